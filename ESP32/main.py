@@ -1,7 +1,14 @@
 # gps_main.py - 稳健的 GGA 解析 + VTG/RMC 速度解析 + DTU 上传（MicroPython）
 from machine import UART
+import machine
+import math
 import time
+import uasyncio as asyncio
 import ujson
+import ubinascii
+import ustruct
+import urandom
+import uos
 import sys
 
 # 配置
@@ -17,10 +24,39 @@ DTU_RX = 15
 
 BOOT_WAIT = 20      # 启动后等待 DTU 联网时间（秒）
 PRINT_INTERVAL = 1  # 控制台打印间隔（秒）
-UPLOAD_INTERVAL = 2 # 上传间隔（秒）
+UPLOAD_INTERVAL = 2 # 最短上传间隔（秒）
+
+# 按运动状态自适应上传：停着时只发心跳，行驶中按距离/转向/最长间隔触发
+MOVING_SPEED_KMH = 5.0      # 速度不低于这个值视为行驶（停车时 GPS 速度噪声一般在 2km/h 以内）
+HEARTBEAT_INTERVAL = 60     # 静止时的心跳间隔（秒）
+STATIONARY_DISTANCE_M = 50  # 静止状态下位置偏离上次上传超过这么远也上传（被推走、低速挪车）
+MOVE_DISTANCE_M = 30        # 行驶中距上次上传超过多少米上传
+HEADING_CHANGE_DEG = 20     # 行驶中航向变化超过多少度上传（保留转弯处的形状）
+MOVING_MAX_INTERVAL = 15    # 行驶中最长多久必须上传一次（秒）
+
+# 设备 ID：服务器按它区分多台定位器，默认取芯片唯一 ID，也可手动改成车牌等
+DEVICE_ID = ubinascii.hexlify(machine.unique_id()).decode()
+
+# 上传协议
+UPLINK_MODE = "frame"   # "frame": 紧凑二进制批量帧（服务器确认、断网缓存）；"json": 旧的逐条 JSON 行
+BATCH_SIZE = 5          # 每帧最多打包几个定位点
+BATCH_MAX_WAIT = 10     # 不满一帧时最多攒多久就发（秒）
+ACK_TIMEOUT = 15        # 发出后多久没收到服务器确认就重发（秒）
+ACK_MAX_RETRIES = 120   # 同一帧最多重发多少次（约 30 分钟），仍没有确认就丢弃，避免一帧卡住整个队列
+RAM_FRAMES = 64         # 内存里最多缓存的待发帧数，再多的按顺序写到 flash
+SPOOL_FILE = "spool.bin"
+SPOOL_MAX_BYTES = 256 * 1024  # flash 缓存上限，满了以后丢弃新帧
+
+# NMEA 读取与调度
+QUIET = True          # 安静模式：不打印每条原始 NMEA 句子（5~10Hz 模块下逐条打印会拖慢读取，导致串口溢出）
+GPS_RXBUF = 2048      # GPS 串口驱动的接收缓冲（字节）
+NMEA_BUF_SIZE = 512   # 句子拼接缓冲（字节），一条 NMEA 最长 82 字节
+GPS_POLL_MS = 20      # GPS 串口没有新数据时的轮询间隔（毫秒）
+DTU_POLL_MS = 100     # 发送/确认处理的间隔（毫秒）
+DTU_OUT_MAX = 32      # 待写入 DTU 的数据块上限，超过时丢弃最早的
 
 # 初始化串口
-gps_uart = UART(GPS_UART_ID, baudrate=GPS_BAUD, rx=GPS_RX, tx=GPS_TX, timeout=1000)
+gps_uart = UART(GPS_UART_ID, baudrate=GPS_BAUD, rx=GPS_RX, tx=GPS_TX, timeout=0, rxbuf=GPS_RXBUF)
 dtu_uart = UART(DTU_UART_ID, baudrate=DTU_BAUD, tx=DTU_TX, rx=DTU_RX, timeout=1000)
 
 def print_flush(*args, **kwargs):
@@ -31,27 +67,27 @@ def print_flush(*args, **kwargs):
         pass
 
 print_flush("摩托车定位器启动成功！等待 GPS 定位与 DTU 联网...")
-time.sleep(BOOT_WAIT)
 
 last_print = 0
 last_upload = 0
 latest_fix = None  # (timestr, lat, lon, sats, alt, qual)
 latest_speed_kmh = 0.0
+latest_course = None  # 对地航向（度），RMC/VTG 给出，静止时可能为空
+last_sent = None      # 上次上传时的 (lat, lon, course, moving)
 
-def parse_gga(line):
+def parse_gga(parts):
     """
-    解析单条 GGA 句子，返回 (timestr, lat, lon, sats, alt, qual) 或 None
+    解析已按逗号切分的 GGA 句子，返回 (timestr, lat, lon, sats, alt, qual) 或 None
     """
-    parts = line.split(',')
     if len(parts) < 10:
         return None
     qual = parts[6]
     if qual in ('0', ''):
         return None
     lat_raw = parts[2]
-    lat_dir = parts[3] if len(parts) > 3 else ''
+    lat_dir = parts[3]
     lon_raw = parts[4]
-    lon_dir = parts[5] if len(parts) > 5 else ''
+    lon_dir = parts[5]
     try:
         if not lat_raw or not lon_raw:
             return None
@@ -68,99 +104,501 @@ def parse_gga(line):
         print_flush("GGA 解析异常:", e)
         return None
 
-# 主循环：读取串口，解析 GGA/VTG/RMC，打印并定期上传最新位置与速度
-while True:
+# ---------- NMEA 读取 ----------
+def _hex(c):
+    return c - 48 if c <= 57 else (c | 32) - 87
+
+class NmeaReader:
+    """
+    GPS 串口句子读取器：readinto 追加到预分配的缓冲区，按换行切句，
+    校验 *hh 校验和后按句子类型（GGA/RMC/VTG，不区分 GP/GN/BD 前缀）分发，
+    每条句子只解码、切分一次；不关心的类型不解码。
+    """
+
+    def __init__(self, uart, handlers, size=NMEA_BUF_SIZE):
+        self.uart = uart
+        self.handlers = handlers   # {b'GGA': fn(parts), ...}
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.fill = 0
+        self.good = 0
+        self.bad = 0       # 校验失败或格式不对
+        self.overflow = 0  # 缓冲区满仍没有换行，整块丢弃的次数
+
+    def poll(self):
+        """读入串口里已到达的数据并处理其中完整的句子，返回读到的字节数。"""
+        n = self.uart.any()
+        if not n:
+            return 0
+        if self.fill == len(self.buf):
+            self.fill = 0
+            self.overflow += 1
+        end = self.fill + min(n, len(self.buf) - self.fill)
+        got = self.uart.readinto(self.mv[self.fill:end]) or 0
+        buf = self.buf
+        start = 0
+        end = self.fill + got
+        for i in range(self.fill, end):
+            if buf[i] == 10:  # '\n'
+                self._sentence(start, i)
+                start = i + 1
+        rest = end - start
+        if start and rest:
+            self.mv[0:rest] = self.mv[start:end]
+        self.fill = rest
+        return got
+
+    def _sentence(self, start, end):
+        buf = self.buf
+        while start < end and buf[start] != 36:  # 跳到 '$'
+            start += 1
+        if end > start and buf[end - 1] == 13:   # '\r'
+            end -= 1
+        if end - start < 10 or buf[end - 3] != 42:  # 至少 "$xxYYY*hh"
+            self.bad += 1
+            return
+        cs = 0
+        for i in range(start + 1, end - 3):
+            cs ^= buf[i]
+        if cs != (_hex(buf[end - 2]) << 4) | _hex(buf[end - 1]):
+            self.bad += 1
+            if not QUIET:
+                print_flush("NMEA 校验失败:", bytes(self.mv[start:end]))
+            return
+        self.good += 1
+        if not QUIET:
+            print_flush("原始 NMEA 数据:", bytes(self.mv[start:end]).decode())
+        handler = self.handlers.get(bytes(self.mv[start + 3:start + 6]))
+        if handler is not None:
+            handler(bytes(self.mv[start:end - 3]).decode().split(','))
+
+# ---------- DTU 发送队列 ----------
+# 所有写往 DTU 的数据先进这个队列，由 dtu_task 异步写出，串口发送不阻塞 GPS 读取
+dtu_out = []
+
+def dtu_send(data):
+    if len(dtu_out) >= DTU_OUT_MAX:
+        dtu_out.pop(0)
+    dtu_out.append(data)
+
+# ---------- 紧凑二进制上报帧 ----------
+# 与服务器 success.py 中的解码一致（小端）：
+#   帧:     magic(B)=0xA5  type(B)  length(H)  payload  crc32(I)   crc 覆盖 magic..payload
+#   0x01 定位批次 payload:
+#           seq(H)  id_len(B) id  n(B)
+#           关键帧  lat(i) lon(i) 1e-6 度, t(I) UTC 秒(0=未知), alt(i) 0.1 米,
+#                   sats(B) quality(B) speed(H) 0.01 km/h
+#           n-1 个增量  dlat(h) dlon(h) 1e-6 度, dt(B) 秒, dalt(h) 0.1 米, sats(B) speed(H)
+#   0x81 确认 payload: seq(H)
+# 一帧 5 个点约 100 字节，同样内容的 JSON 约 700 字节。
+FRAME_MAGIC = 0xA5
+FRAME_FIXES = 0x01
+FRAME_ACK = 0x81
+ACK_FRAME_SIZE = 10
+DEVICE_ID_BYTES = DEVICE_ID.encode()
+
+latest_date = None  # RMC 中的 UTC 日期 (年, 月, 日)
+
+def utc_epoch(date, timestr):
+    """GNSS 日期 + GGA 时间 "hh:mm:ss" -> Unix 秒（不依赖板子的 RTC）；没有日期时返回 0。"""
+    if not date or len(timestr) < 8:
+        return 0
     try:
-        if gps_uart.any():
-            raw = gps_uart.readline()
-            if not raw:
-                time.sleep(0.05)
+        y, m, d = date
+        y -= m <= 2
+        era = y // 400
+        yoe = y - era * 400
+        doy = (153 * (m + (-3 if m > 2 else 9)) + 2) // 5 + d - 1
+        doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+        days = era * 146097 + doe - 719468
+        return days * 86400 + int(timestr[0:2]) * 3600 + int(timestr[3:5]) * 60 + int(timestr[6:8])
+    except Exception:
+        return 0
+
+def _clamp(v, lo, hi):
+    return lo if v < lo else hi if v > hi else v
+
+def _fix_ints(fix):
+    """(lat, lon, t, alt, sats, qual, speed_kmh) -> 帧里使用的定点整数。"""
+    lat, lon, t, alt, sats, qual, speed = fix
+    return (int(round(lat * 1e6)), int(round(lon * 1e6)), t, int(round(alt * 10)),
+            _clamp(sats, 0, 255), _clamp(qual, 0, 255), _clamp(int(round(speed * 100)), 0, 65535))
+
+def can_delta(prev, fix):
+    """fix 能否以增量形式跟在 prev 后面（超出增量字段范围就另起关键帧）。"""
+    a = _fix_ints(prev); b = _fix_ints(fix)
+    if (a[2] == 0) != (b[2] == 0) or a[5] != b[5]:
+        return False
+    dt = b[2] - a[2]
+    return (0 <= dt <= 255 and abs(b[0] - a[0]) <= 32767 and abs(b[1] - a[1]) <= 32767
+            and abs(b[3] - a[3]) <= 32767)
+
+def encode_frame(seq, fixes):
+    key = _fix_ints(fixes[0])
+    body = ustruct.pack('<HB', seq, len(DEVICE_ID_BYTES)) + DEVICE_ID_BYTES + ustruct.pack('<B', len(fixes))
+    body += ustruct.pack('<iiIiBBH', *key)
+    prev = key
+    for fix in fixes[1:]:
+        cur = _fix_ints(fix)
+        body += ustruct.pack('<hhBhBH', cur[0] - prev[0], cur[1] - prev[1], cur[2] - prev[2],
+                             cur[3] - prev[3], cur[4], cur[6])
+        prev = cur
+    head = ustruct.pack('<BBH', FRAME_MAGIC, FRAME_FIXES, len(body)) + body
+    return head + ustruct.pack('<I', ubinascii.crc32(head) & 0xffffffff)
+
+def frame_seq(frame):
+    return ustruct.unpack_from('<H', frame, 4)[0]
+
+def frame_ok(frame):
+    """帧头、长度和 CRC 都对得上（用于检查从 flash 读回的帧）。"""
+    if len(frame) < 8 or frame[0] != FRAME_MAGIC:
+        return False
+    if ustruct.unpack_from('<H', frame, 2)[0] != len(frame) - 8:
+        return False
+    return ubinascii.crc32(frame[:-4]) & 0xffffffff == ustruct.unpack_from('<I', frame, len(frame) - 4)[0]
+
+class Spool:
+    """
+    待发帧队列（存储转发）：最早的一批在内存里，放不下的按顺序追加到 flash 文件。
+    flash 里的帧读回内存后，等内存清空（全部确认）才删除文件；中途重启会从头重发，
+    服务器按帧 CRC 去重。启动时先检查文件，写到一半掉电留下的残缺记录之后的部分不算数，
+    新帧从最后一条完整记录后面接着写。读回时记录的长度、帧头或 CRC 仍不对，
+    剩下的部分已经无法对齐，整段放弃。
+    """
+
+    def __init__(self):
+        self.ram = []
+        self.flash_pos = 0    # flash 文件中下一个还没读回内存的位置
+        self.dropped = 0
+        self.corrupt = 0      # 发现损坏、被放弃的次数
+        self.flash_size = self._scan()  # 有效数据的末尾，新帧从这里写
+
+    def _scan(self):
+        """启动时逐条检查 flash 文件，返回最后一条完整记录的末尾。"""
+        end = 0
+        try:
+            size = uos.stat(SPOOL_FILE)[6]
+            with open(SPOOL_FILE, 'rb') as f:
+                while True:
+                    hdr = f.read(2)
+                    if len(hdr) < 2:
+                        break
+                    length = ustruct.unpack('<H', hdr)[0]
+                    data = f.read(length)
+                    if len(data) != length or not frame_ok(data):
+                        break
+                    end += 2 + length
+        except OSError:
+            return 0
+        if end < size:
+            self.corrupt += 1
+            print_flush("flash 缓存尾部不完整，丢弃 {} 字节".format(size - end))
+        return end
+
+    def push(self, frame):
+        # flash 里还有没读回的帧时，新帧也必须排到 flash 后面，保证顺序
+        if self.flash_pos < self.flash_size or len(self.ram) >= RAM_FRAMES:
+            if self.flash_size + len(frame) + 2 > SPOOL_MAX_BYTES:
+                self.dropped += 1
+                return
+            # 不用追加模式：文件末尾可能还留着掉电时写了一半的记录，从有效数据末尾覆盖写
+            with open(SPOOL_FILE, 'r+b' if self.flash_size else 'wb') as f:
+                f.seek(self.flash_size)
+                f.write(ustruct.pack('<H', len(frame)))
+                f.write(frame)
+            self.flash_size += len(frame) + 2
+        else:
+            self.ram.append(frame)
+
+    def head(self):
+        if not self.ram and self.flash_pos < self.flash_size:
+            self._load()
+        return self.ram[0] if self.ram else None
+
+    def pop(self):
+        self.ram.pop(0)
+        if not self.ram and self.flash_size and self.flash_pos >= self.flash_size:
+            try:
+                uos.remove(SPOOL_FILE)
+            except OSError:
+                pass
+            self.flash_pos = self.flash_size = 0
+
+    def _load(self):
+        bad = False
+        with open(SPOOL_FILE, 'rb') as f:
+            f.seek(self.flash_pos)
+            while len(self.ram) < RAM_FRAMES and self.flash_pos < self.flash_size:
+                hdr = f.read(2)
+                length = ustruct.unpack('<H', hdr)[0] if len(hdr) == 2 else 0
+                data = f.read(length) if length else b''
+                if len(data) != length or not frame_ok(data):
+                    bad = True
+                    break
+                self.ram.append(data)
+                self.flash_pos += 2 + length
+        if bad:
+            # 记录损坏（例如写到一半掉电）：后面的记录都对不齐了，放弃到当前文件末尾
+            self.corrupt += 1
+            print_flush("flash 缓存损坏，丢弃 {} 字节".format(self.flash_size - self.flash_pos))
+            self.flash_pos = self.flash_size
+
+    def pending(self):
+        return len(self.ram) + (1 if self.flash_pos < self.flash_size else 0)
+
+class Uplink:
+    """攒批 -> 编码 -> 入队；队首帧发出后等服务器确认，超时重发（停等式）。"""
+
+    def __init__(self):
+        self.spool = Spool()
+        self.batch = []
+        self.batch_started = 0
+        self.seq = urandom.getrandbits(16)
+        self.inflight = None
+        self.sent_at = 0
+        self.retries = 0      # 当前队首帧已经重发的次数
+        self.gave_up = 0      # 重发次数用完被丢弃的帧数
+        self.rx = b''
+
+    def add_fix(self, fix):
+        if self.batch and not can_delta(self.batch[-1], fix):
+            self.flush()
+        if not self.batch:
+            self.batch_started = time.time()
+        self.batch.append(fix)
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        self.seq = (self.seq + 1) & 0xFFFF
+        self.spool.push(encode_frame(self.seq, self.batch))
+        self.batch = []
+
+    def pump(self):
+        """主循环里周期调用：超时攒批、读确认、发送/重发队首帧。"""
+        now = time.time()
+        if self.batch and now - self.batch_started >= BATCH_MAX_WAIT:
+            self.flush()
+        self.read_acks()
+        frame = self.spool.head()
+        if frame is None:
+            return
+        if self.inflight is frame:
+            if now - self.sent_at < ACK_TIMEOUT:
+                return
+            self.retries += 1
+            if self.retries > ACK_MAX_RETRIES:
+                self.gave_up += 1
+                print_flush("帧 {} 重发 {} 次仍未确认，丢弃".format(frame_seq(frame), ACK_MAX_RETRIES))
+                self.spool.pop()
+                self.inflight = None
+                frame = self.spool.head()
+                if frame is None:
+                    return
+        if self.inflight is not frame:
+            self.retries = 0
+        dtu_send(frame)
+        self.inflight = frame
+        self.sent_at = now
+
+    def read_acks(self):
+        n = dtu_uart.any()
+        if not n:
+            return
+        rx = self.rx + dtu_uart.read(n)
+        while True:
+            i = rx.find(bytes([FRAME_MAGIC]))
+            if i < 0:
+                rx = b''
+                break
+            rx = rx[i:]
+            if len(rx) < ACK_FRAME_SIZE:
+                break
+            ok = (rx[1] == FRAME_ACK and ustruct.unpack_from('<H', rx, 2)[0] == 2 and
+                  ubinascii.crc32(rx[:6]) & 0xffffffff == ustruct.unpack_from('<I', rx, 6)[0])
+            if not ok:
+                rx = rx[1:]  # DTU 自己的提示信息等杂数据，跳过
                 continue
+            self.on_ack(ustruct.unpack_from('<H', rx, 4)[0])
+            rx = rx[ACK_FRAME_SIZE:]
+        self.rx = rx[-64:]
+
+    def on_ack(self, seq):
+        head = self.spool.head()
+        if head is not None and frame_seq(head) == seq:
+            self.spool.pop()
+            self.inflight = None  # 下一轮 pump 立即发送下一帧，恢复联网后快速补传
+
+uplink = Uplink() if UPLINK_MODE == "frame" else None
+
+# ---------- 句子处理 ----------
+def _course(field):
+    global latest_course
+    try:
+        latest_course = float(field) if field else None
+    except ValueError:
+        latest_course = None
+
+def on_vtg(parts):
+    """VTG：航向在 parts[1]，速度 km/h 在 parts[7]。"""
+    global latest_speed_kmh
+    if len(parts) > 1:
+        _course(parts[1])
+    if len(parts) > 7 and parts[7]:
+        try:
+            latest_speed_kmh = float(parts[7])
+        except ValueError:
+            pass
+
+def on_rmc(parts):
+    """RMC：速度（knots 在 parts[7]，需 *1.852 -> km/h）、航向（parts[8]）与 UTC 日期。"""
+    global latest_speed_kmh, latest_date
+    if len(parts) > 8:
+        _course(parts[8])
+    if len(parts) > 7 and parts[7]:
+        try:
+            latest_speed_kmh = float(parts[7]) * 1.852
+        except ValueError:
+            pass
+    # UTC 日期 ddmmyy，用于给二进制帧里的定位点打时间戳
+    if len(parts) > 9 and len(parts[9]) == 6:
+        try:
+            d = parts[9]
+            latest_date = (2000 + int(d[4:6]), int(d[2:4]), int(d[0:2]))
+        except ValueError:
+            pass
+
+def on_gga(parts):
+    """GGA：位置。每秒打印一次，按 upload_reason 的判断上传。"""
+    global latest_fix, last_print, last_upload, last_sent
+    res = parse_gga(parts)
+    if not res:
+        return
+    latest_fix = res
+    now = time.time()
+
+    # 打印（每秒一次）
+    if now - last_print >= PRINT_INTERVAL:
+        timestr, lat, lon, sats, alt, qual = latest_fix
+        print_flush("时间:", timestr)
+        print_flush("纬度: {:.6f}°{}".format(abs(lat), "S" if lat < 0 else "N"))
+        print_flush("经度: {:.6f}°{}".format(abs(lon), "W" if lon < 0 else "E"))
+        print_flush("卫星: {} 颗   海拔: {} 米   质量: {}".format(sats, alt, qual))
+        print_flush("速度: {:.2f} km/h".format(latest_speed_kmh))
+        print_flush("NMEA: 有效 {} 条  校验失败 {} 条  缓冲溢出 {} 次".format(
+            gps_reader.good, gps_reader.bad, gps_reader.overflow))
+        print_flush("-" * 60)
+        last_print = now
+
+    # 上传（按运动状态决定）
+    reason = upload_reason(latest_fix, now)
+    if reason:
+        try:
+            upload(latest_fix)
+            if not QUIET:
+                print_flush("上传原因:", reason)
+        except Exception as e:
+            print_flush("上传时发生错误:", e)
+        last_upload = now
+        last_sent = (latest_fix[1], latest_fix[2], latest_course, latest_speed_kmh >= MOVING_SPEED_KMH)
+
+def _distance_m(lat1, lon1, lat2, lon2):
+    # 等距圆柱近似，几十米到几公里的范围足够准确
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371000.0 * math.sqrt(x * x + y * y)
+
+def upload_reason(fix, now):
+    """需要上传时返回原因，否则返回 None。"""
+    if last_sent is None:
+        return "首个定位"
+    dt = now - last_upload
+    if dt < UPLOAD_INTERVAL:
+        return None
+    sent_lat, sent_lon, sent_course, sent_moving = last_sent
+    moving = latest_speed_kmh >= MOVING_SPEED_KMH
+    if moving != sent_moving:
+        return "起步" if moving else "停车"
+    dist = _distance_m(sent_lat, sent_lon, fix[1], fix[2])
+    if not moving:
+        if dt >= HEARTBEAT_INTERVAL:
+            return "心跳"
+        if dist >= STATIONARY_DISTANCE_M:
+            return "静止中位置偏移"
+        return None
+    if dist >= MOVE_DISTANCE_M:
+        return "距离"
+    if latest_course is not None and sent_course is not None:
+        turn = abs(latest_course - sent_course) % 360
+        if min(turn, 360 - turn) >= HEADING_CHANGE_DEG:
+            return "转向"
+    if dt >= MOVING_MAX_INTERVAL:
+        return "定时"
+    return None
+
+def upload(fix):
+    timestr, lat, lon, sats, alt, qual = fix
+    if uplink is not None:
+        uplink.add_fix((lat, lon, utc_epoch(latest_date, timestr), alt, sats, int(qual), latest_speed_kmh))
+        if not QUIET:
+            print_flush("↑ 已加入上传队列，待发帧:", uplink.spool.pending())
+        return
+    payload = ujson.dumps({
+        "id": DEVICE_ID,
+        "lat": round(lat, 6),
+        "lon": round(lon, 6),
+        "alt": alt,
+        "sats": sats,
+        "quality": qual,
+        "speed_kmh": round(latest_speed_kmh, 2),
+        "time": int(time.time())
+    }) + "\r\n"
+    dtu_send(payload.encode())
+    if not QUIET:
+        print_flush("↑ 已上传到 DTU:", payload.strip())
+
+gps_reader = NmeaReader(gps_uart, {b'GGA': on_gga, b'RMC': on_rmc, b'VTG': on_vtg})
+
+# ---------- 调度 ----------
+async def gps_task():
+    """持续读取 GPS：有数据就处理并立即让出，没有数据时短暂休眠。"""
+    while True:
+        try:
+            got = gps_reader.poll()
+        except Exception as e:
+            print_flush("GPS 读取或处理异常:", e)
             try:
-                text = raw.decode('ascii', 'ignore')
+                sys.print_exception(e)
             except:
-                text = repr(raw)
-
-            for line in text.splitlines():
-                line = line.strip()
-                if not line:
-                    continue
-                print_flush("原始 NMEA 数据:", line)
-
-                # 处理 VTG（速度，km/h 在 parts[7]）
-                try:
-                    if len(line) >= 6 and line[0] == '$' and line[3:6] == 'VTG':
-                        parts = line.split(',')
-                        if len(parts) > 7 and parts[7]:
-                            try:
-                                sp_kmh = float(parts[7])
-                                latest_speed_kmh = sp_kmh
-                            except:
-                                pass
-                except Exception as e:
-                    print_flush("VTG 解析异常:", e)
-
-                # 处理 RMC（速度，knots 在 parts[7]，需 *1.852 -> km/h）
-                try:
-                    if len(line) >= 6 and line[0] == '$' and (line[3:6] == 'RMC' or line[3:6] == 'GPR' or line[1:4] == 'GNR'):
-                        # 兼容 GNRMC/GPRMC
-                        parts = line.split(',')
-                        if len(parts) > 7 and parts[7]:
-                            try:
-                                sp_knots = float(parts[7])
-                                latest_speed_kmh = sp_knots * 1.852
-                            except:
-                                pass
-                except Exception as e:
-                    # 不要阻塞主循环
-                    print_flush("RMC 解析异常:", e)
-
-                # 处理 GGA（位置）
-                if len(line) >= 6 and line[0] == '$' and line[3:6] == 'GGA':
-                    res = parse_gga(line)
-                    if res:
-                        latest_fix = res
-                        now = time.time()
-
-                        # 打印（每秒一次）
-                        if now - last_print >= PRINT_INTERVAL:
-                            timestr, lat, lon, sats, alt, qual = latest_fix
-                            print_flush("时间:", timestr)
-                            print_flush("纬度: {:.6f}°{}".format(abs(lat), "S" if lat < 0 else "N"))
-                            print_flush("经度: {:.6f}°{}".format(abs(lon), "W" if lon < 0 else "E"))
-                            print_flush("卫星: {} 颗   海拔: {} 米   质量: {}".format(sats, alt, qual))
-                            print_flush("速度: {:.2f} km/h".format(latest_speed_kmh))
-                            print_flush("原始数据:", line)
-                            print_flush("-" * 60)
-                            last_print = now
-
-                        # 上传（每 UPLOAD_INTERVAL 秒）
-                        if time.time() - last_upload >= UPLOAD_INTERVAL:
-                            try:
-                                timestr, lat, lon, sats, alt, qual = latest_fix
-                                payload = ujson.dumps({
-                                    "lat": round(lat, 6),
-                                    "lon": round(lon, 6),
-                                    "alt": alt,
-                                    "sats": sats,
-                                    "quality": qual,
-                                    "speed_kmh": round(latest_speed_kmh, 2),
-                                    "time": int(time.time())
-                                }) + "\r\n"
-                                dtu_uart.write(payload.encode())
-                                print_flush("↑ 已上传到 DTU:", payload.strip())
-                                last_upload = time.time()
-                            except Exception as e:
-                                print_flush("上传时发生错误:", e)
-    except KeyboardInterrupt:
-        print_flush("检测到 KeyboardInterrupt，停止运行（REPL 中断）。")
-        break
-    except Exception as e:
-        print_flush("串口读取或处理异常:", e)
+                pass
+            got = 0
+        await asyncio.sleep_ms(0 if got else GPS_POLL_MS)
+
+async def dtu_task():
+    """等待 DTU 联网后，周期处理确认/重发，并把发送队列异步写出。"""
+    writer = asyncio.StreamWriter(dtu_uart, {})
+    await asyncio.sleep(BOOT_WAIT)  # 这段时间 GPS 照常读取，定位点先进上传队列
+    while True:
         try:
-            sys.print_exception(e)
-        except:
-            pass
-        time.sleep(1)
+            if uplink is not None:
+                # 发送/重发待发帧，处理服务器确认（联网恢复后逐帧补传）
+                uplink.pump()
+            while dtu_out:
+                writer.write(dtu_out.pop(0))
+                await writer.drain()
+        except Exception as e:
+            print_flush("DTU 发送异常:", e)
+        await asyncio.sleep_ms(DTU_POLL_MS)
+
+async def main():
+    asyncio.create_task(dtu_task())
+    await gps_task()
 
-    time.sleep(0.1)
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    print_flush("检测到 KeyboardInterrupt，停止运行（REPL 中断）。")
+finally:
+    asyncio.new_event_loop()
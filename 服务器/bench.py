@@ -0,0 +1,168 @@
+# bench.py - success.py 热点函数的微基准
+# 用法：python bench.py coords|filter|geofence [-n 100000]
+import argparse
+import random
+import time
+
+import success
+
+
+def timed(fn, repeat=3):
+    """取 repeat 次中最快的一次（秒）。"""
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None or dt < best else best
+    return best
+
+
+def report(name, n, seconds):
+    print(f"  {name:<34} {seconds * 1000:9.1f} ms   {n / seconds / 1000:10.1f} k点/秒")
+
+
+def bench_coords(args):
+    """坐标转换与距离：逐点标量 vs 批量（numpy / 纯 Python 回退）。"""
+    n = args.n
+    rnd = random.Random(1)
+    lats = [30.0 + rnd.uniform(-0.5, 0.5) for _ in range(n)]
+    lons = [120.0 + rnd.uniform(-0.5, 0.5) for _ in range(n)]
+    print(f"坐标转换/距离，{n} 个点，numpy: {'有' if success.np is not None else '无'}")
+
+    conv = success.wgs84_to_gcj02
+    report("wgs84_to_gcj02 逐点", n, timed(lambda: [conv(a, b) for a, b in zip(lats, lons)]))
+    report("wgs84_to_gcj02_batch", n, timed(lambda: success.wgs84_to_gcj02_batch(lats, lons)))
+
+    hav = success.haversine
+    report("haversine 逐点（相邻点）", n,
+           timed(lambda: [hav(lats[i], lons[i], lats[i + 1], lons[i + 1]) for i in range(n - 1)]))
+    report("haversine_consecutive", n, timed(lambda: success.haversine_consecutive(lats, lons)))
+
+    ooc = success.out_of_china
+    report("out_of_china 逐点", n, timed(lambda: [ooc(a, b) for a, b in zip(lats, lons)]))
+    report("out_of_china_batch", n, timed(lambda: success.out_of_china_batch(lats, lons)))
+
+    if success.np is not None:
+        # 输入已经是 ndarray 时（例如从文件整列读入），省掉 list -> ndarray 的转换
+        np = success.np
+        alat = np.asarray(lats); alon = np.asarray(lons)
+        report("wgs84_to_gcj02_batch (ndarray)", n, timed(lambda: success.wgs84_to_gcj02_batch(alat, alon)))
+        report("haversine_consecutive (ndarray)", n, timed(lambda: success.haversine_consecutive(alat, alon)))
+
+
+def _noisy_track(n, rnd, sigma=5.0, outlier_rate=0.03, outlier_m=200.0):
+    """1Hz 的模拟行驶轨迹：真实位置 + 高斯噪声，按比例混入多路径造成的大偏差点。"""
+    m_lat = 110540.0
+    m_lon = 111320.0 * 0.866
+    lat, lon, heading, speed = 30.0, 120.0, 0.0, 10.0
+    want_heading, want_speed = heading, speed
+    truth, points, bad = [], [], []
+    for i in range(n):
+        if i % 60 == 0:
+            want_heading = heading + rnd.uniform(-3.14, 3.14)
+            want_speed = rnd.choice((0.0, 5.0, 10.0, 20.0))
+        # 转向不超过 0.3 rad/s，加减速不超过 2 m/s²
+        heading += max(-0.3, min(0.3, want_heading - heading))
+        speed += max(-2.0, min(2.0, want_speed - speed))
+        lat += speed * success.math.cos(heading) / m_lat
+        lon += speed * success.math.sin(heading) / m_lon
+        truth.append((lat, lon))
+        is_bad = rnd.random() < outlier_rate
+        err = outlier_m if is_bad else sigma
+        points.append((lat + rnd.gauss(0, err) / m_lat, lon + rnd.gauss(0, err) / m_lon,
+                       speed * 3.6 + rnd.gauss(0, 1), 9, 1, 1000.0 + i))
+        bad.append(is_bad)
+    return truth, points, bad
+
+
+def bench_filter(args):
+    """点过滤：每点耗时，以及相对真实轨迹的误差和离群点识别情况。"""
+    n = args.n
+    truth, points, bad = _noisy_track(n, random.Random(2))
+    print(f"点过滤，{n} 个点（1Hz，噪声 5m，3% 为 200m 离群点）")
+    for name, cls in sorted(success.FILTERS.items()):
+        def run():
+            f = cls()
+            last = None
+            out = []
+            for lat, lon, spd, sats, qual, ts in points:
+                ok, la, lo, _, _ = f.check(last, lat, lon, spd, sats, qual, ts)
+                if ok:
+                    last = (la, lo, ts)
+                out.append((ok, la, lo))
+            return out
+        seconds = timed(run)
+        out = run()
+        err = [success.haversine(t[0], t[1], o[1], o[2]) for t, o in zip(truth, out) if o[0]]
+        rms = (sum(e * e for e in err) / len(err)) ** 0.5 if err else 0.0
+        caught = sum(1 for b, o in zip(bad, out) if b and not o[0])
+        false_drop = sum(1 for b, o in zip(bad, out) if not b and not o[0])
+        report(f"{name}", n, seconds)
+        print(f"  {'':<34} 每点 {seconds / n * 1e6:.2f} µs   误差 RMS {rms:.1f} m   "
+              f"离群点识别 {caught}/{sum(bad)}   误删 {false_drop}")
+
+
+def _random_fences(count, rnd, lat0=29.0, lon0=119.0, span=2.0):
+    """在 span×span 度（约 200 公里见方，一个城市群）内随机放置圆形和多边形围栏。"""
+    fences = []
+    for i in range(count):
+        lat = lat0 + rnd.uniform(0, span); lon = lon0 + rnd.uniform(0, span)
+        r = rnd.uniform(50, 500)
+        if i % 2:
+            fences.append({"type": "circle", "lat": lat, "lon": lon, "radius": r})
+        else:
+            d = r / 111000.0
+            fences.append({"type": "polygon", "points": [[lat - d, lon - d], [lat - d, lon + d],
+                                                         [lat + d * 1.5, lon], [lat + d, lon - d * 0.5]]})
+    return fences
+
+
+def bench_geofence(args):
+    """地理围栏：每点耗时随围栏数量的变化，网格索引 vs 逐个检查。"""
+    n = args.n
+    rnd = random.Random(4)
+    lat, lon = 30.0, 120.0
+    pts = []
+    for i in range(n):
+        lat += rnd.uniform(-1, 1) * 0.0005; lon += rnd.uniform(-1, 1) * 0.0005
+        pts.append((f"d{i % 100}", lat, lon))
+    print(f"地理围栏，{n} 个点，100 台设备，围栏随机分布在 2°×2° 范围内")
+    for count in (0, 100, 1000, 10000, 50000):
+        engine = success.GeofenceEngine()
+        for spec in _random_fences(count, rnd):
+            engine.put(spec)
+
+        def run():
+            ev = engine.evaluate
+            for i, (dev, la, lo) in enumerate(pts):
+                ev(dev, la, lo, i)
+        report(f"网格索引，{count} 个围栏", n, timed(run))
+        if count <= 1000:
+            fences = list(engine.fences.values())
+
+            def brute():
+                for dev, la, lo in pts:
+                    [f.id for f in fences if f.contains(la, lo)]
+            report(f"逐个检查，{count} 个围栏", n, timed(brute))
+
+
+BENCHES = {
+    "coords": bench_coords,
+    "filter": bench_filter,
+    "geofence": bench_geofence,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="success.py 微基准")
+    parser.add_argument("bench", choices=sorted(BENCHES) + ["all"])
+    parser.add_argument("-n", type=int, default=100000, help="点数")
+    args = parser.parse_args()
+    names = sorted(BENCHES) if args.bench == "all" else [args.bench]
+    for name in names:
+        BENCHES[name](args)
+
+
+if __name__ == "__main__":
+    main()
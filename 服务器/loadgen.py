@@ -0,0 +1,350 @@
+# loadgen.py - 本机压测：模拟大量定位器向 TCP 端口上报，同时模拟观看者请求 /data
+#
+# 用法：
+#   python loadgen.py --spawn                        # 在临时目录启动一个 success.py 再压测
+#   python loadgen.py --devices 500 --rate 1 --viewers 20 --duration 30
+#   python loadgen.py --replay log.jsonl             # 回放 ESP32 上报的 JSON 行
+#
+# 上报格式与 ESP32/main.py 写入 DTU 的 JSON 行相同，另外带一个 t_sent 字段；
+# 服务器会把它原样放进 latest，--probes 个设备通过 /stream 订阅，
+# 收到推送时用 t_sent 计算端到端的接入延迟。
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def percentiles(values):
+    if not values:
+        return {"n": 0}
+    v = sorted(values)
+    pick = lambda q: v[min(len(v) - 1, int(q * len(v)))]
+    return {"n": len(v), "p50": pick(0.50), "p90": pick(0.90), "p99": pick(0.99), "max": v[-1]}
+
+
+def fmt_ms(p):
+    if p["n"] == 0:
+        return "无数据"
+    return "n={n}  p50={:.1f}ms  p90={:.1f}ms  p99={:.1f}ms  max={:.1f}ms".format(
+        p["p50"] * 1000, p["p90"] * 1000, p["p99"] * 1000, p["max"] * 1000, n=p["n"])
+
+
+class Results:
+    def __init__(self):
+        self.sent = 0
+        self.send_errors = 0
+        self.ingest_latency = []
+        self.http_latency = []
+        self.http_bytes = 0
+        self.http_status = {}
+        self.http_errors = 0
+
+
+# ---------- 模拟设备 ----------
+def synthetic_track(index, rnd, rate=1.0):
+    """
+    按 rate 次/秒采样的模拟行驶轨迹：每隔约一分钟换一个目标航向和速度（含停车），
+    转向不超过 0.3 rad/s、加减速不超过 2 m/s²，加几米的定位噪声；
+    0.5% 的点是一次大跳变（应被服务器丢弃），其余都应被接受。
+    """
+    dt = 1.0 / rate
+    m_lat = 110540.0
+    lat = 30.0 + rnd.uniform(-1, 1)
+    lon = 120.0 + rnd.uniform(-1, 1)
+    m_lon = 111320.0 * math.cos(math.radians(lat))
+    heading = rnd.uniform(-math.pi, math.pi)
+    speed = 0.0
+    want_heading, want_speed = heading, speed
+    next_change = 0.0
+    t = 0.0
+    while True:
+        if t >= next_change:
+            want_heading = heading + rnd.uniform(-math.pi, math.pi)
+            want_speed = rnd.choice((0.0, 5.0, 10.0, 15.0, 20.0))
+            next_change = t + rnd.uniform(30, 90)
+        heading += max(-0.3 * dt, min(0.3 * dt, want_heading - heading))
+        speed += max(-2.0 * dt, min(2.0 * dt, want_speed - speed))
+        lat += speed * dt * math.cos(heading) / m_lat
+        lon += speed * dt * math.sin(heading) / m_lon
+        t += dt
+        if rnd.random() > 0.995:
+            yield {"lat": lat + 5.0, "lon": lon, "sats": 3}   # 跳变噪声点
+            continue
+        yield {"lat": round(lat + rnd.gauss(0, 3) / m_lat, 6),
+               "lon": round(lon + rnd.gauss(0, 3) / m_lon, 6), "alt": 10.0,
+               "sats": rnd.randint(6, 20), "quality": "1",
+               "speed_kmh": round(max(0.0, speed * 3.6 + rnd.gauss(0, 1)), 2)}
+
+
+def replay_track(lines, index):
+    """回放记录的 JSON 行，每个设备从不同偏移开始循环。"""
+    i = index % len(lines)
+    while True:
+        yield dict(lines[i])
+        i = (i + 1) % len(lines)
+
+
+async def device(args, index, track, res, stop):
+    dev_id = f"load-{index}"
+    interval = 1.0 / args.rate
+    # 错开各设备的启动时间，避免所有设备同一毫秒发包
+    await asyncio.sleep(random.random() * interval)
+    while not stop.is_set():
+        try:
+            reader, writer = await asyncio.open_connection(args.host, args.tcp_port)
+        except OSError:
+            res.send_errors += 1
+            await asyncio.sleep(1)
+            continue
+        try:
+            next_t = time.monotonic()
+            while not stop.is_set():
+                payload = next(track)
+                payload["id"] = dev_id
+                payload["time"] = int(time.time())
+                payload["t_sent"] = time.time()
+                writer.write(json.dumps(payload).encode() + b"\r\n")
+                await writer.drain()
+                res.sent += 1
+                next_t += interval
+                await asyncio.sleep(max(0.0, next_t - time.monotonic()))
+        except (ConnectionError, OSError):
+            res.send_errors += 1
+        finally:
+            writer.close()
+
+
+# ---------- HTTP 客户端（只用标准库 asyncio 流，HTTP/1.0 读到连接关闭为止） ----------
+async def http_get(args, path, headers=None):
+    reader, writer = await asyncio.open_connection(args.host, args.http_port)
+    req = f"GET {path} HTTP/1.0\r\nHost: {args.host}\r\n"
+    for k, v in (headers or {}).items():
+        req += f"{k}: {v}\r\n"
+    writer.write((req + "\r\n").encode())
+    await writer.drain()
+    raw = await reader.read()
+    writer.close()
+    head, _, body = raw.partition(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    hdrs = {}
+    for line in lines[1:]:
+        k, _, v = line.partition(":")
+        hdrs[k.strip().lower()] = v.strip()
+    return status, hdrs, body
+
+
+async def viewer(args, index, res, stop):
+    """模拟一个地图页面：轮询 /data（full 带 ETag，或 since 增量）。"""
+    dev_id = f"load-{index % args.devices}"
+    cursor = 0
+    etag = None
+    await asyncio.sleep(random.random() * args.viewer_interval)
+    while not stop.is_set():
+        if args.viewer_mode == "since":
+            path = f"/data?device={dev_id}&since={cursor}"
+            headers = {}
+        else:
+            path = f"/data?device={dev_id}"
+            headers = {"If-None-Match": etag} if etag else {}
+        if args.gzip:
+            headers["Accept-Encoding"] = "gzip"
+        t0 = time.perf_counter()
+        try:
+            status, hdrs, body = await http_get(args, path, headers)
+        except OSError:
+            res.http_errors += 1
+            await asyncio.sleep(1)
+            continue
+        res.http_latency.append(time.perf_counter() - t0)
+        res.http_bytes += len(body)
+        res.http_status[status] = res.http_status.get(status, 0) + 1
+        if status == 200:
+            etag = hdrs.get("etag")
+            if args.viewer_mode == "since":
+                try:
+                    cursor = json.loads(body).get("cursor", cursor)
+                except ValueError:
+                    pass
+        await asyncio.sleep(args.viewer_interval)
+
+
+async def probe(args, index, res, stop):
+    """订阅一个设备的 /stream，用推送里的 latest.t_sent 计算接入延迟。"""
+    dev_id = f"load-{index}"
+    await asyncio.sleep(1)  # 等设备先上报，服务器里才有这个设备
+    while not stop.is_set():
+        try:
+            reader, writer = await asyncio.open_connection(args.host, args.http_port)
+        except OSError:
+            await asyncio.sleep(1)
+            continue
+        writer.write(f"GET /stream?device={dev_id} HTTP/1.0\r\n\r\n".encode())
+        await writer.drain()
+        first = True
+        try:
+            while not stop.is_set():
+                line = await asyncio.wait_for(reader.readline(), timeout=1)
+                if not line:
+                    break
+                if not line.startswith(b"data: "):
+                    continue
+                now = time.time()
+                if first:
+                    first = False  # 第一条是补发的快照，不算延迟
+                    continue
+                try:
+                    t_sent = json.loads(line[6:])["latest"].get("t_sent")
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if t_sent:
+                    res.ingest_latency.append(now - t_sent)
+        except asyncio.TimeoutError:
+            continue
+        finally:
+            writer.close()
+        await asyncio.sleep(0.5)
+
+
+async def fetch_stats(args):
+    try:
+        status, _, body = await http_get(args, "/stats")
+        return json.loads(body) if status == 200 else None
+    except (OSError, ValueError):
+        return None
+
+
+# ---------- 主流程 ----------
+async def run(args):
+    rnd = random.Random(args.seed)
+    replay = None
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as f:
+            replay = [json.loads(l) for l in f if l.strip().startswith("{")]
+        replay = [r for r in replay if "lat" in r and "lon" in r]
+        if not replay:
+            sys.exit(f"{args.replay} 中没有可回放的 JSON 行")
+
+    res = Results()
+    stop = asyncio.Event()
+    before = await fetch_stats(args)
+    if before is None:
+        sys.exit(f"连不上 http://{args.host}:{args.http_port}/stats，服务器是否已启动？（或加 --spawn）")
+
+    tasks = []
+    for i in range(args.devices):
+        track = replay_track(replay, i) if replay else synthetic_track(i, random.Random(rnd.random()), args.rate)
+        tasks.append(asyncio.create_task(device(args, i, track, res, stop)))
+    for i in range(args.viewers):
+        tasks.append(asyncio.create_task(viewer(args, i, res, stop)))
+    for i in range(min(args.probes, args.devices)):
+        tasks.append(asyncio.create_task(probe(args, i, res, stop)))
+
+    print(f"压测中：{args.devices} 台设备 × {args.rate} 点/秒，{args.viewers} 个观看者"
+          f"（{args.viewer_mode}，每 {args.viewer_interval}s），{args.probes} 个延迟探针，持续 {args.duration}s",
+          file=sys.stderr)
+    t0 = time.monotonic()
+    await asyncio.sleep(args.duration)
+    elapsed = time.monotonic() - t0
+    # 等几百毫秒把还在路上的点处理完再取统计
+    await asyncio.sleep(0.5)
+    after = await fetch_stats(args)
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    report = {
+        "duration": round(elapsed, 2),
+        "sent_per_sec": round(res.sent / elapsed, 1),
+        "send_errors": res.send_errors,
+        "ingest_latency": percentiles(res.ingest_latency),
+        "http_latency": percentiles(res.http_latency),
+        "http_requests_per_sec": round(len(res.http_latency) / elapsed, 1),
+        "http_bytes_per_sec": round(res.http_bytes / elapsed),
+        "http_status": res.http_status,
+        "http_errors": res.http_errors,
+    }
+    if after:
+        lw0 = before["lock_wait"]; lw1 = after["lock_wait"]
+        report["server"] = {
+            "accepted_per_sec": round((after["points_accepted"] - before["points_accepted"]) / elapsed, 1),
+            "dropped_per_sec": round((after["points_dropped"] - before["points_dropped"]) / elapsed, 1),
+            "lines_per_sec": round((after["lines_total"] - before["lines_total"]) / elapsed, 1),
+            "lock_contended": lw1["contended"] - lw0["contended"],
+            "lock_acquired": lw1["acquired"] - lw0["acquired"],
+            "lock_wait_total_ms": round(lw1["wait_total_ms"] - lw0["wait_total_ms"], 3),
+            "lock_wait_max_ms": lw1["wait_max_ms"],
+        }
+    return report
+
+
+def print_report(r):
+    print("-" * 60)
+    print(f"发送: {r['sent_per_sec']} 点/秒  发送错误: {r['send_errors']}")
+    s = r.get("server")
+    if s:
+        print(f"服务器: 接受 {s['accepted_per_sec']} 点/秒  丢弃 {s['dropped_per_sec']} 点/秒  "
+              f"行 {s['lines_per_sec']} /秒")
+        print(f"设备锁: {s['lock_acquired']} 次加锁, {s['lock_contended']} 次等待, "
+              f"累计等待 {s['lock_wait_total_ms']}ms, 最长 {s['lock_wait_max_ms']}ms")
+    print(f"接入延迟（上报 -> /stream 推送）: {fmt_ms(r['ingest_latency'])}")
+    print(f"HTTP /data: {r['http_requests_per_sec']} 请求/秒, {r['http_bytes_per_sec']} 字节/秒, "
+          f"状态 {r['http_status']}, 错误 {r['http_errors']}")
+    print(f"HTTP 响应时间: {fmt_ms(r['http_latency'])}")
+
+
+def spawn_server(args):
+    """在临时目录里启动 success.py（历史库也落在临时目录），返回进程。"""
+    workdir = tempfile.mkdtemp(prefix="loadgen-")
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "success.py")
+    proc = subprocess.Popen([sys.executable, server], cwd=workdir,
+                            stdout=subprocess.DEVNULL if not args.verbose else None,
+                            stderr=subprocess.STDOUT)
+    time.sleep(args.spawn_wait)
+    if proc.poll() is not None:
+        sys.exit("success.py 启动失败（端口被占用？）")
+    return proc
+
+
+def main():
+    parser = argparse.ArgumentParser(description="success.py 本机压测")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--tcp-port", type=int, default=16666)
+    parser.add_argument("--http-port", type=int, default=8000)
+    parser.add_argument("--devices", type=int, default=100, help="模拟设备数")
+    parser.add_argument("--rate", type=float, default=1.0, help="每台设备每秒上报次数")
+    parser.add_argument("--viewers", type=int, default=10, help="模拟观看者数")
+    parser.add_argument("--viewer-interval", type=float, default=2.0, help="观看者轮询间隔（秒）")
+    parser.add_argument("--viewer-mode", choices=("full", "since"), default="full",
+                        help="full: 全量 + If-None-Match；since: 增量游标")
+    parser.add_argument("--gzip", action="store_true", help="观看者请求 gzip")
+    parser.add_argument("--probes", type=int, default=5, help="订阅 /stream 测延迟的设备数")
+    parser.add_argument("--duration", type=float, default=20.0, help="压测时长（秒）")
+    parser.add_argument("--replay", help="回放的 JSON 行文件（ESP32 上报格式）")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--spawn", action="store_true", help="自动在临时目录启动 success.py")
+    parser.add_argument("--spawn-wait", type=float, default=1.5)
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果（便于对比回归）")
+    parser.add_argument("--verbose", action="store_true", help="--spawn 时显示服务器输出")
+    args = parser.parse_args()
+
+    proc = spawn_server(args) if args.spawn else None
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
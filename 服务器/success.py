@@ -1,32 +1,1667 @@
-import socket
+import asyncio
 import threading
 import json
 import time
 from http.server import SimpleHTTPRequestHandler
 from socketserver import TCPServer, ThreadingMixIn
 import math
-from collections import deque
+from collections import deque, OrderedDict
+from array import array
 import traceback
+import sys
+from bisect import bisect_left
+from urllib.parse import urlsplit, parse_qs, unquote
+try:
+    import numpy as np  # 可选：批量坐标转换/距离计算
+except ImportError:
+    np = None
+import gzip
+import os
+import struct
+import queue
+import sqlite3
+import zlib
+import mmap
+import socket
+import multiprocessing
+import tempfile
+import signal
 
 # ================= 配置区域 =================
 TCP_PORT = 16666
 HTTP_PORT = 8000
 ENABLE_CONVERT_TO_GCJ02 = True
 
-TRAIL_MAX = 1000
+TRAIL_MAX = 1000  # 每台设备内存中保留的轨迹点数（按列存储，可放大到 10 万以上）
 STAY_THRESHOLD_METERS = 20  # 停留判断阈值（米）
 # 简化判定参数（按你思路）
 BYPASS_SECONDS = 3600            # 与上次有效点时间间隔超过 1 小时 -> 跳过过滤（秒）
 MAX_JUMP_METERS_SIMPLE = 50000.0 # 跳变阈值：50 公里（米）
+
+# 停留/行程分段（/stays、/trips）
+STAY_RADIUS_METERS = 50     # 在这个半径内持续停留才算一次停留
+STAY_MIN_SECONDS = 180      # 至少停留这么久才记为停留（过滤红绿灯、堵车）
+TRIP_GAP_SECONDS = 900      # 相邻两点间隔超过这么久视为中断，结束当前停留/行程
+SEGMENTS_MAX = 500          # 每台设备保留的已结束停留/行程条数
+
+# 地理围栏（/geofences、/geofence-events）
+GEOFENCE_FILE = "geofences.json"  # 围栏定义的保存文件，空字符串则只保存在内存
+GEOFENCE_CELL_DEG = 0.01          # 网格索引的格子大小（度，约 1 公里）
+GEOFENCE_MAX_CELLS = 10000        # 覆盖格子数超过这个值的大围栏不进网格，每个点都按外接矩形检查
+GEOFENCE_EVENTS_MAX = 10000       # 内存中保留的进出事件条数
+
+# 点过滤：'kalman' 常速度卡尔曼滤波（平滑 + 剔除离群点）；'simple' 只用上面的跳变阈值
+FILTER_MODE = "kalman"
+KALMAN_ACCEL = 3.0          # 过程噪声：加速度标准差（m/s²）
+KALMAN_BASE_SIGMA = 5.0     # 单点定位误差标准差（米），再按卫星数和定位质量缩放
+KALMAN_SPEED_SIGMA = 1.0    # 静止时（上报速度 < 0.5 m/s）“速度为 0”观测的误差标准差（m/s）
+KALMAN_GATE = 13.8          # 新息马氏距离平方阈值（二维卡方 99.9%），超过判为离群点
+KALMAN_MAX_OUTLIERS = 3     # 连续这么多个离群点后认为滤波器跟丢，用新点重新初始化
+
+# TCP 接入参数
+TCP_BACKLOG = 1024          # listen 队列长度（大量 4G 模块同时重连）
+TCP_READ_SIZE = 4096        # 每个连接单次读取的字节数（预分配缓冲区大小）
+TCP_MAX_LINE = 8192         # 单行最大字节数，超过则丢弃该行（防止无换行数据撑爆内存）
+TCP_IDLE_TIMEOUT = 60       # 连接无数据超时（秒）
+FRAME_DEDUP_WINDOW = 1024   # 每台设备记住最近多少个二进制帧，用于丢弃重传的重复帧
+FRAME_MAX_AGE = 7 * 86400   # 帧里的定位时间早于这么久以前视为无效，改用收到的时间
+STATS_WINDOW = 10           # 连接/行速率的统计窗口（秒）
+STATS_PRINT_INTERVAL = 60   # 控制台打印接入统计的间隔（秒），0 关闭
+
+# 指标与诊断（/metrics、/profile）
+DROP_LOG_PER_SEC = 5        # 丢弃点日志每秒最多打印几条，超出的只计数，下次打印时汇总
+PROFILE_INTERVAL = 0.005    # 采样分析器的采样间隔（秒）
+PROFILE_MAX_SECONDS = 300   # 采样分析器开启后最长运行时间，忘记关闭时自动停止
+
+# 实时推送（/stream）参数
+STREAM_QUEUE_MAX = 100      # 每个订阅者最多积压的事件数，超过则丢弃积压并让浏览器重新拉全量
+STREAM_KEEPALIVE = 15       # 无事件时发送心跳注释的间隔（秒）
+
+# /data 全量响应缓存
+GZIP_MIN_BYTES = 1024       # 响应体超过该大小才预先 gzip 压缩
+GZIP_LEVEL = 5
+
+# 轨迹抽稀：/data?zoom=（用预先增量抽稀好的级别）或 /data?tolerance=米（现算 Douglas-Peucker）
+LOD_TOLERANCES = (2, 8, 30, 120, 500, 2000)  # 预计算的各级容差（米），从细到粗
+SIMPLIFY_PIXELS = 1.0       # 允许的偏差（屏幕像素），按缩放级别换算成米
+MAX_ZOOM = 22               # ?zoom= 的取值范围 0..MAX_ZOOM
+
+# 持久化存储（SQLite WAL），STORE_PATH 为空则不保存历史
+STORE_PATH = "track.db"
+STORE_BATCH = 500           # 每次事务最多写入的行数
+STORE_FLUSH_INTERVAL = 1.0  # 攒批最长等待时间（秒）
+STORE_QUEUE_MAX = 100000    # 待写队列上限，磁盘跟不上时丢弃而不是阻塞接入
+STORE_REPLAY_ROWS = 5000    # 启动时每台设备从日志尾部重放的行数
+
+# 历史轨迹瓦片（/tiles/z/x/y），数据来自上面的持久化存储
+TILE_INDEX_ZOOM = 14        # 存储按这一级瓦片的编号（Morton 序）建索引，任意一级瓦片都是一段连续区间
+TILE_MIN_ZOOM = 3
+TILE_MAX_ZOOM = 20
+TILE_EXTENT = 4096          # 瓦片内整数坐标的范围
+TILE_BUFFER = 64            # 裁剪时向瓦片外多留的范围（瓦片内坐标），线条在边界处不被截断
+TILE_CACHE_MAX = 2000       # 渲染好的瓦片 LRU 缓存条数
+
+# 多进程模式：HTTP_WORKERS > 0 时主进程只负责接入（TCP、过滤、围栏、写 SQLite），
+# 另起 HTTP_WORKERS 个进程用 SO_REUSEPORT 共同监听 HTTP_PORT（需要 Linux）；0 为原来的单进程
+HTTP_WORKERS = 0
+RING_SLOTS = 65536          # 进程间共享内存环形缓冲的记录数（每条 512 字节）
+RING_POLL_INTERVAL = 0.01   # HTTP worker 读取环形缓冲的间隔（秒）
+RING_STATS_MAX = 65536      # 共享内存里接入统计快照的最大字节数
 # ===========================================
 
-# 数据结构（全局）
-trail = deque(maxlen=TRAIL_MAX)
-latest = {
-    "lat": 0, "lon": 0, "time": "等待连接...",
-    "sats": 0, "alt": 0, "stay_duration": "0秒", "speed_kmh": 0.0
-}
-lock = threading.Lock()
+# ---------- 轨迹环形缓冲区 ----------
+class TrailBuffer:
+    """
+    按列保存轨迹：每个字段一个 array，只存原始数值，不再为每个点建 dict
+    和预格式化的时间/时长字符串（序列化时再格式化）。每点约 60 字节，
+    TRAIL_MAX 放大到 10 万级也不会吃掉太多内存。
+
+    逻辑下标 0 是最旧的点；点的 seq 连续递增，seq = first_seq + 下标。
+    未满时各列直接 append，满了以后覆盖最旧的位置（head 前移）。
+    """
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.lat = array('d'); self.lon = array('d')
+        self.speed_kmh = array('d'); self.alt = array('d')
+        self.start_ts = array('d'); self.last_ts = array('d')
+        self.sats = array('i')
+        self.ver = array('q')   # 该点最后一次变化时设备的 version
+        self.head = 0           # 最旧点的物理下标
+        self.first_seq = 1      # 最旧点的 seq
+        self.seqs = None        # select() 得到的稀疏副本才有：每个点的 seq
+
+    def columns(self):
+        return (self.lat, self.lon, self.speed_kmh, self.alt,
+                self.start_ts, self.last_ts, self.sats, self.ver)
+
+    def __len__(self):
+        return len(self.lat)
+
+    @property
+    def last_seq(self):
+        return self.first_seq + len(self.lat) - 1
+
+    def pos(self, i):
+        """逻辑下标 -> 物理下标（支持负数下标）。"""
+        n = len(self.lat)
+        if i < 0:
+            i += n
+        return (self.head + i) % n
+
+    def append(self, lat, lon, speed_kmh, alt, sats, ts, ver):
+        """追加一个点，返回它的 seq。"""
+        # 先按各列的类型转换一遍：值放不进某一列时在写入任何一列之前就抛异常，各列长度始终一致
+        d = array('d', (lat, lon, speed_kmh, alt, ts))
+        values = (d[0], d[1], d[2], d[3], d[4], d[4], array('i', (sats,))[0], array('q', (ver,))[0])
+        if len(self.lat) < self.maxlen:
+            for col, v in zip(self.columns(), values):
+                col.append(v)
+        else:
+            h = self.head
+            for col, v in zip(self.columns(), values):
+                col[h] = v
+            self.head = (h + 1) % self.maxlen
+            self.first_seq += 1
+        return self.last_seq
+
+    def touch_last(self, ts, ver):
+        """停留更新：只改末尾点的 last_ts 和 ver。"""
+        p = self.pos(-1)
+        self.last_ts[p] = ts
+        self.ver[p] = ver
+
+    def index_since(self, since):
+        """第一个 ver > since 的逻辑下标。只有末尾点会被更新，ver 单调递增，从尾部倒查。"""
+        i = len(self.lat)
+        ver = self.ver
+        while i > 0 and ver[self.pos(i - 1)] > since:
+            i -= 1
+        return i
+
+    def copy(self, start=0):
+        """复制逻辑区间 [start, len) 为一个不环绕的新缓冲区（整列内存拷贝，持锁时间很短）。"""
+        n = len(self.lat)
+        out = TrailBuffer(max(n - start, 1))
+        out.first_seq = self.first_seq + start
+        a = self.head + start
+        for src, dst in zip(self.columns(), out.columns()):
+            if a >= n and n:
+                dst.extend(src[a - n:self.head])
+            else:
+                dst.extend(src[a:])
+                dst.extend(src[:self.head])
+        return out
+
+    def select(self, seqs):
+        """按 seq 挑出部分点（升序），得到一个稀疏副本。"""
+        out = TrailBuffer(max(len(seqs), 1))
+        out.seqs = []
+        first = self.first_seq; n = len(self.lat)
+        for seq in seqs:
+            i = seq - first
+            if 0 <= i < n:
+                p = (self.head + i) % n
+                for src, dst in zip(self.columns(), out.columns()):
+                    dst.append(src[p])
+                out.seqs.append(seq)
+        return out
+
+    def to_json(self):
+        """直接从各列拼出 JSON 数组（copy()/select() 得到的缓冲区不环绕，按顺序遍历即可）。"""
+        parts = []
+        strftime = time.strftime; localtime = time.localtime
+        seqs = self.seqs if self.seqs is not None else range(self.first_seq, self.first_seq + len(self.lat))
+        for seq, lat, lon, speed_kmh, alt, start_ts, last_ts, sats, ver in zip(
+                seqs, self.lat, self.lon, self.speed_kmh, self.alt,
+                self.start_ts, self.last_ts, self.sats, self.ver):
+            parts.append(
+                '{"seq":%d,"ver":%d,"lat":%r,"lon":%r,"speed_kmh":%r,"alt":%r,"sats":%d,'
+                '"start_ts":%r,"last_ts":%r,"time_str":"%s","duration_str":"%s"}' % (
+                    seq, ver, lat, lon, speed_kmh, alt, sats, start_ts, last_ts,
+                    strftime("%H:%M:%S", localtime(start_ts)),
+                    "0秒" if last_ts == start_ts else format_duration(last_ts - start_ts)))
+        return '[' + ','.join(parts) + ']'
+
+# ---------- 轨迹抽稀（按缩放级别的多级细节） ----------
+def project_meters(lat, lon, coslat):
+    """经纬度 -> 近似平面米坐标（等距圆柱投影，coslat 取轨迹参考纬度的余弦）。"""
+    return lon * 111320.0 * coslat, lat * 110574.0
+
+def zoom_tolerance(zoom, lat):
+    """地图缩放级别下 SIMPLIFY_PIXELS 个像素对应的地面距离（米）。"""
+    return SIMPLIFY_PIXELS * 156543.03392 * math.cos(math.radians(lat)) / (2 ** zoom)
+
+def douglas_peucker(xs, ys, tolerance):
+    """Douglas-Peucker 抽稀，返回保留点的下标（升序）。用显式栈，避免长轨迹递归过深。"""
+    n = len(xs)
+    if n <= 2:
+        return list(range(n))
+    keep = bytearray(n)
+    keep[0] = keep[n - 1] = 1
+    stack = [(0, n - 1)]
+    tol2 = tolerance * tolerance
+    while stack:
+        first, last = stack.pop()
+        x0, y0 = xs[first], ys[first]
+        dx, dy = xs[last] - x0, ys[last] - y0
+        seg2 = dx * dx + dy * dy
+        best = -1.0; idx = -1
+        for i in range(first + 1, last):
+            px, py = xs[i] - x0, ys[i] - y0
+            if seg2 > 0:
+                cross = px * dy - py * dx
+                d2 = cross * cross / seg2
+            else:
+                d2 = px * px + py * py
+            if d2 > best:
+                best = d2; idx = i
+        if best > tol2:
+            keep[idx] = 1
+            stack.append((first, idx))
+            stack.append((idx, last))
+    return [i for i in range(n) if keep[i]]
+
+class LodLevel:
+    """
+    某一容差下的增量抽稀结果（锥形/楔形相交法，每个新点 O(1)）。
+    从锚点出发维护一个方向区间：区间内任意方向的射线到之后每个点的距离
+    都不超过容差；新点落在区间外时，上一个点成为新的锚点。楔形只管横向偏差，
+    另外记下这一段离锚点最远的距离，新点往回退超过容差（原路折返）也另起锚点。
+    kept 保存已固定的锚点 seq，输出时再加上当前最后一个点。
+    """
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.kept = deque()
+        self.anchor = None   # (x, y)
+        self.lo = self.hi = None
+        self.max_d = 0.0     # 这一段里离锚点最远的距离
+        self.prev = None     # (seq, x, y)
+
+    def add(self, seq, x, y):
+        if self.anchor is None:
+            self._set_anchor(seq, x, y)
+        elif not self._fits(x, y):
+            # 超出楔形：上一个点固定下来作为新锚点，再从它重新约束新点
+            pseq, px, py = self.prev
+            self._set_anchor(pseq, px, py)
+            self._fits(x, y)
+        self.prev = (seq, x, y)
+
+    def _set_anchor(self, seq, x, y):
+        self.kept.append(seq)
+        self.anchor = (x, y)
+        self.lo = self.hi = None
+        self.max_d = 0.0
+
+    def _fits(self, x, y):
+        ax, ay = self.anchor
+        dx = x - ax; dy = y - ay
+        d = math.hypot(dx, dy)
+        if d < self.max_d - self.tolerance:
+            return False
+        if d <= self.tolerance:
+            self.max_d = max(self.max_d, d)
+            return True
+        theta = math.atan2(dy, dx)
+        alpha = math.asin(self.tolerance / d)
+        if self.lo is None:
+            self.lo, self.hi = theta - alpha, theta + alpha
+            self.max_d = d
+            return True
+        mid = (self.lo + self.hi) / 2
+        theta = mid + (theta - mid + math.pi) % (2 * math.pi) - math.pi  # 处理角度回绕
+        if not (self.lo <= theta <= self.hi):
+            return False
+        self.lo = max(self.lo, theta - alpha)
+        self.hi = min(self.hi, theta + alpha)
+        self.max_d = max(self.max_d, d)
+        return True
+
+    def prune(self, first_seq):
+        """丢掉已经被环形缓冲区淘汰的点。"""
+        kept = self.kept
+        while kept and kept[0] < first_seq:
+            kept.popleft()
+
+    def seqs(self):
+        out = list(self.kept)
+        if self.prev is not None and (not out or out[-1] != self.prev[0]):
+            out.append(self.prev[0])
+        return out
+
+# ---------- 停留/行程分段 ----------
+class _Span:
+    """一段连续点的统计：起止点、点数、距离、最高速度、坐标和（停留取平均位置）。"""
+
+    __slots__ = ("start_lat", "start_lon", "start_ts", "end_lat", "end_lon", "end_ts",
+                 "points", "distance", "max_speed", "sum_lat", "sum_lon", "entry_step", "is_stay")
+
+    def __init__(self, lat, lon, speed_kmh, ts, entry_step=0.0):
+        self.start_lat = self.end_lat = self.sum_lat = lat
+        self.start_lon = self.end_lon = self.sum_lon = lon
+        self.start_ts = self.end_ts = ts
+        self.points = 1
+        self.distance = 0.0
+        self.max_speed = speed_kmh
+        self.entry_step = entry_step  # 从前一个点到本段第一个点的距离
+        self.is_stay = False
+
+    def add(self, lat, lon, speed_kmh, ts, step):
+        self.end_lat = lat; self.end_lon = lon; self.end_ts = ts
+        self.points += 1
+        self.distance += step
+        self.sum_lat += lat; self.sum_lon += lon
+        if speed_kmh > self.max_speed:
+            self.max_speed = speed_kmh
+
+    def copy(self):
+        span = _Span.__new__(_Span)
+        for k in _Span.__slots__:
+            setattr(span, k, getattr(self, k))
+        return span
+
+    def merge(self, other):
+        """把紧接在后面的一段并入本段。"""
+        self.end_lat = other.end_lat; self.end_lon = other.end_lon; self.end_ts = other.end_ts
+        self.points += other.points
+        self.distance += other.entry_step + other.distance
+        self.sum_lat += other.sum_lat; self.sum_lon += other.sum_lon
+        if other.max_speed > self.max_speed:
+            self.max_speed = other.max_speed
+
+    def stay_record(self, seg_id, ongoing):
+        duration = self.end_ts - self.start_ts
+        return {"id": seg_id, "start_ts": self.start_ts, "end_ts": self.end_ts,
+                "duration": round(duration, 1), "duration_str": format_duration(duration),
+                "lat": round(self.sum_lat / self.points, 6), "lon": round(self.sum_lon / self.points, 6),
+                "points": self.points, "ongoing": ongoing}
+
+    def trip_record(self, seg_id, ongoing):
+        duration = self.end_ts - self.start_ts
+        return {"id": seg_id, "start_ts": self.start_ts, "end_ts": self.end_ts,
+                "duration": round(duration, 1), "duration_str": format_duration(duration),
+                "distance_m": round(self.distance, 1),
+                "max_speed_kmh": round(self.max_speed, 2),
+                "avg_speed_kmh": round(self.distance / duration * 3.6, 2) if duration > 0 else 0.0,
+                "start_lat": round(self.start_lat, 6), "start_lon": round(self.start_lon, 6),
+                "end_lat": round(self.end_lat, 6), "end_lon": round(self.end_lon, 6),
+                "points": self.points, "ongoing": ongoing}
+
+class Segmenter:
+    """
+    把一台设备的点流增量切分成停留和行程，每点 O(1)。
+    以候选停留的第一个点为锚点，后续点都在 STAY_RADIUS_METERS 内就延长候选；候选持续满
+    STAY_MIN_SECONDS 即成为停留，同时结束之前的行程（行程终点取停留的锚点）。
+    有点离开半径时：候选已是停留则结束停留、从停留的最后一个点开始新行程；
+    否则候选里的点并入当前行程。已结束的记录各保留最近 SEGMENTS_MAX 条。
+    调用方持有设备锁。
+    """
+
+    def __init__(self):
+        self.stays = deque(maxlen=SEGMENTS_MAX)
+        self.trips = deque(maxlen=SEGMENTS_MAX)
+        self.next_id = 1
+        self.cand = None   # 候选停留（或已确认、尚未结束的停留）
+        self.trip = None   # 当前行程中候选停留之前的部分
+        self.last = None   # 上一个点 (lat, lon, ts)
+
+    def _take_id(self):
+        seg_id = self.next_id
+        self.next_id += 1
+        return seg_id
+
+    def _finish_trip(self):
+        if self.trip is not None and self.trip.points > 1:
+            self.trips.append(self.trip.trip_record(self._take_id(), False))
+        self.trip = None
+
+    def add(self, lat, lon, speed_kmh, ts):
+        last = self.last
+        if last is not None and ts - last[2] > TRIP_GAP_SECONDS:
+            self.close()
+            last = None
+        step = haversine(last[0], last[1], lat, lon) if last is not None else 0.0
+        self.last = (lat, lon, ts)
+        cand = self.cand
+        if cand is None:
+            self.cand = _Span(lat, lon, speed_kmh, ts, step)
+            return
+        if haversine(cand.start_lat, cand.start_lon, lat, lon) <= STAY_RADIUS_METERS:
+            cand.add(lat, lon, speed_kmh, ts, step)
+            if not cand.is_stay and cand.end_ts - cand.start_ts >= STAY_MIN_SECONDS:
+                cand.is_stay = True
+                if self.trip is not None:
+                    # 行程到停留的锚点为止
+                    trip = self.trip
+                    trip.end_lat = cand.start_lat; trip.end_lon = cand.start_lon; trip.end_ts = cand.start_ts
+                    trip.points += 1
+                    trip.distance += cand.entry_step
+                    self._finish_trip()
+            return
+        # 离开了候选停留的半径
+        if cand.is_stay:
+            self.stays.append(cand.stay_record(self._take_id(), False))
+            self.trip = _Span(cand.end_lat, cand.end_lon, 0.0, cand.end_ts)
+            self.trip.max_speed = speed_kmh
+        elif self.trip is None:
+            self.trip = cand
+        else:
+            self.trip.merge(cand)
+        self.cand = _Span(lat, lon, speed_kmh, ts, step)
+
+    def close(self):
+        """数据中断：按最后一个点结束当前的停留和行程。"""
+        cand = self.cand
+        if cand is not None:
+            if cand.is_stay:
+                self.stays.append(cand.stay_record(self._take_id(), False))
+                self._finish_trip()
+            else:
+                if self.trip is None:
+                    self.trip = cand
+                else:
+                    self.trip.merge(cand)
+                self._finish_trip()
+        self.cand = None
+        self.trip = None
+        self.last = None
+
+    def current_stay(self):
+        cand = self.cand
+        return cand.stay_record(self.next_id, True) if cand is not None and cand.is_stay else None
+
+    def current_trip(self):
+        cand = self.cand
+        if cand is None or cand.is_stay:
+            return None
+        if self.trip is None:
+            trip = cand
+        else:
+            trip = self.trip.copy()
+            trip.merge(cand)
+        return trip.trip_record(self.next_id, True) if trip.points > 1 else None
+
+    def records(self, kind, start=None, end=None, limit=50):
+        """按时间顺序返回最近 limit 条停留或行程（含进行中的），可按时间范围过滤。"""
+        out = list(self.stays if kind == "stays" else self.trips)
+        cur = self.current_stay() if kind == "stays" else self.current_trip()
+        if cur is not None:
+            out.append(cur)
+        if start is not None:
+            out = [r for r in out if r["end_ts"] >= start]
+        if end is not None:
+            out = [r for r in out if r["start_ts"] <= end]
+        return out[-limit:] if limit > 0 else []
+
+# ---------- 地理围栏 ----------
+def _fence_coord(value, limit, name):
+    """围栏坐标转成 float 并检查范围；NaN 的比较结果总是 False，也在这里被拒绝。"""
+    v = float(value)
+    if not -limit <= v <= limit:
+        raise ValueError(f"{name} out of range: {value!r}")
+    return v
+
+class Fence:
+    """
+    一个围栏：圆形 {"type": "circle", "lat", "lon", "radius"(米)}
+    或多边形 {"type": "polygon", "points": [[lat, lon], ...]}。
+    坐标与轨迹相同（开启 ENABLE_CONVERT_TO_GCJ02 时为 GCJ-02，即地图上看到的坐标）。
+    """
+
+    def __init__(self, fence_id, spec):
+        self.id = fence_id
+        self.name = str(spec.get("name", fence_id))
+        self.type = spec.get("type")
+        if self.type == "circle":
+            self.lat = _fence_coord(spec["lat"], 90.0, "lat")
+            self.lon = _fence_coord(spec["lon"], 180.0, "lon")
+            self.radius = float(spec["radius"])
+            if not (math.isfinite(self.radius) and self.radius > 0):
+                raise ValueError("radius must be a positive finite number")
+            self.coslat = math.cos(math.radians(self.lat))
+            dlat = self.radius / 110540.0
+            dlon = self.radius / (111320.0 * max(self.coslat, 1e-6))
+            self.bbox = (self.lat - dlat, self.lon - dlon, self.lat + dlat, self.lon + dlon)
+        elif self.type == "polygon":
+            pts = [(_fence_coord(p[0], 90.0, "lat"), _fence_coord(p[1], 180.0, "lon"))
+                   for p in spec["points"]]
+            if len(pts) < 3:
+                raise ValueError("polygon needs at least 3 points")
+            self.lats = [p[0] for p in pts]; self.lons = [p[1] for p in pts]
+            self.bbox = (min(self.lats), min(self.lons), max(self.lats), max(self.lons))
+        else:
+            raise ValueError("type must be 'circle' or 'polygon'")
+
+    def contains(self, lat, lon):
+        b = self.bbox
+        if not (b[0] <= lat <= b[2] and b[1] <= lon <= b[3]):
+            return False
+        if self.type == "circle":
+            y = (lat - self.lat) * 110540.0
+            x = (lon - self.lon) * 111320.0 * self.coslat
+            return x * x + y * y <= self.radius * self.radius
+        # 射线法
+        lats = self.lats; lons = self.lons
+        inside = False
+        j = len(lats) - 1
+        for i in range(len(lats)):
+            if (lats[i] > lat) != (lats[j] > lat) and \
+                    lon < (lons[j] - lons[i]) * (lat - lats[i]) / (lats[j] - lats[i]) + lons[i]:
+                inside = not inside
+            j = i
+        return inside
+
+    def to_dict(self):
+        d = {"id": self.id, "name": self.name, "type": self.type}
+        if self.type == "circle":
+            d.update(lat=self.lat, lon=self.lon, radius=self.radius)
+        else:
+            d["points"] = [[a, b] for a, b in zip(self.lats, self.lons)]
+        return d
+
+class GeofenceEngine:
+    """
+    围栏索引与进出判定。围栏按外接矩形登记到 GEOFENCE_CELL_DEG 大小的网格里，每个点
+    只检查所在格子里的围栏，耗时与围栏总数无关（只与附近围栏的密度有关）。
+    每台设备记住当前所在的围栏集合，前后比较产生 enter/exit 事件，事件带递增的 seq，
+    /geofence-events 用 seq 作为游标增量拉取。
+    增删改来自 HTTP 线程、判定来自 ingest 线程，由 self.lock 保护。
+    """
+
+    def __init__(self, cell=GEOFENCE_CELL_DEG):
+        self.cell = cell
+        self.lock = threading.Lock()
+        self.fences = {}      # id -> Fence
+        self.grid = {}        # (格子行, 格子列) -> [fence id, ...]
+        self.large = set()    # 覆盖格子过多、不进网格的围栏 id
+        self.inside = {}      # 设备 id -> 当前所在的围栏 id 集合
+        self.events = deque(maxlen=GEOFENCE_EVENTS_MAX)
+        self.event_seq = 0
+        self.next_id = 1
+
+    def _cells(self, bbox):
+        c = self.cell
+        r0, c0 = math.floor(bbox[0] / c), math.floor(bbox[1] / c)
+        r1, c1 = math.floor(bbox[2] / c), math.floor(bbox[3] / c)
+        if (r1 - r0 + 1) * (c1 - c0 + 1) > GEOFENCE_MAX_CELLS:
+            return None
+        return [(r, col) for r in range(r0, r1 + 1) for col in range(c0, c1 + 1)]
+
+    def _insert(self, fence):
+        """
+        登记（或替换）一个围栏，调用方持有 self.lock。
+        先算好要登记的格子再改动 fences 和网格，出错时两者都保持原样。
+        """
+        cells = self._cells(fence.bbox)
+        old = self.fences.get(fence.id)
+        if old is not None:
+            self._unindex(old)
+        self.fences[fence.id] = fence
+        if cells is None:
+            self.large.add(fence.id)
+            return
+        for key in cells:
+            self.grid.setdefault(key, []).append(fence.id)
+
+    def _unindex(self, fence):
+        if fence.id in self.large:
+            self.large.discard(fence.id)
+            return
+        for key in self._cells(fence.bbox):
+            ids = self.grid.get(key)
+            if ids is not None:
+                ids.remove(fence.id)
+                if not ids:
+                    del self.grid[key]
+
+    def put(self, spec, fence_id=None):
+        """新建或替换一个围栏，返回 Fence；参数不合法时抛 ValueError/KeyError/TypeError。"""
+        with self.lock:
+            if fence_id is None:
+                fence_id = str(spec.get("id") or "")
+            if not fence_id:
+                while str(self.next_id) in self.fences:
+                    self.next_id += 1
+                fence_id = str(self.next_id)
+            fence = Fence(fence_id, spec)
+            self._insert(fence)
+            return fence
+
+    def delete(self, fence_id):
+        with self.lock:
+            fence = self.fences.pop(fence_id, None)
+            if fence is None:
+                return False
+            self._unindex(fence)
+            # 删除的围栏不再产生 exit 事件
+            for ids in self.inside.values():
+                ids.discard(fence_id)
+            return True
+
+    def get(self, fence_id):
+        with self.lock:
+            fence = self.fences.get(fence_id)
+            return fence.to_dict() if fence is not None else None
+
+    def list(self):
+        with self.lock:
+            return [f.to_dict() for f in self.fences.values()]
+
+    def evaluate(self, device_id, lat, lon, ts):
+        """用一个被接受的点更新设备的进出状态，返回本次产生的事件列表。"""
+        c = self.cell
+        with self.lock:
+            if not self.fences:
+                return []
+            fences = self.fences
+            now_in = set()
+            for fid in self.grid.get((math.floor(lat / c), math.floor(lon / c)), ()):
+                if fences[fid].contains(lat, lon):
+                    now_in.add(fid)
+            for fid in self.large:
+                if fences[fid].contains(lat, lon):
+                    now_in.add(fid)
+            before = self.inside.get(device_id)
+            if before is None:
+                before = set()
+            if now_in == before:
+                return []
+            out = []
+            for kind, ids in (("exit", before - now_in), ("enter", now_in - before)):
+                for fid in ids:
+                    self.event_seq += 1
+                    ev = {"seq": self.event_seq, "type": kind, "device": device_id, "fence": fid,
+                          "name": fences[fid].name, "ts": ts, "lat": lat, "lon": lon}
+                    self.events.append(ev)
+                    out.append(ev)
+            if now_in:
+                self.inside[device_id] = now_in
+            else:
+                self.inside.pop(device_id, None)
+            return out
+
+    def events_since(self, since=0, device_id=None, limit=1000):
+        """seq 大于 since 的事件（按时间顺序，最多 limit 条，至少 1 条）和新的游标。"""
+        limit = max(limit, 1)
+        with self.lock:
+            cursor = self.event_seq
+            events = self.events
+            if events and since >= events[0]["seq"]:
+                # seq 连续递增，直接跳到游标之后
+                start = since - events[0]["seq"] + 1
+                selected = [events[i] for i in range(start, len(events))]
+            else:
+                selected = list(events)
+        if device_id is not None:
+            selected = [e for e in selected if e["device"] == device_id]
+        if len(selected) > limit:
+            selected = selected[:limit]
+            cursor = selected[-1]["seq"]
+        return cursor, selected
+
+    def save(self, path):
+        """把围栏定义写到 JSON 文件（先写临时文件再替换）。"""
+        data = self.list()
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _read(path):
+        """读取围栏文件，返回 Fence 列表；不合法的条目打印出来后跳过，不影响启动。"""
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return []
+        fences = []
+        for spec in data:
+            try:
+                fences.append(Fence(str(spec["id"]), spec))
+            except (ValueError, KeyError, TypeError, IndexError, AttributeError) as e:
+                print(f"跳过不合法的围栏 {str(spec)[:100]}：{e}")
+        return fences
+
+    def load(self, path):
+        fences = self._read(path)
+        with self.lock:
+            for fence in fences:
+                self._insert(fence)
+        return len(fences)
+
+    def reload(self, path):
+        """
+        重新读取围栏文件并整体替换（多进程模式下文件可能被别的进程改写），返回围栏数。
+        新索引建好后在锁内一次换上，判定线程不会看到只加载了一半的围栏。
+        """
+        fences = self._read(path)
+        with self.lock:
+            self.fences = {}; self.grid = {}; self.large = set()
+            for fence in fences:
+                self._insert(fence)
+            for ids in self.inside.values():
+                ids.intersection_update(self.fences)
+        return len(fences)
+
+    def add_event(self, ev):
+        """加入别的进程产生的事件（HTTP worker 从环形缓冲收到）；seq 不连续时丢掉旧事件。"""
+        with self.lock:
+            if ev["seq"] != self.event_seq + 1:
+                self.events.clear()
+            self.events.append(ev)
+            self.event_seq = ev["seq"]
+
+geofences = GeofenceEngine()
+
+# ---------- 指标与诊断 ----------
+# 时间类直方图的桶上限（秒）和字节数直方图的桶上限
+LATENCY_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+class Histogram:
+    """
+    Prometheus 风格的直方图：固定桶上限，observe 只做一次二分查找和两次加法。
+    和其他统计计数一样不加锁，多线程同时 observe 偶尔少记一次可以接受。
+    """
+
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels=""):
+        """Prometheus 文本格式的 _bucket/_sum/_count 行。"""
+        sep = "," if labels else ""
+        out = []
+        acc = 0
+        for le, n in zip(self.buckets, self.counts):
+            acc += n
+            out.append(f'{name}_bucket{{{labels}{sep}le="{le:g}"}} {acc}')
+        acc += self.counts[-1]
+        out.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {acc}')
+        lb = f"{{{labels}}}" if labels else ""
+        out.append(f"{name}_sum{lb} {self.sum:.6g}")
+        out.append(f"{name}_count{lb} {acc}")
+        return out
+
+# /data 的编码耗时与响应大小，按 kind 区分：full（全量，按版本缓存，只在变化后编码一次）/ since（增量）
+data_encode_seconds = {"full": Histogram(), "since": Histogram()}
+data_response_bytes = {"full": Histogram(SIZE_BUCKETS), "since": Histogram(SIZE_BUCKETS)}
+
+class HttpStats:
+    """HTTP 侧计数：当前处理中的连接数、累计请求数。"""
+
+    def __init__(self):
+        self.active = 0
+        self.connections = 0
+
+http_stats = HttpStats()
+
+class RateLimitedLog:
+    """
+    结构化（一行一个 JSON）且限速的日志：每秒最多 per_sec 条，超出的只计数，
+    下一条能打印时附带 suppressed 汇总，避免大量丢点时控制台 I/O 拖慢接入。
+    """
+
+    def __init__(self, per_sec):
+        self.per_sec = per_sec
+        self.window = 0
+        self.sent = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        now = int(time.time())
+        with self.lock:
+            if now != self.window:
+                self.window = now
+                self.sent = 0
+            if self.sent >= self.per_sec:
+                self.suppressed += 1
+                return
+            self.sent += 1
+            record = {"ts": round(time.time(), 3), "event": event}
+            record.update(fields)
+            if self.suppressed:
+                record["suppressed"] = self.suppressed
+                self.suppressed = 0
+        print(json.dumps(record, ensure_ascii=False))
+
+drop_log = RateLimitedLog(DROP_LOG_PER_SEC)
+
+class SamplingProfiler:
+    """
+    采样式性能分析：开启后后台线程每 PROFILE_INTERVAL 秒抓一次所有线程的调用栈，
+    统计各函数作为栈顶（自身耗时）和出现在栈中（含子调用）的次数。不开启时没有任何开销；
+    运行中随时可以取报告，不需要重启服务器。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = False
+        self.started = 0.0
+        self.samples = 0
+        self.self_counts = {}
+        self.total_counts = {}
+        self.thread_counts = {}
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+            self.started = time.time()
+            self.samples = 0
+            self.self_counts = {}; self.total_counts = {}; self.thread_counts = {}
+        threading.Thread(target=self._run, name="profiler", daemon=True).start()
+        return True
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        me = threading.get_ident()
+        while self.running and time.time() - self.started < PROFILE_MAX_SECONDS:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+            with self.lock:
+                self.samples += 1
+                for tid, frame in frames.items():
+                    if tid == me:
+                        continue
+                    tname = names.get(tid, str(tid))
+                    code = frame.f_code
+                    key = (code.co_filename.rsplit("/", 1)[-1], code.co_name, frame.f_lineno)
+                    self.self_counts[key] = self.self_counts.get(key, 0) + 1
+                    self.thread_counts[tname] = self.thread_counts.get(tname, 0) + 1
+                    seen = set()
+                    while frame is not None:
+                        code = frame.f_code
+                        if code not in seen:
+                            seen.add(code)
+                            fkey = (code.co_filename.rsplit("/", 1)[-1], code.co_name, code.co_firstlineno)
+                            self.total_counts[fkey] = self.total_counts.get(fkey, 0) + 1
+                        frame = frame.f_back
+            time.sleep(PROFILE_INTERVAL)
+        self.running = False
+
+    def report(self, top=30):
+        with self.lock:
+            samples = self.samples
+            self_counts = sorted(self.self_counts.items(), key=lambda kv: -kv[1])[:top]
+            total_counts = sorted(self.total_counts.items(), key=lambda kv: -kv[1])[:top]
+            threads = sorted(self.thread_counts.items(), key=lambda kv: -kv[1])
+        lines = [f"采样分析：{'运行中' if self.running else '已停止'}，{samples} 次采样，"
+                 f"间隔 {PROFILE_INTERVAL * 1000:g} ms", "", "各线程样本数："]
+        lines += [f"  {n:8d}  {name}" for name, n in threads]
+        lines += ["", "栈顶（自身耗时，按行）：", "  样本数   占比  位置"]
+        lines += [f"  {n:6d}  {n * 100.0 / max(samples, 1):5.1f}%  {f}:{ln} {fn}"
+                  for (f, fn, ln), n in self_counts]
+        lines += ["", "在栈中（含子调用，按函数）：", "  样本数   占比  函数"]
+        lines += [f"  {n:6d}  {n * 100.0 / max(samples, 1):5.1f}%  {f}:{ln} {fn}"
+                  for (f, fn, ln), n in total_counts]
+        return "\n".join(lines) + "\n"
+
+profiler = SamplingProfiler()
+
+# ---------- 锁等待统计 ----------
+class LockStats:
+    """设备锁的竞争情况：等待次数、累计/最大等待时间，以及等待/持有时间分布。"""
+
+    def __init__(self):
+        self.acquired = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait = Histogram()   # 只记录发生竞争时的等待
+        self.hold = Histogram()
+
+    def snapshot(self):
+        return {
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "wait_total_ms": round(self.wait_total * 1000, 3),
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+        }
+
+lock_stats = LockStats()
+
+class TimedLock:
+    """带等待/持有时间统计的锁；无竞争时只多一次非阻塞 acquire，等待不计时。"""
+
+    __slots__ = ("_lock", "_held_at")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._held_at = 0.0
+
+    def __enter__(self):
+        lock_stats.acquired += 1
+        if not self._lock.acquire(False):
+            t0 = time.perf_counter()
+            self._lock.acquire()
+            waited = time.perf_counter() - t0
+            lock_stats.contended += 1
+            lock_stats.wait_total += waited
+            lock_stats.wait.observe(waited)
+            if waited > lock_stats.wait_max:
+                lock_stats.wait_max = waited
+        self._held_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        lock_stats.hold.observe(time.perf_counter() - self._held_at)
+        self._lock.release()
+
+# ---------- 设备注册表 ----------
+BOOT_ID = int(time.time())  # 放进 ETag，服务器重启后旧的 ETag 全部失效
+# 游标的高位：单进程为 0（游标就是 version）；多进程模式下接入进程启动时取一个随机值，
+# 所有 HTTP worker 共用（version 也由接入进程统一编号），重启前的游标按全量（reset）处理
+CURSOR_EPOCH = 0
+
+def cursor_out(version):
+    """设备 version -> 返回给客户端的游标。"""
+    return (CURSOR_EPOCH << 32) | version
+
+def cursor_in(since):
+    """客户端游标 -> version；不是本次启动发出的游标返回 0（全量）。"""
+    if since < 0 or since >> 32 != CURSOR_EPOCH:
+        return 0
+    return since & 0xffffffff
+
+class Device:
+    """单个定位器的状态：独立的轨迹、最新位置和锁，设备之间互不影响。"""
+
+    def __init__(self, device_id):
+        self.id = device_id
+        self.trail = TrailBuffer(TRAIL_MAX)
+        self.latest = {
+            "lat": 0, "lon": 0, "time": "等待连接...",
+            "sats": 0, "alt": 0, "stay_duration": "0秒", "speed_kmh": 0.0
+        }
+        self.lock = TimedLock()
+        self.updated = 0.0  # 最近一次收到上报的时间
+        # version：每次新增点或停留更新 +1。每个点记录自己最后一次变化时的 ver，
+        # 客户端用 version 作为增量游标（点的 seq 由 TrailBuffer 维护）。
+        # 多进程模式下 version 由接入进程编号，随共享内存记录带给各 HTTP worker；
+        # cursor_floor 之前的游标在本进程对不上（从 SQLite 恢复的部分），按全量处理。
+        self.version = 0
+        self.cursor_floor = 0
+        self.ring_synced = False
+        # 全量 /data 响应的缓存：variant -> (version, etag, body, gzip_body)，按 version 失效
+        # variant 为 None（完整轨迹）或抽稀参数
+        self.cache = {}
+        self.encode_lock = threading.Lock()
+        # 各级预先抽稀的轨迹，随新点增量维护；stay_seqs 记录成为停留点的 seq（抽稀时总是保留）
+        self.lod = [LodLevel(t) for t in LOD_TOLERANCES]
+        self.stay_seqs = deque()
+        self.coslat = None  # 平面投影的参考纬度余弦，取第一个点
+        # 最近处理过的二进制帧（按 CRC 去重），设备没收到确认而重传时不会重复入库
+        self.recent_frames = set()
+        self.recent_frames_order = deque()
+        # 停留/行程分段，随 add_point 增量更新
+        self.segments = Segmenter()
+        # 点过滤器（FILTER_MODE 选择），只在 ingest 线程使用
+        self.filter = FILTERS[FILTER_MODE]()
+
+    def remember_frame(self, crc):
+        """记录一帧；已经见过则返回 False。只在 ingest 线程调用。"""
+        if crc in self.recent_frames:
+            return False
+        self.recent_frames.add(crc)
+        self.recent_frames_order.append(crc)
+        if len(self.recent_frames_order) > FRAME_DEDUP_WINDOW:
+            self.recent_frames.discard(self.recent_frames_order.popleft())
+        return True
+
+    def last_point(self):
+        """(lat, lon, last_ts) 或 None，调用方持有 self.lock。"""
+        trail = self.trail
+        if len(trail) == 0:
+            return None
+        p = trail.pos(-1)
+        return trail.lat[p], trail.lon[p], trail.last_ts[p]
+
+    def add_point(self, lat, lon, speed_kmh, alt, sats, ts, extra=None, version=None):
+        """
+        加入一个已通过过滤的点（保留停留判定逻辑），返回新的 version。
+        version 为接入进程给出的编号（多进程模式的 HTTP worker），否则本地 +1。
+        """
+        trail = self.trail; latest = self.latest
+        with self.lock:
+            self.updated = max(self.updated, ts)
+            self.version = self.version + 1 if version is None else version
+            is_staying = False
+            last = self.last_point()
+            if last is not None and haversine(last[0], last[1], lat, lon) < STAY_THRESHOLD_METERS:
+                is_staying = True
+                p = trail.pos(-1)
+                if trail.last_ts[p] == trail.start_ts[p]:
+                    self.stay_seqs.append(trail.last_seq)
+                trail.touch_last(ts, self.version)
+                latest['stay_duration'] = format_duration(ts - trail.start_ts[trail.pos(-1)])
+
+            if not is_staying:
+                seq = trail.append(lat, lon, speed_kmh, alt, sats, ts, self.version)
+                latest['stay_duration'] = "移动中"
+                if self.coslat is None:
+                    self.coslat = math.cos(math.radians(lat))
+                x, y = project_meters(lat, lon, self.coslat)
+                first_seq = trail.first_seq
+                for level in self.lod:
+                    level.add(seq, x, y)
+                    level.prune(first_seq)
+                while self.stay_seqs and self.stay_seqs[0] < first_seq:
+                    self.stay_seqs.popleft()
+
+            self.segments.add(lat, lon, speed_kmh, ts)
+
+            # 更新 latest（只在点被接受时更新经纬等）
+            if extra:
+                latest.update(extra)
+            latest['lat'] = lat; latest['lon'] = lon; latest['alt'] = alt; latest['sats'] = sats
+            latest['time'] = time.strftime("%H:%M:%S", time.localtime(ts))
+            latest['speed_kmh'] = round(speed_kmh, 2)
+            return self.version
+
+    def adopt_version(self, version):
+        """
+        HTTP worker：从 SQLite 恢复的状态对应接入进程的 version，此后按它编号。
+        恢复出来的点都算作不晚于 version，更早的游标在本进程对不上，按全量处理。
+        """
+        with self.lock:
+            ver = self.trail.ver
+            for i in range(len(ver)):
+                if ver[i] > version:
+                    ver[i] = version
+            self.version = self.cursor_floor = version
+            self.cache = {}
+            self.ring_synced = True
+
+    def valid_cursor(self, since):
+        """since 能否做增量（不是全量 reset）。"""
+        return 0 < since <= self.version and since >= self.cursor_floor
+
+    def snapshot_json(self, since=0, lod=None):
+        """
+        /data 响应体（bytes）；since 合法时为增量，否则为全量（reset）。
+        lod 为 ('zoom', 级别下标) 或 ('tolerance', 米) 时返回抽稀后的全量轨迹。
+        持锁只做整列拷贝，格式化和编码都在锁外。
+        """
+        with self.lock:
+            version = self.version
+            reset = not self.valid_cursor(since) or lod is not None
+            head = {"device": self.id, "cursor": cursor_out(version), "reset": reset,
+                    "latest": dict(self.latest)}
+            total = len(self.trail)
+            if lod is not None and lod[0] == 'zoom':
+                level = self.lod[lod[1]]
+                seqs = sorted(set(level.seqs()).union(self.stay_seqs))
+                view = self.trail.select(seqs)
+                head["lod"] = {"tolerance": level.tolerance, "points": total}
+            else:
+                view = self.trail.copy(0 if reset else self.trail.index_since(since))
+                stay_seqs = list(self.stay_seqs)
+        if lod is not None and lod[0] == 'tolerance':
+            # 任意容差：在副本上现算 Douglas-Peucker（不占锁）
+            coslat = self.coslat or 1.0
+            xs = [lon * 111320.0 * coslat for lon in view.lon]
+            ys = [lat * 110574.0 for lat in view.lat]
+            first = view.first_seq
+            seqs = {first + i for i in douglas_peucker(xs, ys, lod[1])}
+            view = view.select(sorted(seqs.union(stay_seqs)))
+            head["lod"] = {"tolerance": lod[1], "points": total}
+        body = json.dumps(head)[:-1] + ', "trail": ' + view.to_json() + '}'
+        return version, body.encode()
+
+    def lod_for(self, zoom=None, tolerance=None):
+        """把 ?zoom= / ?tolerance= 换成抽稀参数；容差小于最细一级时返回 None（不抽稀）。"""
+        if zoom is not None:
+            lat = self.latest.get('lat') or 35.0
+            tolerance = zoom_tolerance(min(max(zoom, 0), MAX_ZOOM), lat)
+            # 取不超过所需容差的最粗一级预计算结果
+            best = None
+            for i, t in enumerate(LOD_TOLERANCES):
+                if t <= tolerance:
+                    best = i
+            return None if best is None else ('zoom', best)
+        if tolerance is not None and tolerance > 0:
+            return ('tolerance', float(tolerance))
+        return None
+
+    def full_response(self, lod=None):
+        """
+        返回编码好的全量响应。同一 version 只编码一次，所有观看者共用；
+        持锁时间只有取快照，编码和压缩都在锁外完成。
+        """
+        cache = self.cache.get(lod)
+        if cache is not None and cache[0] == self.version:
+            return cache
+        with self.encode_lock:
+            cache = self.cache.get(lod)
+            if cache is not None and cache[0] == self.version:
+                return cache
+            t0 = time.perf_counter()
+            cursor, body = self.snapshot_json(lod=lod)
+            gz = gzip.compress(body, GZIP_LEVEL) if len(body) >= GZIP_MIN_BYTES else None
+            data_encode_seconds["full"].observe(time.perf_counter() - t0)
+            data_response_bytes["full"].observe(len(body))
+            etag = 'W/"%x-%x-%d-%x"' % (BOOT_ID, zlib.crc32(self.id.encode()), cursor,
+                                        zlib.crc32(repr(lod).encode()))
+            if len(self.cache) >= 16:
+                self.cache.clear()  # 任意容差的变体不要无限累积
+            cache = self.cache[lod] = (cursor, etag, body, gz)
+            return cache
+
+devices = {}
+devices_lock = threading.Lock()  # 只保护注册表本身（新增设备），不参与单设备数据读写
+
+def get_device(device_id, create=True):
+    dev = devices.get(device_id)
+    if dev is None and create:
+        with devices_lock:
+            dev = devices.get(device_id)
+            if dev is None:
+                dev = devices[device_id] = Device(device_id)
+                print(f"新设备: {device_id}")
+    return dev
+
+def default_device():
+    """未指定设备时，返回最近有上报的设备。"""
+    with devices_lock:
+        devs = list(devices.values())
+    return max(devs, key=lambda d: d.updated, default=None)
+
+def device_id_of(j, addr):
+    """设备 ID 取自上报中的 id 字段，没有时退回对端 IP（4G 重连后端口会变）。"""
+    dev_id = j.get('id')
+    if dev_id:
+        return str(dev_id)
+    return addr[0] if addr else "unknown"
+
+# ---------- 实时推送（SSE） ----------
+class Subscriber:
+    """
+    一个 /stream 连接。ingest 只做不阻塞的入队；队列满说明浏览器太慢，
+    直接清空积压并标记 overflow，由 HTTP 线程通知浏览器重新拉全量。
+    """
+
+    def __init__(self, device_id, maxlen=STREAM_QUEUE_MAX):
+        self.device_id = device_id
+        self.maxlen = maxlen
+        self.queue = deque()
+        self.overflow = False
+        self.cond = threading.Condition()
+
+    def push(self, data):
+        with self.cond:
+            if len(self.queue) >= self.maxlen:
+                self.queue.clear()
+                self.overflow = True
+            else:
+                self.queue.append(data)
+            self.cond.notify()
+
+    def take(self, timeout):
+        """等待并取出全部积压事件，返回 (events, overflow)。"""
+        with self.cond:
+            if not self.queue and not self.overflow:
+                self.cond.wait(timeout)
+            events = list(self.queue)
+            self.queue.clear()
+            overflow, self.overflow = self.overflow, False
+            return events, overflow
+
+subscribers = set()
+subscribers_lock = threading.Lock()
+
+def subscribe(device_id):
+    sub = Subscriber(device_id)
+    with subscribers_lock:
+        subscribers.add(sub)
+    return sub
+
+def unsubscribe(sub):
+    with subscribers_lock:
+        subscribers.discard(sub)
+
+def publish(dev, since):
+    """把 since 之后的变化推给订阅了该设备的所有连接；只编码一次。"""
+    with subscribers_lock:
+        targets = [s for s in subscribers if s.device_id == dev.id]
+    if not targets:
+        return
+    _, data = dev.snapshot_json(since)
+    for sub in targets:
+        sub.push(data)
+
+# ---------- 持久化存储（SQLite WAL，追加写） ----------
+class TrackStore:
+    """
+    所有被接受的点追加写入 SQLite（WAL 模式）。ingest 只把行放进队列，
+    由单独的写线程攒批后一次事务提交（group commit），磁盘 I/O 不会卡住接入。
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.queue = queue.Queue(maxsize=STORE_QUEUE_MAX)
+        self.dropped = 0   # 队列满时丢弃的行数（磁盘跟不上）
+        self.written = 0
+        self.pending_remote = 0  # 只读实例：ingest 进程报告的待写队列长度
+        # 每台设备上一个写入的点 (lat, lon, ts, 瓦片编号)，用来记录线段的起点；只在 ingest 线程访问
+        self._prev = {}
+        self._writer = None
+        if readonly:
+            # HTTP worker 只查询，建表、迁移和写入都由 ingest 进程负责
+            return
+        conn = self.connect()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS points (
+                id INTEGER PRIMARY KEY,
+                device TEXT NOT NULL,
+                ts REAL NOT NULL,
+                lat REAL NOT NULL,
+                lon REAL NOT NULL,
+                speed_kmh REAL,
+                alt REAL,
+                sats INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS points_ts ON points(ts);
+            CREATE INDEX IF NOT EXISTS points_device_ts ON points(device, ts);
+        """)
+        self._migrate(conn)
+        conn.close()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _migrate(self, conn):
+        """
+        瓦片用的列：qk 为点所在索引瓦片的编号，plat/plon/pqk 为同一设备上一个点（线段起点），
+        间隔超过 TRIP_GAP_SECONDS 时为空（轨迹断开）。旧数据库补上列并回填一次。
+        """
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(points)")}
+        with conn:
+            for col, typ in (("qk", "INTEGER"), ("plat", "REAL"), ("plon", "REAL"), ("pqk", "INTEGER")):
+                if col not in cols:
+                    conn.execute(f"ALTER TABLE points ADD COLUMN {col} {typ}")
+            conn.execute("CREATE INDEX IF NOT EXISTS points_device_qk ON points(device, qk)")
+            conn.execute("CREATE INDEX IF NOT EXISTS points_device_pqk ON points(device, pqk)")
+        if conn.execute("SELECT 1 FROM points WHERE qk IS NULL LIMIT 1").fetchone() is None:
+            return
+        print("为历史数据建立瓦片索引...")
+        ids = [r[0] for r in conn.execute("SELECT DISTINCT device FROM points WHERE qk IS NULL")]
+        for dev_id in ids:
+            prev = None
+            updates = []
+            for row_id, ts, lat, lon in conn.execute(
+                    "SELECT id, ts, lat, lon FROM points WHERE device = ? ORDER BY ts", (dev_id,)).fetchall():
+                qk = tile_key(lat, lon)
+                if prev is not None and ts - prev[2] <= TRIP_GAP_SECONDS:
+                    updates.append((qk, prev[0], prev[1], prev[3], row_id))
+                else:
+                    updates.append((qk, None, None, None, row_id))
+                prev = (lat, lon, ts, qk)
+            with conn:
+                conn.executemany("UPDATE points SET qk = ?, plat = ?, plon = ?, pqk = ? WHERE id = ?", updates)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def append(self, row):
+        """row = (device, ts, lat, lon, speed_kmh, alt, sats)；不阻塞。"""
+        dev_id, ts, lat, lon = row[0], row[1], row[2], row[3]
+        qk = tile_key(lat, lon)
+        prev = self._prev.get(dev_id)
+        self._prev[dev_id] = (lat, lon, ts, qk)
+        if prev is not None and 0 <= ts - prev[2] <= TRIP_GAP_SECONDS:
+            row = row + (qk, prev[0], prev[1], prev[3])
+        else:
+            row = row + (qk, None, None, None)
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def seed_prev(self, dev_id, row):
+        """启动重放后记下每台设备最后一个点，重启后的第一段线段能接上。"""
+        _, ts, lat, lon = row[:4]
+        self._prev[dev_id] = (lat, lon, ts, tile_key(lat, lon))
+
+    def pending(self):
+        """待写队列长度；只读实例返回 ingest 进程报告的值。"""
+        return self.queue.qsize() if self._writer is not None else self.pending_remote
+
+    def close(self):
+        """写入剩余数据后停止写线程。"""
+        if self._writer is None:
+            return
+        self.queue.put(None)
+        self._writer.join(timeout=10)
+
+    def _write_loop(self):
+        conn = self.connect()
+        while True:
+            row = self.queue.get()
+            stop = row is None
+            batch = [] if stop else [row]
+            deadline = time.monotonic() + STORE_FLUSH_INTERVAL
+            # 攒批：凑满 STORE_BATCH 行或等满 STORE_FLUSH_INTERVAL 秒
+            while not stop and len(batch) < STORE_BATCH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    row = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if row is None:
+                    stop = True
+                else:
+                    batch.append(row)
+            if stop:
+                # 退出前把队列里剩下的也写掉
+                while True:
+                    try:
+                        row = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if row is not None:
+                        batch.append(row)
+            if batch:
+                try:
+                    with conn:
+                        conn.executemany(
+                            "INSERT INTO points (device, ts, lat, lon, speed_kmh, alt, sats, qk, plat, plon, pqk) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+                    self.written += len(batch)
+                    # 提交之后再让相关瓦片失效，之后的请求一定能读到新点
+                    tile_cache.invalidate(batch)
+                    if ring is not None:
+                        # HTTP worker 的瓦片缓存在各自进程里，同样等提交之后再通知
+                        for row in batch:
+                            ring.put(RING_STORED, row[0], row[1], row[2], row[3],
+                                     math.nan if row[8] is None else row[8],
+                                     math.nan if row[9] is None else row[9])
+                except Exception:
+                    print("TrackStore 写入异常：")
+                    traceback.print_exc()
+            if stop:
+                conn.close()
+                return
+
+    def query(self, device=None, t_from=None, t_to=None, limit=None):
+        """按时间范围逐批读出点（走 ts 索引），生成器，不会把结果整体载入内存。"""
+        sql = "SELECT device, ts, lat, lon, speed_kmh, alt, sats FROM points WHERE 1=1"
+        args = []
+        if device is not None:
+            sql += " AND device = ?"; args.append(device)
+        if t_from is not None:
+            sql += " AND ts >= ?"; args.append(t_from)
+        if t_to is not None:
+            sql += " AND ts <= ?"; args.append(t_to)
+        sql += " ORDER BY ts"
+        if limit is not None:
+            sql += " LIMIT ?"; args.append(limit)
+        conn = self.connect()
+        try:
+            cur = conn.execute(sql, args)
+            while True:
+                rows = cur.fetchmany(1000)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def tile_segments(self, device, z, x, y, t_from=None, t_to=None):
+        """
+        与瓦片 (z, x, y) 有关的线段 (ts, plat, plon, lat, lon)，按时间顺序：起点或终点落在
+        瓦片里的都算（两个索引各取一段连续区间）。plat 为空表示轨迹从这个点重新开始。
+        """
+        lo, hi = tile_key_range(z, x, y)
+        sql = ("SELECT ts, plat, plon, lat, lon FROM points WHERE device = ? "
+               "AND ((qk >= ? AND qk < ?) OR (pqk >= ? AND pqk < ?))")
+        args = [device, lo, hi, lo, hi]
+        if t_from is not None:
+            sql += " AND ts >= ?"; args.append(t_from)
+        if t_to is not None:
+            sql += " AND ts <= ?"; args.append(t_to)
+        sql += " ORDER BY ts"
+        conn = self.connect()
+        try:
+            return conn.execute(sql, args).fetchall()
+        finally:
+            conn.close()
+
+    def tail(self, per_device):
+        """每个设备最近 per_device 行，按时间顺序，用于启动时重建内存轨迹。"""
+        conn = self.connect()
+        try:
+            ids = [r[0] for r in conn.execute("SELECT DISTINCT device FROM points")]
+            for dev_id in ids:
+                rows = conn.execute(
+                    "SELECT device, ts, lat, lon, speed_kmh, alt, sats FROM points "
+                    "WHERE device = ? ORDER BY ts DESC LIMIT ?", (dev_id, per_device)).fetchall()
+                rows.reverse()
+                yield dev_id, rows
+        finally:
+            conn.close()
+
+store = None
+
+def restore_from_store():
+    """用日志尾部重放出每个设备的内存轨迹（重放时不再过滤，也不重复写日志）。"""
+    n = 0
+    for dev_id, rows in store.tail(STORE_REPLAY_ROWS):
+        dev = get_device(dev_id)
+        for _, ts, lat, lon, speed_kmh, alt, sats in rows:
+            dev.add_point(lat, lon, speed_kmh or 0.0, alt or 0.0, sats or 0, ts)
+            n += 1
+        if rows:
+            store.seed_prev(dev_id, rows[-1])
+    print(f"已从 {store.path} 恢复 {n} 个历史点，{len(devices)} 台设备")
+
+# ---------- 历史轨迹瓦片 ----------
+def mercator_xy(lat, lon):
+    """经纬度 -> Web 墨卡托归一化坐标 (0~1, 0~1)，y 向南增大（与高德/谷歌瓦片编号一致）。"""
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    s = math.sin(math.radians(lat))
+    return (lon + 180.0) / 360.0, 0.5 - math.log((1 + s) / (1 - s)) / (4 * math.pi)
+
+def _spread_bits(v):
+    v &= 0xFFFF
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    return (v | (v << 1)) & 0x55555555
+
+def morton(x, y):
+    return _spread_bits(x) | (_spread_bits(y) << 1)
+
+def tile_cell(lat, lon):
+    """点所在的 TILE_INDEX_ZOOM 级瓦片 (x, y)。"""
+    n = 1 << TILE_INDEX_ZOOM
+    mx, my = mercator_xy(lat, lon)
+    return min(max(int(mx * n), 0), n - 1), min(max(int(my * n), 0), n - 1)
+
+def tile_key(lat, lon):
+    return morton(*tile_cell(lat, lon))
+
+def tile_key_range(z, x, y):
+    """瓦片 (z, x, y) 覆盖的索引编号区间 [lo, hi)。"""
+    d = TILE_INDEX_ZOOM - z
+    if d >= 0:
+        m = morton(x, y)
+        return m << (2 * d), (m + 1) << (2 * d)
+    m = morton(x >> -d, y >> -d)
+    return m, m + 1
+
+def clip_segment(x0, y0, x1, y1, lo, hi):
+    """Liang-Barsky 裁剪到 [lo, hi]²，返回 (x0, y0, x1, y1, 终点被裁掉) 或 None。"""
+    dx = x1 - x0; dy = y1 - y0
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, x0 - lo), (dx, hi - x0), (-dy, y0 - lo), (dy, hi - y0)):
+        if p == 0:
+            if q < 0:
+                return None
+        else:
+            t = q / p
+            if p < 0:
+                if t > t1:
+                    return None
+                if t > t0:
+                    t0 = t
+            else:
+                if t < t0:
+                    return None
+                if t < t1:
+                    t1 = t
+    return x0 + t0 * dx, y0 + t0 * dy, x0 + t1 * dx, y0 + t1 * dy, t1 < 1.0
+
+def encode_polyline(points):
+    """整数坐标序列 -> Google encoded polyline 字符串（首点绝对值，之后为差值）。"""
+    out = []
+    px = py = 0
+    for x, y in points:
+        for v in (x - px, y - py):
+            v = ~(v << 1) if v < 0 else v << 1
+            while v >= 0x20:
+                out.append(chr((0x20 | (v & 0x1f)) + 63))
+                v >>= 5
+            out.append(chr(v + 63))
+        px, py = x, y
+    return "".join(out)
+
+def render_tile(segments, z, x, y):
+    """把线段裁剪、量化到瓦片内整数坐标并连成折线，返回编码后的折线列表。"""
+    n = 1 << z
+    scale = TILE_EXTENT * n
+    ox = x * TILE_EXTENT; oy = y * TILE_EXTENT
+    lo = -TILE_BUFFER; hi = TILE_EXTENT + TILE_BUFFER
+    lines = []
+    cur = []
+    for _, plat, plon, lat, lon in segments:
+        if plat is None:
+            continue  # 轨迹起点，下一条线段会从这里开始
+        mx0, my0 = mercator_xy(plat, plon)
+        mx1, my1 = mercator_xy(lat, lon)
+        c = clip_segment(mx0 * scale - ox, my0 * scale - oy, mx1 * scale - ox, my1 * scale - oy, lo, hi)
+        if c is None:
+            continue
+        a = (int(round(c[0])), int(round(c[1])))
+        b = (int(round(c[2])), int(round(c[3])))
+        if not cur or cur[-1] != a:
+            if len(cur) >= 2:
+                lines.append(cur)
+            cur = [a]
+        if b != cur[-1]:
+            cur.append(b)
+        if c[4]:
+            # 线段出了瓦片，之后再进来是新的一段
+            if len(cur) >= 2:
+                lines.append(cur)
+            cur = []
+    if len(cur) >= 2:
+        lines.append(cur)
+    return [encode_polyline(line) for line in lines]
+
+class TileCache:
+    """
+    渲染好的瓦片（LRU）。每个条目挂在它所在（或所属）的索引格子的祖先瓦片上，
+    新点写入后只让包含该点（以及它所在线段起点）格子的瓦片失效，其他瓦片继续命中。
+    """
+
+    def __init__(self, maxsize=TILE_CACHE_MAX):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (None, etag, body, gz)
+        self.anchors = {}             # (device, z, x, y) -> {key, ...}
+        self.version = 0              # 每次失效 +1，渲染期间有失效则不缓存结果
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _anchor(key):
+        device, z, x, y = key[:4]
+        if z > TILE_INDEX_ZOOM:
+            d = z - TILE_INDEX_ZOOM
+            return device, TILE_INDEX_ZOOM, x >> d, y >> d
+        return device, z, x, y
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, self.version
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry, self.version
+
+    def put(self, key, entry, version):
+        with self.lock:
+            if version != self.version:
+                return
+            self.entries[key] = entry
+            self.anchors.setdefault(self._anchor(key), set()).add(key)
+            while len(self.entries) > self.maxsize:
+                old, _ = self.entries.popitem(last=False)
+                self._drop_anchor(old)
+
+    def _drop_anchor(self, key):
+        a = self._anchor(key)
+        keys = self.anchors.get(a)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.anchors[a]
+
+    def invalidate(self, rows):
+        """rows 为刚写入的存储行，(device, ts, lat, lon, ..., qk, plat, plon, pqk)。"""
+        cells = set()
+        for row in rows:
+            cells.add((row[0],) + tile_cell(row[2], row[3]))
+            if row[8] is not None:
+                cells.add((row[0],) + tile_cell(row[8], row[9]))
+        with self.lock:
+            self.version += 1
+            if not self.entries:
+                return
+            for device, cx, cy in cells:
+                for z in range(TILE_MIN_ZOOM, TILE_INDEX_ZOOM + 1):
+                    d = TILE_INDEX_ZOOM - z
+                    keys = self.anchors.pop((device, z, cx >> d, cy >> d), None)
+                    if keys:
+                        for key in keys:
+                            self.entries.pop(key, None)
+
+tile_cache = TileCache()
+
+def tile_response(device, z, x, y, t_from=None, t_to=None):
+    """瓦片的 JSON 响应 (None, etag, body, gzip_body)，先查 LRU 缓存。"""
+    key = (device, z, x, y, t_from, t_to)
+    entry, version = tile_cache.get(key)
+    if entry is not None:
+        return entry
+    lines = render_tile(store.tile_segments(device, z, x, y, t_from, t_to), z, x, y)
+    body = json.dumps({"z": z, "x": x, "y": y, "extent": TILE_EXTENT, "lines": lines},
+                      separators=(',', ':')).encode()
+    gz = gzip.compress(body, GZIP_LEVEL) if len(body) >= GZIP_MIN_BYTES else None
+    entry = (None, 'W/"%x-%x"' % (zlib.crc32(body), len(body)), body, gz)
+    tile_cache.put(key, entry, version)
+    return entry
 
 # ---------- 工具函数 ----------
 def haversine(lat1, lon1, lat2, lon2):
@@ -47,173 +1682,1041 @@ def format_duration(seconds):
 def out_of_china(lat, lon):
     return not (73.66 < lon < 135.05 and 3.86 < lat < 53.55)
 
+# 偏移量多项式提到模块级，不再每次调用都重新定义闭包。
+# sin/sqrt 作为参数传入，标量路径用 math，批量路径传 numpy 的同名函数。
+_GCJ_A = 6378245.0
+_GCJ_EE = 0.00669342162296594323
+
+def _transform_lat(x, y, sin=math.sin, sqrt=math.sqrt, pi=math.pi):
+    ret = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * sqrt(abs(x))
+    ret += (20.0 * sin(6.0 * x * pi) + 20.0 * sin(2.0 * x * pi)) * 2.0 / 3.0
+    ret += (20.0 * sin(y * pi) + 40.0 * sin(y / 3.0 * pi)) * 2.0 / 3.0
+    ret += (160.0 * sin(y / 12.0 * pi) + 320.0 * sin(y * pi / 30.0)) * 2.0 / 3.0
+    return ret
+
+def _transform_lon(x, y, sin=math.sin, sqrt=math.sqrt, pi=math.pi):
+    ret = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * sqrt(abs(x))
+    ret += (20.0 * sin(6.0 * x * pi) + 20.0 * sin(2.0 * x * pi)) * 2.0 / 3.0
+    ret += (20.0 * sin(x * pi) + 40.0 * sin(x / 3.0 * pi)) * 2.0 / 3.0
+    ret += (150.0 * sin(x / 12.0 * pi) + 300.0 * sin(x / 30.0 * pi)) * 2.0 / 3.0
+    return ret
+
 def wgs84_to_gcj02(lat, lon):
     try:
         lat = float(lat); lon = float(lon)
     except:
         return lat, lon
     if out_of_china(lat, lon): return lat, lon
-    a = 6378245.0; ee = 0.00669342162296594323
-    def _tLat(x, y):
-        ret = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * math.sqrt(abs(x))
-        ret += (20.0 * math.sin(6.0 * x * math.pi) + 20.0 * math.sin(2.0 * x * math.pi)) * 2.0 / 3.0
-        ret += (20.0 * math.sin(y * math.pi) + 40.0 * math.sin(y / 3.0 * math.pi)) * 2.0 / 3.0
-        ret += (160.0 * math.sin(y / 12.0 * math.pi) + 320.0 * math.sin(y * math.pi / 30.0)) * 2.0 / 3.0
-        return ret
-    def _tLon(x, y):
-        ret = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * math.sqrt(abs(x))
-        ret += (20.0 * math.sin(6.0 * x * math.pi) + 20.0 * math.sin(2.0 * x * math.pi)) * 2.0 / 3.0
-        ret += (20.0 * math.sin(x * math.pi) + 40.0 * math.sin(x / 3.0 * math.pi)) * 2.0 / 3.0
-        ret += (150.0 * math.sin(x / 12.0 * math.pi) + 300.0 * math.sin(x / 30.0 * math.pi)) * 2.0 / 3.0
-        return ret
-    dLat = _tLat(lon - 105.0, lat - 35.0); dLon = _tLon(lon - 105.0, lat - 35.0)
+    a = _GCJ_A; ee = _GCJ_EE
+    dLat = _transform_lat(lon - 105.0, lat - 35.0); dLon = _transform_lon(lon - 105.0, lat - 35.0)
     radLat = lat / 180.0 * math.pi
     magic = math.sin(radLat); magic = 1 - ee * magic * magic; sqrtMagic = math.sqrt(magic)
     dLat = (dLat * 180.0) / ((a * (1 - ee)) / (magic * sqrtMagic) * math.pi)
     dLon = (dLon * 180.0) / (a / sqrtMagic * math.cos(radLat) * math.pi)
     return lat + dLat, lon + dLon
 
-# ---------- TCP 服务器 ----------
-def tcp_server():
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(('0.0.0.0', TCP_PORT))
-    s.listen(5)
-    print(f"TCP server listening on 0.0.0.0:{TCP_PORT}")
-    while True:
-        try:
-            client, addr = s.accept()
-            threading.Thread(target=handle_client, args=(client, addr), daemon=True).start()
-        except Exception:
-            print("tcp_server.accept 异常：")
-            traceback.print_exc()
+# ---------- 批量版本（回放/补录历史数据用） ----------
+# 有 numpy 时整列向量化计算，返回 ndarray；没有时退回逐点计算，返回 list。
 
-def handle_client(client, addr):
-    print(f"Client connected: {addr}")
-    client.settimeout(60)
-    buf = b""
+def out_of_china_batch(lats, lons):
+    if np is not None:
+        lats = np.asarray(lats, dtype=float); lons = np.asarray(lons, dtype=float)
+        return ~((73.66 < lons) & (lons < 135.05) & (3.86 < lats) & (lats < 53.55))
+    return [out_of_china(lat, lon) for lat, lon in zip(lats, lons)]
 
-    while True:
-        try:
-            data = client.recv(1024)
-            if not data:
-                break
-            buf += data
-            while b'\n' in buf:
-                line, buf = buf.split(b'\n', 1)
-                try:
-                    j = json.loads(line.decode('utf-8', 'ignore').strip())
-                except Exception:
+def wgs84_to_gcj02_batch(lats, lons):
+    """批量 WGS84 -> GCJ02，返回 (lats, lons)；国外的点原样返回。"""
+    if np is None:
+        out = [wgs84_to_gcj02(lat, lon) for lat, lon in zip(lats, lons)]
+        return [p[0] for p in out], [p[1] for p in out]
+    lat = np.asarray(lats, dtype=float); lon = np.asarray(lons, dtype=float)
+    a = _GCJ_A; ee = _GCJ_EE
+    x = lon - 105.0; y = lat - 35.0
+    dLat = _transform_lat(x, y, np.sin, np.sqrt)
+    dLon = _transform_lon(x, y, np.sin, np.sqrt)
+    radLat = lat / 180.0 * np.pi
+    magic = np.sin(radLat); magic = 1 - ee * magic * magic; sqrtMagic = np.sqrt(magic)
+    dLat = (dLat * 180.0) / ((a * (1 - ee)) / (magic * sqrtMagic) * np.pi)
+    dLon = (dLon * 180.0) / (a / sqrtMagic * np.cos(radLat) * np.pi)
+    outside = out_of_china_batch(lat, lon)
+    return np.where(outside, lat, lat + dLat), np.where(outside, lon, lon + dLon)
+
+def haversine_batch(lat1, lon1, lat2, lon2):
+    """逐元素计算两组点之间的距离（米）。"""
+    if np is None:
+        return [haversine(*p) for p in zip(lat1, lon1, lat2, lon2)]
+    lat1 = np.radians(np.asarray(lat1, dtype=float)); lon1 = np.radians(np.asarray(lon1, dtype=float))
+    lat2 = np.radians(np.asarray(lat2, dtype=float)); lon2 = np.radians(np.asarray(lon2, dtype=float))
+    a = np.sin((lat2 - lat1) / 2.0) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+    return 6371000 * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+def haversine_consecutive(lats, lons):
+    """一条轨迹相邻两点之间的距离，长度为 n-1。"""
+    if np is None:
+        return [haversine(lats[i], lons[i], lats[i + 1], lons[i + 1]) for i in range(len(lats) - 1)]
+    lats = np.asarray(lats, dtype=float); lons = np.asarray(lons, dtype=float)
+    return haversine_batch(lats[:-1], lons[:-1], lats[1:], lons[1:])
+
+# ---------- 点过滤 ----------
+# 过滤器接口：check(last, lat, lon, speed_kmh, sats, quality, ts) -> (accept, lat, lon, kind, reason)
+#   last 为该设备上一个被接受的点 (lat, lon, ts) 或 None；accept 为 False 即离群点，
+#   返回的 lat/lon 是要记录的位置（可以是平滑后的）；kind 为原因类别（用于统计），reason 为说明。
+class SimpleJumpFilter:
+    """原有规则：只丢弃短时间内超过 MAX_JUMP_METERS_SIMPLE 的跳变，位置原样保留。"""
+
+    def check(self, last, lat, lon, speed_kmh, sats, quality, ts):
+        if last is None:
+            # 没有历史点，首次接受
+            return True, lat, lon, "first", "首次有效点，直接接受"
+        last_lat, last_lon, last_ts = last
+        dt = ts - last_ts
+        if dt > BYPASS_SECONDS:
+            # 距离上次超过 1 小时 -> 跳过过滤，直接接受
+            return True, lat, lon, "gap", f"与上次有效点间隔 {int(dt)}s > {BYPASS_SECONDS}s，跳过过滤"
+        # 否则计算距离，若超过 50km 则丢弃
+        dist = haversine(last_lat, last_lon, lat, lon)
+        if dist > MAX_JUMP_METERS_SIMPLE:
+            return False, lat, lon, "jump", f"短时间内跳变过大 ({dist:.1f} m)，丢弃"
+        return True, lat, lon, "ok", f"短时间内跳变可接受 ({dist:.1f} m)"
+
+# 定位质量（GGA 第 6 字段）对误差的缩放：2 差分，4 RTK 固定，5 RTK 浮点，6 推算
+_QUALITY_SCALE = {2: 0.5, 4: 0.1, 5: 0.3, 6: 5.0}
+_M_PER_DEG_LAT = 110540.0
+_M_PER_DEG_LON = 111320.0
+
+def measurement_variance(sats, quality):
+    """单点定位误差的方差（米²）：卫星少于 8 颗按比例放大，未知卫星数按 2 倍。"""
+    sigma = KALMAN_BASE_SIGMA * _QUALITY_SCALE.get(quality, 1.0)
+    sigma *= 8.0 / sats if 0 < sats < 8 else (2.0 if sats <= 0 else 1.0)
+    return sigma * sigma
+
+def _kf_predict(s, dt, q):
+    # s = [位置, 速度, P00, P01, P11]，常速度模型，连续白噪声加速度
+    p, v, a, b, c = s
+    dt2 = dt * dt
+    s[0] = p + v * dt
+    s[2] = a + 2 * dt * b + dt2 * c + q * dt2 * dt / 3
+    s[3] = b + dt * c + q * dt2 / 2
+    s[4] = c + q * dt
+
+def _kf_update_pos(s, z, r):
+    p, v, a, b, c = s
+    k0 = a / (a + r); k1 = b / (a + r)
+    y = z - p
+    s[0] = p + k0 * y; s[1] = v + k1 * y
+    s[2] = a - k0 * a; s[3] = b - k0 * b; s[4] = c - k1 * b
+
+def _kf_update_vel(s, z, r):
+    p, v, a, b, c = s
+    k0 = b / (c + r); k1 = c / (c + r)
+    y = z - v
+    s[0] = p + k0 * y; s[1] = v + k1 * y
+    s[2] = a - k0 * b; s[3] = b - k0 * c; s[4] = c - k1 * c
+
+class KalmanFilter:
+    """
+    常速度卡尔曼滤波：在以首点为原点的平面（米）上，东、北方向各一个 (位置, 速度) 状态，
+    每点 O(1)。观测误差按卫星数和定位质量估计，上报速度为 0 时约束速度为 0。
+    新息的马氏距离平方超过 KALMAN_GATE 判为离群点并丢弃；连续 KALMAN_MAX_OUTLIERS 个
+    离群点（例如出隧道后已经走远）或间隔超过 BYPASS_SECONDS 时用新点重新初始化。
+    接受的点输出滤波后的位置。
+    """
+
+    def __init__(self):
+        self.ts = None
+        self.outliers = 0
+
+    def _reset(self, lat, lon, r, speed, ts):
+        self.lat0 = lat; self.lon0 = lon
+        self.kx = _M_PER_DEG_LON * math.cos(math.radians(lat))
+        vv = max(speed, 10.0) ** 2  # 速度方向未知，初始方差取 max(速度, 10m/s) 的平方
+        self.ex = [0.0, 0.0, r, 0.0, vv]
+        self.ny = [0.0, 0.0, r, 0.0, vv]
+        self.ts = ts
+        self.outliers = 0
+
+    def check(self, last, lat, lon, speed_kmh, sats, quality, ts):
+        r = measurement_variance(sats, quality)
+        speed = speed_kmh / 3.6
+        if self.ts is None:
+            self._reset(lat, lon, r, speed, ts)
+            return True, lat, lon, "first", "首次有效点，初始化滤波"
+        dt = ts - self.ts
+        if dt > BYPASS_SECONDS:
+            self._reset(lat, lon, r, speed, ts)
+            return True, lat, lon, "gap", f"与上次有效点间隔 {int(dt)}s > {BYPASS_SECONDS}s，重新初始化滤波"
+        ex, ny = self.ex, self.ny
+        if dt > 0:
+            q = KALMAN_ACCEL * KALMAN_ACCEL
+            _kf_predict(ex, dt, q); _kf_predict(ny, dt, q)
+            self.ts = ts
+        x = (lon - self.lon0) * self.kx
+        y = (lat - self.lat0) * _M_PER_DEG_LAT
+        ix = x - ex[0]; iy = y - ny[0]
+        d2 = ix * ix / (ex[2] + r) + iy * iy / (ny[2] + r)
+        if d2 > KALMAN_GATE:
+            self.outliers += 1
+            if self.outliers >= KALMAN_MAX_OUTLIERS:
+                self._reset(lat, lon, r, speed, ts)
+                return True, lat, lon, "reset", f"连续 {KALMAN_MAX_OUTLIERS} 个离群点，按新位置重新初始化滤波"
+            return False, lat, lon, "outlier", f"离群点 (偏离预测 {math.sqrt(ix * ix + iy * iy):.1f} m，马氏距离² {d2:.1f})，丢弃"
+        self.outliers = 0
+        _kf_update_pos(ex, x, r); _kf_update_pos(ny, y, r)
+        # 上报速度只有大小没有方向：只在静止时作为“速度为 0”的观测，抑制停车时的漂移。
+        # （行驶中沿估计方向施加速度大小，转弯时方向滞后，实测反而增加误删）
+        if speed < 0.5:
+            rv = KALMAN_SPEED_SIGMA * KALMAN_SPEED_SIGMA
+            _kf_update_vel(ex, 0.0, rv); _kf_update_vel(ny, 0.0, rv)
+        out_lat = self.lat0 + ny[0] / _M_PER_DEG_LAT
+        out_lon = self.lon0 + ex[0] / self.kx
+        return True, out_lat, out_lon, "ok", f"滤波后接受 (修正 {math.hypot(ex[0] - x, ny[0] - y):.1f} m)"
+
+FILTERS = {
+    "simple": SimpleJumpFilter,
+    "kalman": KalmanFilter,
+}
+
+# ---------- TCP 服务器（asyncio 单线程多路复用） ----------
+class IngestStats:
+    """接入统计：累计连接数/行数/接受/丢弃点数，并按秒采样计算最近窗口内的速率。"""
+
+    RATES = ("connections", "lines", "accepted", "dropped")
+
+    def __init__(self, window=STATS_WINDOW):
+        self.connections = 0      # 累计连接数
+        self.active = 0           # 当前在线连接数
+        self.lines = 0            # 累计收到的行数
+        self.overlong = 0         # 因超长被丢弃的行数
+        self.frames = 0           # 收到的二进制帧
+        self.bad_frames = 0       # 校验失败的二进制帧
+        self.dup_frames = 0       # 重传导致的重复帧
+        self.bad_json = 0         # 无法解析的 JSON 行
+        self.accepted = 0         # 被接受的点
+        self.dropped = 0          # 被过滤丢弃的点
+        self.by_reason = {}       # (accepted/dropped, 过滤器给出的原因类别) -> 点数
+        self._samples = deque(maxlen=window + 1)
+        self.started = time.time()
+
+    def sample(self):
+        self._samples.append((time.time(),) + tuple(getattr(self, k) for k in self.RATES))
+
+    def snapshot(self):
+        rates = dict.fromkeys(self.RATES, 0.0)
+        if len(self._samples) >= 2:
+            first = self._samples[0]; last = self._samples[-1]
+            dt = last[0] - first[0]
+            if dt > 0:
+                for i, k in enumerate(self.RATES, 1):
+                    rates[k] = (last[i] - first[i]) / dt
+        return {
+            "connections_total": self.connections,
+            "connections_active": self.active,
+            "lines_total": self.lines,
+            "lines_overlong": self.overlong,
+            "lines_bad_json": self.bad_json,
+            "frames_total": self.frames,
+            "frames_bad": self.bad_frames,
+            "frames_duplicate": self.dup_frames,
+            "points_accepted": self.accepted,
+            "points_dropped": self.dropped,
+            "connections_per_sec": round(rates["connections"], 2),
+            "lines_per_sec": round(rates["lines"], 2),
+            "accepted_per_sec": round(rates["accepted"], 2),
+            "dropped_per_sec": round(rates["dropped"], 2),
+            "lock_wait": lock_stats.snapshot(),
+            "uptime": int(time.time() - self.started),
+        }
+
+    COUNTERS = ("connections", "active", "lines", "overlong", "frames", "bad_frames",
+                "dup_frames", "bad_json", "accepted", "dropped", "started")
+
+    def export(self):
+        """原始计数和采样（可 JSON 序列化），多进程模式下经共享内存交给 HTTP worker。"""
+        d = {k: getattr(self, k) for k in self.COUNTERS}
+        d["by_reason"] = [[r, k, n] for (r, k), n in self.by_reason.items()]
+        d["samples"] = list(self._samples)
+        return d
+
+    def load(self, d):
+        """用 export() 的结果覆盖本进程的统计（HTTP worker 的 /stats、/metrics）。"""
+        for k in self.COUNTERS:
+            setattr(self, k, d[k])
+        self.by_reason = {(r, k): n for r, k, n in d["by_reason"]}
+        self._samples.clear()
+        self._samples.extend(tuple(x) for x in d["samples"])
+
+ingest_stats = IngestStats()
+
+class DtuProtocol(asyncio.BufferedProtocol):
+    """
+    每个 DTU 连接一个实例，全部运行在同一个事件循环里。
+    recv 直接写入预分配的 bytearray（通过 memoryview），在其中按 '\\n' 切出 JSON 行、
+    按长度切出二进制帧；只有跨包的残留部分才会拷贝到 pending 缓冲区，
+    避免 buf += data 的反复拷贝。
+    """
+
+    def __init__(self, read_size=TCP_READ_SIZE, max_line=TCP_MAX_LINE):
+        self._rbuf = bytearray(read_size)
+        self._rview = memoryview(self._rbuf)
+        self._pending = bytearray()
+        self._max_line = max_line
+        self._discarding = False  # 正在丢弃一行超长数据，直到下一个换行
+        self.transport = None
+        self.addr = None
+        self.last_rx = 0.0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        self.last_rx = time.monotonic()
+        ingest_stats.connections += 1
+        ingest_stats.active += 1
+        connections.add(self)
+        print(f"Client connected: {self.addr}")
+
+    def get_buffer(self, sizehint):
+        return self._rview
+
+    def buffer_updated(self, nbytes):
+        self.last_rx = time.monotonic()
+        pending = self._pending
+        if pending:
+            # 有残留的半行/半帧：拼上本次数据后统一解析
+            pending += self._rview[:nbytes]
+            used = self._consume(pending, len(pending))
+            del pending[:used]   # bytearray 头部删除是摊还 O(1) 的
+        else:
+            # 常见情况：直接在接收缓冲区里解析，只拷贝末尾不完整的部分
+            used = self._consume(self._rbuf, nbytes)
+            if used < nbytes:
+                pending += self._rview[used:nbytes]
+        # 背压保护：没有换行的数据超过上限时直接丢弃这一行
+        if len(pending) > self._max_line:
+            ingest_stats.overlong += 1
+            pending.clear()
+            self._discarding = True
+
+    def _consume(self, buf, end):
+        """
+        从 buf[0:end] 中解析完整的 JSON 行和二进制帧，返回已消费的字节数。
+        DTU 会夹带不以换行结尾的注册包/心跳包，帧不一定出现在行首：帧头必须长度和 CRC
+        都对得上才接受，否则前进一个字节继续找；一行里藏着完整合法的帧时，帧之前的部分
+        按杂乱数据丢弃，从帧头重新开始。
+        """
+        pos = 0
+        while pos < end:
+            if self._discarding:
+                idx = buf.find(b'\n', pos, end)
+                q = find_frame(buf, pos, end if idx < 0 else idx, end)
+                if q is not None:
+                    self._discarding = False
+                    pos = q
+                    continue
+                if idx < 0:
+                    # 留下末尾可能是半个帧的部分，收全后还能认出来
+                    last = buf.rfind(_FRAME_MAGIC_BYTE, max(pos, end - FRAME_MAX_SIZE), end)
+                    return last if last >= 0 else end
+                self._discarding = False
+                pos = idx + 1
+                continue
+            if buf[pos] == FRAME_MAGIC:
+                total = frame_length_at(buf, pos, end)
+                if total > 0:
+                    ingest_stats.frames += 1
+                    handle_frame(bytes(buf[pos:pos + total]), self)
+                    pos += total
+                    continue
+                if total < 0:
+                    if total == FRAME_BAD_CRC:
+                        ingest_stats.frames += 1
+                        ingest_stats.bad_frames += 1
+                    pos += 1  # 不是合法的帧，跳过这个字节继续找
                     continue
+                # 看起来是没收全的帧：后面已经有别的完整数据时它只是杂乱数据，跳过去
+                nxt = resume_after(buf, pos, end)
+                if nxt is None:
+                    break
+                pos = nxt
+                continue
+            idx = buf.find(b'\n', pos, end)
+            q = find_frame(buf, pos, end if idx < 0 else idx, end)
+            if q is not None:
+                pos = q  # 帧之前是 DTU 夹带的杂乱数据
+                continue
+            if idx < 0:
+                break
+            line = buf[pos:idx]
+            if not (line[:1] == b'{' and line.rstrip(b'\r ')[-1:] == b'}'):
+                # 杂乱数据后面可能跟着一个还没收全、里面碰巧有换行的帧：等帧收全再切分
+                p = partial_frame(buf, pos, idx, end)
+                if p >= 0 and resume_after(buf, p, end) is None:
+                    break
+            ingest_stats.lines += 1
+            handle_line(line, self.addr)
+            pos = idx + 1
+        return pos
 
-                # 只关注含 lat/lon 的上报
-                if 'lat' in j and 'lon' in j:
-                    try:
-                        lat = float(j['lat']); lon = float(j['lon'])
-                        if ENABLE_CONVERT_TO_GCJ02:
-                            lat, lon = wgs84_to_gcj02(lat, lon)
-                        lat, lon = round(lat, 6), round(lon, 6)
-
-                        speed_kmh = float(j.get('speed_kmh', 0.0))
-                        alt = float(j.get('alt', 0.0))
-                        sats = int(j.get('sats', 0))
-
-                        now_ts = time.time()
-
-                        # 获取上一个被接受的有效点（全局，来自 trail 的最后一个点）
-                        with lock:
-                            if len(trail) > 0:
-                                last_pt = trail[-1]
-                                last_valid_lat = last_pt['lat']
-                                last_valid_lon = last_pt['lon']
-                                last_valid_ts = last_pt.get('last_ts', last_pt.get('start_ts', None))
-                            else:
-                                last_valid_lat = last_valid_lon = last_valid_ts = None
-
-                        # 判定逻辑（按你要求的简化规则）
-                        if last_valid_ts is None:
-                            # 没有历史点，首次接受
-                            accept = True
-                            reason = "首次有效点，直接接受"
-                        else:
-                            dt = now_ts - last_valid_ts
-                            if dt > BYPASS_SECONDS:
-                                # 距离上次超过 1 小时 -> 跳过过滤，直接接受
-                                accept = True
-                                reason = f"与上次有效点间隔 {int(dt)}s > {BYPASS_SECONDS}s，跳过过滤"
-                            else:
-                                # 否则计算距离，若超过 50km 则丢弃
-                                dist = haversine(last_valid_lat, last_valid_lon, lat, lon)
-                                if dist > MAX_JUMP_METERS_SIMPLE:
-                                    accept = False
-                                    reason = f"短时间内跳变过大 ({dist:.1f} m)，丢弃"
-                                else:
-                                    accept = True
-                                    reason = f"短时间内跳变可接受 ({dist:.1f} m)"
-
-                        if not accept:
-                            # 丢弃该点（不更新经纬），仅更新最新时间以示收到并记录日志
-                            print(f"丢弃点: {lat},{lon} 原因: {reason} sats={sats}")
-                            with lock:
-                                latest['time'] = time.strftime("%H:%M:%S", time.localtime(now_ts))
-                            continue
-
-                        # 接受该点：加入 trail 并更新 latest（保留停留判定逻辑）
-                        with lock:
-                            is_staying = False
-                            if len(trail) > 0:
-                                last_pt = trail[-1]
-                                if haversine(last_pt['lat'], last_pt['lon'], lat, lon) < STAY_THRESHOLD_METERS:
-                                    is_staying = True
-                                    last_pt['last_ts'] = now_ts
-                                    last_pt['duration_str'] = format_duration(now_ts - last_pt['start_ts'])
-                                    latest['stay_duration'] = last_pt['duration_str']
-
-                            if not is_staying:
-                                trail.append({
-                                    "lat": lat, "lon": lon, "speed_kmh": speed_kmh, "alt": alt, "sats": sats,
-                                    "start_ts": now_ts, "last_ts": now_ts,
-                                    "time_str": time.strftime("%H:%M:%S", time.localtime(now_ts)),
-                                    "duration_str": "0秒"
-                                })
-                                latest['stay_duration'] = "移动中"
-
-                            # 更新 latest（只在点被接受时更新经纬等）
-                            latest.update(j)
-                            latest['lat'] = lat; latest['lon'] = lon; latest['alt'] = alt; latest['sats'] = sats
-                            latest['time'] = time.strftime("%H:%M:%S", time.localtime(now_ts))
-                            latest['speed_kmh'] = round(speed_kmh, 2)
-
-                    except Exception:
-                        print("处理经纬度时异常：")
-                        traceback.print_exc()
-        except socket.timeout:
-            break
-        except Exception:
-            print("handle_client recv 异常：")
-            traceback.print_exc()
-            break
+    def connection_lost(self, exc):
+        connections.discard(self)
+        ingest_stats.active -= 1
+        print(f"Client disconnected: {self.addr}")
+
+connections = set()
+
+async def _housekeeping():
+    """每秒采样一次速率；顺带清理超时无数据的连接（替代每连接 settimeout）。"""
+    last_report = time.monotonic()
+    ring_control_seen = ring.control() if ring is not None else 0
+    while True:
+        await asyncio.sleep(1)
+        ingest_stats.sample()
+        now = time.monotonic()
+        for conn in [c for c in connections if now - c.last_rx > TCP_IDLE_TIMEOUT]:
+            conn.transport.close()
+        if ring is not None:
+            ctl = ring.control()
+            if ctl != ring_control_seen:
+                ring_control_seen = ctl
+                if ctl & 3 == RING_CTL_PROFILE_START:
+                    profiler.start()
+                elif ctl & 3 == RING_CTL_PROFILE_STOP:
+                    profiler.stop()
+            if not ring.put_stats(ring_stats_blob()):
+                print(f"接入统计超过 RING_STATS_MAX（{RING_STATS_MAX} 字节），本次没有同步给 HTTP worker")
+            reload_geofences_if_changed()
+        if STATS_PRINT_INTERVAL and now - last_report >= STATS_PRINT_INTERVAL:
+            s = ingest_stats.snapshot()
+            print(f"[ingest] 在线 {s['connections_active']} 连接, "
+                  f"{s['connections_per_sec']} 连接/秒, {s['lines_per_sec']} 行/秒")
+            last_report = now
+
+async def tcp_server():
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(
+        DtuProtocol, '0.0.0.0', TCP_PORT, backlog=TCP_BACKLOG, reuse_address=True)
+    print(f"TCP server listening on 0.0.0.0:{TCP_PORT}")
+    async with server:
+        await asyncio.gather(server.serve_forever(), _housekeeping())
+
+def run_tcp_server():
     try:
-        client.close()
-    except:
+        asyncio.run(tcp_server())
+    except Exception:
+        print("tcp_server 异常：")
+        traceback.print_exc()
+
+# ---------- 紧凑二进制上报帧 ----------
+# 与 ESP32/main.py 中的编码一致（小端）：
+#   帧:     magic(B)=0xA5  type(B)  length(H)  payload  crc32(I)   crc 覆盖 magic..payload
+#   0x01 定位批次 payload:
+#           seq(H)  id_len(B) id  n(B)
+#           关键帧  lat(i) lon(i) 1e-6 度 WGS84, t(I) UTC 秒(0=未知), alt(i) 0.1 米,
+#                   sats(B) quality(B) speed(H) 0.01 km/h
+#           n-1 个增量  dlat(h) dlon(h) 1e-6 度, dt(B) 秒, dalt(h) 0.1 米, sats(B) speed(H)
+#   0x81 确认 payload: seq(H)，服务器收到 0x01 帧后经 DTU 回给设备
+FRAME_MAGIC = 0xA5
+FRAME_FIXES = 0x01
+FRAME_ACK = 0x81
+FRAME_HEADER_SIZE = 4
+FRAME_MAX_PAYLOAD = 4096
+_FRAME_HEAD = struct.Struct('<BBH')
+_FRAME_KEY = struct.Struct('<iiIiBBH')
+_FRAME_DELTA = struct.Struct('<hhBhBH')
+
+FRAME_MAX_SIZE = FRAME_HEADER_SIZE + FRAME_MAX_PAYLOAD + 4
+FRAME_NOT_HEADER, FRAME_BAD_CRC = -1, -2
+_FRAME_MAGIC_BYTE = bytes((FRAME_MAGIC,))
+
+def make_frame(ftype, payload):
+    head = _FRAME_HEAD.pack(FRAME_MAGIC, ftype, len(payload)) + payload
+    return head + struct.pack('<I', zlib.crc32(head))
+
+def frame_length_at(buf, pos, end):
+    """
+    buf[pos] 是 FRAME_MAGIC 时判断这里是不是一帧：完整且 CRC 正确返回帧长，
+    数据还不够返回 0，长度不合理返回 FRAME_NOT_HEADER，CRC 不对返回 FRAME_BAD_CRC。
+    """
+    if end - pos < FRAME_HEADER_SIZE:
+        return 0
+    length = buf[pos + 2] | (buf[pos + 3] << 8)
+    if length > FRAME_MAX_PAYLOAD:
+        return FRAME_NOT_HEADER
+    total = FRAME_HEADER_SIZE + length + 4
+    if end - pos < total:
+        return 0
+    crc = int.from_bytes(buf[pos + total - 4:pos + total], 'little')
+    if zlib.crc32(buf[pos:pos + total - 4]) != crc:
+        return FRAME_BAD_CRC
+    return total
+
+def partial_frame(buf, start, limit, end):
+    """[start, limit) 内第一个可能是还没收全的帧的帧头位置，没有返回 -1。"""
+    i = buf.find(_FRAME_MAGIC_BYTE, start, limit)
+    while i >= 0:
+        if frame_length_at(buf, i, end) == 0:
+            return i
+        i = buf.find(_FRAME_MAGIC_BYTE, i + 1, limit)
+    return -1
+
+def resume_after(buf, p, end):
+    """
+    p 处像是一个还没收全的帧。帧是按顺序到达的，如果它后面已经有完整合法的帧或新的一行 JSON，
+    p 只是杂乱数据里碰巧出现的 0xA5：返回后面那段数据的起点；否则返回 None（继续等）。
+    """
+    nxt = find_frame(buf, p + 1, end, end)
+    j = buf.find(b'\n{', p + 1, end if nxt is None else nxt)
+    return j + 1 if j >= 0 else nxt
+
+def find_frame(buf, start, limit, end):
+    """帧头在 [start, limit) 内、数据在 end 之前已收全且校验正确的第一个帧的起点；没有返回 None。"""
+    i = buf.find(_FRAME_MAGIC_BYTE, start, limit)
+    while i >= 0:
+        if frame_length_at(buf, i, end) > 0:
+            return i
+        i = buf.find(_FRAME_MAGIC_BYTE, i + 1, limit)
+    return None
+
+def decode_fixes(payload):
+    """解析定位批次，返回 (seq, device_id, [(lat, lon, t, alt, sats, quality, speed_kmh), ...])。"""
+    seq, id_len = struct.unpack_from('<HB', payload, 0)
+    off = 3
+    dev_id = payload[off:off + id_len].decode('utf-8', 'replace')
+    off += id_len
+    n = payload[off]; off += 1
+    if n == 0:
+        return seq, dev_id, []
+    lat, lon, t, alt, sats, qual, speed = _FRAME_KEY.unpack_from(payload, off)
+    off += _FRAME_KEY.size
+    fixes = [(lat, lon, t, alt, sats, qual, speed)]
+    for _ in range(n - 1):
+        dlat, dlon, dt, dalt, sats, speed = _FRAME_DELTA.unpack_from(payload, off)
+        off += _FRAME_DELTA.size
+        lat += dlat; lon += dlon; alt += dalt
+        if t:
+            t += dt
+        fixes.append((lat, lon, t, alt, sats, qual, speed))
+    return seq, dev_id, [(la / 1e6, lo / 1e6, t, al / 10.0, s, q, sp / 100.0)
+                         for la, lo, t, al, s, q, sp in fixes]
+
+def handle_frame(frame, proto):
+    body, crc = frame[:-4], struct.unpack_from('<I', frame, len(frame) - 4)[0]
+    if zlib.crc32(body) != crc:
+        ingest_stats.bad_frames += 1
+        return
+    ftype = frame[1]
+    if ftype != FRAME_FIXES:
+        return
+    try:
+        seq, dev_id, fixes = decode_fixes(body[FRAME_HEADER_SIZE:])
+    except (struct.error, IndexError):
+        ingest_stats.bad_frames += 1
+        return
+    # 先确认再处理：设备收到确认就可以从缓存里删掉这一帧
+    try:
+        proto.transport.write(make_frame(FRAME_ACK, struct.pack('<H', seq)))
+    except Exception:
         pass
-    print(f"Client disconnected: {addr}")
+    dev = get_device(dev_id or device_id_of({}, proto.addr))
+    if not dev.remember_frame(crc):
+        ingest_stats.dup_frames += 1  # 确认丢失导致的重传，已经处理过
+        return
+    now = time.time()
+    for lat, lon, t, alt, sats, qual, speed_kmh in fixes:
+        # 定位时间来自 GNSS（UTC），缺失或明显不合理时按收到的时间算
+        ts = t if t and now - FRAME_MAX_AGE < t < now + 60 else now
+        handle_report({"id": dev.id, "lat": lat, "lon": lon, "alt": alt, "sats": sats,
+                       "quality": str(qual), "speed_kmh": speed_kmh}, proto.addr, ts)
+
+def handle_line(line, addr):
+    text = line.decode('utf-8', 'ignore').strip()
+    if not text:
+        return
+    try:
+        j = json.loads(text)
+    except Exception:
+        ingest_stats.bad_json += 1
+        return
+    if isinstance(j, dict):
+        handle_report(j, addr)
+
+def handle_report(j, addr, ts=None):
+    # 只关注含 lat/lon 的上报
+    if 'lat' in j and 'lon' in j:
+        try:
+            lat = float(j['lat']); lon = float(j['lon'])
+            speed_kmh = float(j.get('speed_kmh', 0.0))
+            alt = float(j.get('alt', 0.0))
+            # NaN/inf 进了卡尔曼滤波器会让它的状态一直是 NaN，也没法编码成合法 JSON，入口处直接丢弃
+            if not (all(map(math.isfinite, (lat, lon, speed_kmh, alt))) and abs(lat) <= 90 and abs(lon) <= 180):
+                ingest_stats.dropped += 1
+                key = ("dropped", "invalid")
+                ingest_stats.by_reason[key] = ingest_stats.by_reason.get(key, 0) + 1
+                drop_log.emit("point_dropped", device=device_id_of(j, addr), kind="invalid",
+                              reason="经纬度/速度/海拔不是有效数值", lat=str(j['lat']), lon=str(j['lon']))
+                return
+            if ENABLE_CONVERT_TO_GCJ02:
+                lat, lon = wgs84_to_gcj02(lat, lon)
+
+            sats = min(max(int(j.get('sats', 0)), 0), 255)
+            try:
+                quality = min(max(int(j.get('quality') or 0), 0), 9)
+            except (TypeError, ValueError):
+                quality = 0
 
-# 启动 TCP 接收线程
-threading.Thread(target=tcp_server, daemon=True).start()
+            now_ts = time.time() if ts is None else ts
+            dev = get_device(device_id_of(j, addr))
+            latest = dev.latest
+
+            # 获取该设备上一个被接受的有效点（来自该设备 trail 的最后一个点）
+            with dev.lock:
+                dev.updated = now_ts
+                last = dev.last_point()
+
+            # 判定（以及平滑）交给该设备的过滤器，见 FILTER_MODE
+            accept, lat, lon, kind, reason = dev.filter.check(last, lat, lon, speed_kmh, sats, quality, now_ts)
+            lat, lon = round(lat, 6), round(lon, 6)
+            key = ("accepted" if accept else "dropped", kind)
+            ingest_stats.by_reason[key] = ingest_stats.by_reason.get(key, 0) + 1
+
+            if not accept:
+                # 丢弃该点（不更新经纬），仅更新最新时间以示收到并记录日志（限速）
+                ingest_stats.dropped += 1
+                drop_log.emit("point_dropped", device=dev.id, kind=kind, reason=reason,
+                              lat=lat, lon=lon, sats=sats)
+                with dev.lock:
+                    latest['time'] = time.strftime("%H:%M:%S", time.localtime(now_ts))
+                    dev.version += 1  # latest 变了，让缓存的响应失效
+                    ver = dev.version
+                if ring is not None:
+                    ring.put(RING_DROP, dev.id, now_ts, ver=ver)
+                return
+
+            # 接受该点：加入 trail 并更新 latest，写入持久化日志，推送给订阅者
+            ingest_stats.accepted += 1
+            since = dev.version
+            ver = dev.add_point(lat, lon, speed_kmh, alt, sats, now_ts, j)
+            if store is not None:
+                store.append((dev.id, now_ts, lat, lon, speed_kmh, alt, sats))
+            publish(dev, since)
+            if ring is not None:
+                ring.put(RING_POINT, dev.id, now_ts, lat, lon, speed_kmh, alt, sats, json.dumps(j).encode(), ver)
+            for ev in geofences.evaluate(dev.id, lat, lon, now_ts):
+                print(f"围栏事件[{dev.id}]: {'进入' if ev['type'] == 'enter' else '离开'} {ev['name']}")
+                if ring is not None:
+                    ring.put(RING_EVENT, dev.id, now_ts, extra=json.dumps(ev).encode())
+
+        except Exception:
+            print("处理经纬度时异常：")
+            traceback.print_exc()
 
 # ---------- HTTP 服务 ----------
+def render_metrics():
+    """/metrics：Prometheus 文本格式，汇总各处已有的计数和直方图。"""
+    out = []
+
+    def metric(name, typ, help_text, samples):
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {typ}")
+        for labels, value in samples:
+            out.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+    def histogram(name, help_text, items):
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} histogram")
+        for labels, hist in items:
+            out.extend(hist.render(name, labels))
+
+    st = ingest_stats
+    metric("track_tcp_connections_total", "counter", "DTU TCP 连接累计数", [("", st.connections)])
+    metric("track_tcp_connections_active", "gauge", "当前 DTU TCP 连接数", [("", st.active)])
+    metric("track_http_connections_total", "counter", "HTTP 连接累计数", [("", http_stats.connections)])
+    metric("track_http_connections_active", "gauge", "当前处理中的 HTTP 连接数（含 /stream）", [("", http_stats.active)])
+    metric("track_stream_subscribers", "gauge", "当前 /stream 订阅者数", [("", len(subscribers))])
+    metric("track_lines_total", "counter", "收到的 JSON 行", [("", st.lines)])
+    metric("track_lines_overlong_total", "counter", "超长被丢弃的行", [("", st.overlong)])
+    metric("track_json_errors_total", "counter", "无法解析的 JSON 行", [("", st.bad_json)])
+    metric("track_frames_total", "counter", "收到的二进制帧", [
+        ('result="ok"', st.frames - st.bad_frames - st.dup_frames),
+        ('result="bad"', st.bad_frames), ('result="duplicate"', st.dup_frames)])
+    metric("track_points_total", "counter", "过滤后的点数，按结果和原因类别",
+           [(f'result="{r}",reason="{k}"', n) for (r, k), n in sorted(st.by_reason.items())])
+    metric("track_points_log_suppressed", "gauge", "因限速尚未打印的丢点日志条数", [("", drop_log.suppressed)])
+    metric("track_devices", "gauge", "设备数", [("", len(devices))])
+    metric("track_device_lock_acquired_total", "counter", "设备锁获取次数", [("", lock_stats.acquired)])
+    metric("track_device_lock_contended_total", "counter", "设备锁发生等待的次数", [("", lock_stats.contended)])
+    histogram("track_device_lock_wait_seconds", "设备锁等待时间（只统计发生竞争的获取）", [("", lock_stats.wait)])
+    histogram("track_device_lock_hold_seconds", "设备锁持有时间", [("", lock_stats.hold)])
+    histogram("track_data_encode_seconds", "/data 响应编码耗时（full 含 gzip，按版本缓存）",
+              [(f'kind="{k}"', h) for k, h in data_encode_seconds.items()])
+    histogram("track_data_response_bytes", "/data 响应大小（未压缩）",
+              [(f'kind="{k}"', h) for k, h in data_response_bytes.items()])
+    if store is not None:
+        metric("track_store_rows_written_total", "counter", "写入 SQLite 的行数", [("", store.written)])
+        metric("track_store_rows_dropped_total", "counter", "写队列满被丢弃的行数", [("", store.dropped)])
+        metric("track_store_queue_size", "gauge", "待写队列长度", [("", store.pending())])
+    metric("track_tile_cache_requests_total", "counter", "瓦片缓存查询",
+           [('result="hit"', tile_cache.hits), ('result="miss"', tile_cache.misses)])
+    metric("track_tile_cache_entries", "gauge", "瓦片缓存条数", [("", len(tile_cache.entries))])
+    metric("track_geofences", "gauge", "围栏数", [("", len(geofences.fences))])
+    metric("track_geofence_events_total", "counter", "进出围栏事件数", [("", geofences.event_seq)])
+    metric("track_uptime_seconds", "gauge", "运行时间", [("", int(time.time() - st.started))])
+    return ("\n".join(out) + "\n").encode()
+
 class Handler(SimpleHTTPRequestHandler):
+    def handle(self):
+        http_stats.connections += 1
+        http_stats.active += 1
+        try:
+            super().handle()
+        finally:
+            http_stats.active -= 1
+
+    def send_text(self, text, content_type='text/plain; charset=utf-8'):
+        body = text if isinstance(text, bytes) else text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serve_profile(self, query):
+        """/profile?action=start|stop 开关采样分析器；不带 action 返回当前报告。"""
+        action = query.get('action', [None])[0]
+        if ring is not None:
+            self.serve_ingest_profile(action)
+            return
+        if action == 'start':
+            started = profiler.start()
+            self.send_text("采样分析已开启\n" if started else "采样分析已在运行\n")
+            return
+        if action == 'stop':
+            profiler.stop()
+        elif action is not None:
+            self.send_error(400, "action must be start or stop")
+            return
+        self.send_text(profiler.report())
+
+    def serve_ingest_profile(self, action):
+        """多进程模式：/profile 分析的是接入进程，命令和报告经共享内存转发（报告最多晚 1 秒）。"""
+        if action in ('start', 'stop'):
+            ring.put_control(RING_CTL_PROFILE_START if action == 'start' else RING_CTL_PROFILE_STOP)
+            self.send_text(f"已通知接入进程{'开启' if action == 'start' else '停止'}采样分析，"
+                           "约 1 秒后生效；不带 action 请求 /profile 查看报告\n")
+            return
+        if action is not None:
+            self.send_error(400, "action must be start or stop")
+            return
+        self.send_text(ingest_profile_report or "接入进程尚未开启采样分析\n")
+
+    def serve_tile(self, path, query):
+        """/tiles/z/x/y?device=&from=&to=：历史轨迹瓦片，折线为瓦片内整数坐标的 encoded polyline。"""
+        if store is None:
+            self.send_error(404, "history store disabled")
+            return
+        try:
+            z, x, y = (int(v) for v in path[len('/tiles/'):].split('/'))
+            t_from = float(query['from'][0]) if 'from' in query else None
+            t_to = float(query['to'][0]) if 'to' in query else None
+        except ValueError:
+            self.send_error(400, "expected /tiles/z/x/y with numeric from/to")
+            return
+        if not (TILE_MIN_ZOOM <= z <= TILE_MAX_ZOOM and 0 <= x < (1 << z) and 0 <= y < (1 << z)):
+            self.send_error(400, "tile out of range")
+            return
+        # 历史里可能有当前不在内存中的设备，指定了就直接按 ID 查
+        dev_id = query.get('device', [None])[0]
+        if not dev_id:
+            dev = default_device()
+            if dev is None:
+                self.send_error(404, "no such device")
+                return
+            dev_id = dev.id
+        self.send_cached(tile_response(dev_id, z, x, y, t_from, t_to))
+
+    def serve_segments(self, kind, query):
+        """/stays、/trips：预先算好的停留/行程汇总，?device=&from=&to=&limit=。"""
+        dev_id = query.get('device', [None])[0]
+        dev = get_device(dev_id, create=False) if dev_id else default_device()
+        try:
+            start = float(query['from'][0]) if 'from' in query else None
+            end = float(query['to'][0]) if 'to' in query else None
+            limit = int(query.get('limit', ['50'])[0])
+        except ValueError:
+            self.send_error(400, "from/to/limit must be numbers")
+            return
+        if dev is None:
+            self.send_json({"device": dev_id, kind: []})
+            return
+        with dev.lock:
+            records = dev.segments.records(kind, start, end, limit)
+        self.send_json({"device": dev.id, kind: records})
+
+    def send_json(self, obj):
+        self.send_body(json.dumps(obj).encode())
+
+    def send_body(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_cached(self, cache):
+        """发送缓存的全量响应，支持 If-None-Match -> 304 和 gzip。"""
+        version, etag, body, gz = cache
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        if gz is not None and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gz
+            encoding = 'gzip'
+        else:
+            encoding = None
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serve_history(self, query):
+        """按时间范围导出历史点：/history?from=&to=&device=（Unix 秒），边查边写。"""
+        if store is None:
+            self.send_error(404, "history store disabled")
+            return
+        try:
+            t_from = float(query['from'][0]) if 'from' in query else None
+            t_to = float(query['to'][0]) if 'to' in query else None
+            limit = int(query['limit'][0]) if 'limit' in query else None
+        except ValueError:
+            self.send_error(400, "from/to/limit must be numbers")
+            return
+        device = query.get('device', [None])[0]
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            out = self.wfile
+            out.write(b'[')
+            first = True
+            for dev_id, ts, lat, lon, speed_kmh, alt, sats in store.query(device, t_from, t_to, limit):
+                row = json.dumps({"device": dev_id, "ts": ts, "lat": lat, "lon": lon,
+                                  "speed_kmh": speed_kmh, "alt": alt, "sats": sats})
+                out.write((row if first else ',' + row).encode())
+                first = False
+            out.write(b']')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def serve_stream(self, query):
+        """Server-Sent Events：先补发 since 之后的变化，再实时推送每个新事件。"""
+        dev_id = query.get('device', [None])[0]
+        dev = get_device(dev_id, create=False) if dev_id else default_device()
+        if dev is None:
+            self.send_error(404, "unknown device")
+            return
+        try:
+            since = cursor_in(int(query.get('since', ['0'])[0]))
+        except ValueError:
+            since = 0
+
+        # 先订阅再取快照，保证补发与实时事件之间没有缺口（浏览器按 cursor 去重）
+        sub = subscribe(dev.id)
+        try:
+            _, first = dev.snapshot_json(since)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('X-Accel-Buffering', 'no')
+            self.end_headers()
+            self.wfile.write(b"data: " + first + b"\n\n")
+            self.wfile.flush()
+            while True:
+                events, overflow = sub.take(STREAM_KEEPALIVE)
+                if overflow:
+                    # 积压被丢弃：通知浏览器改为拉一次全量后重连
+                    self.wfile.write(b"event: reset\ndata: {}\n\n")
+                    self.wfile.flush()
+                    return
+                if not events:
+                    self.wfile.write(b": ping\n\n")
+                for data in events:
+                    self.wfile.write(b"data: " + data + b"\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            unsubscribe(sub)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+
+    def sync_geofences(self):
+        """多进程模式：修改前先读入别的进程刚写的 geofences.json，尽量不覆盖它们的修改。"""
+        if ring is not None:
+            reload_geofences_if_changed()
+
+    def save_geofences(self):
+        if GEOFENCE_FILE:
+            try:
+                geofences.save(GEOFENCE_FILE)
+            except OSError:
+                print("保存围栏失败：")
+                traceback.print_exc()
+
+    def do_POST(self):
+        """POST /geofences 新建（body 可带 id 覆盖同名围栏）；POST /geofences/<id> 替换。"""
+        url = urlsplit(self.path)
+        if url.path == '/geofences':
+            fence_id = None
+        elif url.path.startswith('/geofences/'):
+            fence_id = unquote(url.path[len('/geofences/'):])
+        else:
+            self.send_error(404)
+            return
+        try:
+            spec = self.read_json()
+            if not isinstance(spec, dict):
+                raise ValueError("body must be a JSON object")
+            self.sync_geofences()
+            fence = geofences.put(spec, fence_id)
+        except (ValueError, KeyError, TypeError, IndexError, OverflowError) as e:
+            self.send_error(400, f"invalid geofence: {e}")
+            return
+        self.save_geofences()
+        self.send_json(fence.to_dict())
+
+    def do_DELETE(self):
+        url = urlsplit(self.path)
+        if not url.path.startswith('/geofences/'):
+            self.send_error(404)
+            return
+        fence_id = unquote(url.path[len('/geofences/'):])
+        try:
+            self.sync_geofences()
+            deleted = geofences.delete(fence_id)
+        except (ValueError, KeyError, TypeError, IndexError, OverflowError) as e:
+            self.send_error(400, f"cannot delete geofence: {e}")
+            return
+        if not deleted:
+            self.send_error(404, "no such geofence")
+            return
+        self.save_geofences()
+        self.send_json({"deleted": fence_id})
+
     def do_GET(self):
         try:
-            if self.path.startswith('/data'):
-                with lock:
-                    out = {"latest": latest, "trail": list(trail)}
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json; charset=utf-8')
-                self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-                self.end_headers()
-                self.wfile.write(json.dumps(out).encode())
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+
+            if url.path == '/stats':
+                self.send_json(ingest_stats.snapshot())
+                return
+
+            if url.path == '/metrics':
+                self.send_text(render_metrics(), 'text/plain; version=0.0.4; charset=utf-8')
+                return
+
+            if url.path == '/profile':
+                self.serve_profile(query)
+                return
+
+            if url.path == '/devices':
+                with devices_lock:
+                    devs = list(devices.values())
+                out = []
+                for dev in devs:
+                    with dev.lock:
+                        out.append({"id": dev.id, "latest": dict(dev.latest),
+                                    "points": len(dev.trail), "updated": dev.updated})
+                self.send_json(out)
+                return
+
+            if url.path == '/history':
+                self.serve_history(query)
+                return
+
+            if url.path == '/geofences':
+                self.send_json(geofences.list())
+                return
+
+            if url.path.startswith('/geofences/'):
+                fence = geofences.get(unquote(url.path[len('/geofences/'):]))
+                if fence is None:
+                    self.send_error(404, "no such geofence")
+                else:
+                    self.send_json(fence)
+                return
+
+            if url.path == '/geofence-events':
+                try:
+                    since = int(query.get('since', ['0'])[0])
+                    limit = int(query.get('limit', ['1000'])[0])
+                except ValueError:
+                    self.send_error(400, "since/limit must be integers")
+                    return
+                if limit < 1:
+                    self.send_error(400, "limit must be at least 1")
+                    return
+                cursor, events = geofences.events_since(since, query.get('device', [None])[0], limit)
+                self.send_json({"cursor": cursor, "events": events})
+                return
+
+            if url.path.startswith('/tiles/'):
+                self.serve_tile(url.path, query)
+                return
+
+            if url.path in ('/stays', '/trips'):
+                self.serve_segments(url.path[1:], query)
+                return
+
+            if url.path == '/stream':
+                self.serve_stream(query)
+                return
+
+            if url.path == '/data':
+                dev_id = query.get('device', [None])[0]
+                dev = get_device(dev_id, create=False) if dev_id else default_device()
+                if dev is None:
+                    self.send_json({"device": dev_id, "latest": None, "trail": []})
+                    return
+                try:
+                    since = cursor_in(int(query.get('since', ['0'])[0]))
+                except ValueError:
+                    since = 0
+                # 只序列化被选中的设备，其他设备的上报不受影响
+                try:
+                    # 地图的缩放级别可能带小数，取整数部分
+                    zoom = int(float(query['zoom'][0])) if 'zoom' in query else None
+                    tolerance = float(query['tolerance'][0]) if 'tolerance' in query else None
+                except (ValueError, OverflowError):
+                    self.send_error(400, "zoom/tolerance must be numbers")
+                    return
+                if zoom is not None and not 0 <= zoom <= MAX_ZOOM:
+                    self.send_error(400, f"zoom must be between 0 and {MAX_ZOOM}")
+                    return
+                if tolerance is not None and not math.isfinite(tolerance):
+                    self.send_error(400, "tolerance must be a finite number")
+                    return
+                lod = dev.lod_for(zoom, tolerance)
+                if lod is None and dev.valid_cursor(since):
+                    t0 = time.perf_counter()
+                    body = dev.snapshot_json(since)[1]
+                    data_encode_seconds["since"].observe(time.perf_counter() - t0)
+                    data_response_bytes["since"].observe(len(body))
+                    self.send_body(body)
+                else:
+                    self.send_cached(dev.full_response(lod))
                 return
 
             # 返回地图页面（高德）
@@ -226,10 +2729,12 @@ class Handler(SimpleHTTPRequestHandler):
                 body,html{margin:0;height:100%}
                 #map{width:100%;height:100%}
                 #info{position:absolute;top:10px;left:10px;background:#fff;padding:10px;border-radius:5px;box-shadow:0 2px 5px rgba(0,0,0,0.3);z-index:999;font-size:14px;max-width:200px;}
+                #history{position:absolute;top:10px;right:10px;background:#fff;padding:6px 10px;border-radius:5px;box-shadow:0 2px 5px rgba(0,0,0,0.3);z-index:999;font-size:14px;}
             </style>
             </head><body>
             <div id="map"></div>
             <div id="info">等待数据...</div>
+            <label id="history"><input type="checkbox" id="historyToggle"> 全部历史轨迹</label>
             <script>
             var map = new AMap.Map('map', {zoom:17});
             var polyline = new AMap.Polyline({strokeColor:"#3366FF", strokeWeight:6, lineJoin:'round'});
@@ -240,72 +2745,225 @@ class Handler(SimpleHTTPRequestHandler):
             offset: new AMap.Pixel(-10,-25)});
             carMarker.setMap(map);
 
-            var stopMarkers = [];
+            var stopMarkers = {};   // 停留 id -> marker，数据来自服务器分段好的 /stays
+            var stopCount = 0;
             var infoWindow = new AMap.InfoWindow({offset: new AMap.Pixel(0, -30)});
 
-            function clearStopMarkers(){
-                for(var i=0;i<stopMarkers.length;i++){
-                    try{ stopMarkers[i].setMap(null); }catch(e){}
+            // 增量轨迹：每次只拿 cursor 之后新增/变化的点，新点以一段新折线追加到地图上
+            var cursor = 0, curDevice = null;
+            var points = [];        // 已显示的轨迹点（按 seq 递增）
+            var segments = [];      // 追加出来的折线段
+            var MAX_SEGMENTS = 50;  // 段数过多时合并成一条
+
+            function resetMap(){
+                segments.forEach(s => s.setMap(null));
+                segments = [];
+                for(var k in stopMarkers){
+                    try{ stopMarkers[k].setMap(null); }catch(e){}
                 }
-                stopMarkers = [];
+                stopMarkers = {}; stopCount = 0; staysLoaded = 0;
+                points = []; cursor = 0;
+                polyline.setPath([]);
             }
 
-            function update() {
-                fetch('/data').then(r=>r.json()).then(d=>{
-                    var trail = d.trail;
-                    var latest = d.latest;
-                    if(!trail || trail.length===0) return;
-
-                    var path = trail.map(p => [p.lon, p.lat]);
-                    polyline.setPath(path);
-                    carMarker.setPosition(path[path.length-1]);
-
-                    clearStopMarkers();
-
-                    trail.forEach(p => {
-                        if(p.duration_str && p.duration_str !== "0秒" && p.duration_str !== "0分0秒"){
-                            var markerContent = `<div style="background:red;width:8px;height:8px;border-radius:50%;border:2px solid white;box-shadow:0 0 3px #000;"></div>`;
-                            var marker = new AMap.Marker({
-                                position: [p.lon, p.lat],
-                                content: markerContent,
-                                offset: new AMap.Pixel(-6, -6),
-                                anchor: 'center'
+            function fmtTime(ts){
+                return new Date(ts * 1000).toLocaleString();
+            }
+
+            function updateStopMarker(st){
+                var marker = stopMarkers[st.id];
+                if(marker){ marker.setExtData(st); return; }
+                var markerContent = `<div style="background:red;width:8px;height:8px;border-radius:50%;border:2px solid white;box-shadow:0 0 3px #000;"></div>`;
+                marker = new AMap.Marker({
+                    position: [st.lon, st.lat],
+                    content: markerContent,
+                    offset: new AMap.Pixel(-6, -6),
+                    anchor: 'center',
+                    extData: st
+                });
+                marker.on('click', function(e){
+                    var s = e.target.getExtData();
+                    infoWindow.setContent(`
+                        <div style="font-size:14px;">
+                            <b>停留点详情</b>${s.ongoing ? "（停留中）" : ""}<br>
+                            开始时间: ${fmtTime(s.start_ts)}<br>
+                            结束时间: ${s.ongoing ? "-" : fmtTime(s.end_ts)}<br>
+                            停留时长: <span style="color:red;font-weight:bold">${s.duration_str}</span>
+                        </div>
+                    `);
+                    infoWindow.open(map, e.target.getPosition());
+                });
+                marker.setMap(map);
+                stopMarkers[st.id] = marker;
+            }
+
+            // 停留点只有几十条汇总记录，最多每 10 秒刷新一次
+            var staysLoaded = 0;
+            function loadStays(){
+                if(!curDevice || Date.now() - staysLoaded < 10000) return;
+                staysLoaded = Date.now();
+                fetch('/stays?limit=200&device=' + encodeURIComponent(curDevice)).then(r=>r.json()).then(d=>{
+                    if(d.device !== curDevice) return;
+                    var keep = {};
+                    (d.stays || []).forEach(st => { keep[st.id] = true; updateStopMarker(st); });
+                    for(var k in stopMarkers){
+                        if(!keep[k]){ stopMarkers[k].setMap(null); delete stopMarkers[k]; }
+                    }
+                    stopCount = (d.stays || []).length;
+                }).catch(function(e){ console.log("fetch /stays 出错:", e); });
+            }
+
+            function appendTrail(trail){
+                var added = [];
+                trail.forEach(p => {
+                    var last = points[points.length-1];
+                    if(last && p.seq <= last.seq){
+                        // 已有点的停留时长更新：替换成新的数据
+                        if(p.seq === last.seq) points[points.length-1] = p;
+                    } else {
+                        points.push(p);
+                        added.push([p.lon, p.lat]);
+                    }
+                });
+                if(added.length === 0) return;
+                if(segments.length >= MAX_SEGMENTS){
+                    // 合并已有的段，偶尔一次 setPath，避免折线对象无限增长
+                    polyline.setPath(points.map(p => [p.lon, p.lat]));
+                    segments.forEach(s => s.setMap(null));
+                    segments = [];
+                } else {
+                    var prev = points.length > added.length ? points[points.length-added.length-1] : null;
+                    var seg = prev ? [[prev.lon, prev.lat]].concat(added) : added;
+                    if(seg.length >= 2){
+                        var pl = new AMap.Polyline({path: seg, strokeColor:"#3366FF", strokeWeight:6, lineJoin:'round'});
+                        pl.setMap(map);
+                        segments.push(pl);
+                    }
+                }
+                carMarker.setPosition(added[added.length-1]);
+            }
+
+            // 全部历史轨迹：按瓦片从 /tiles 加载，只取视野内的，服务器端已裁剪、量化并缓存
+            var historyLayer = null;
+
+            function decodeLine(str){
+                var pts = [], i = 0, x = 0, y = 0;
+                while(i < str.length){
+                    for(var k = 0; k < 2; k++){
+                        var shift = 0, v = 0, b;
+                        do { b = str.charCodeAt(i++) - 63; v |= (b & 0x1f) << shift; shift += 5; } while(b >= 0x20);
+                        var d = (v & 1) ? ~(v >> 1) : (v >> 1);
+                        if(k === 0) x += d; else y += d;
+                    }
+                    pts.push([x, y]);
+                }
+                return pts;
+            }
+
+            function showHistory(on){
+                if(historyLayer){ historyLayer.setMap(null); historyLayer = null; }
+                if(!on || !curDevice) return;
+                var dev = encodeURIComponent(curDevice);
+                historyLayer = new AMap.TileLayer.Flexible({
+                    cacheSize: 256, zIndex: 110, opacity: 0.7,
+                    createTile: function(x, y, z, success, fail){
+                        var canvas = document.createElement('canvas');
+                        canvas.width = canvas.height = 256;
+                        fetch('/tiles/' + z + '/' + x + '/' + y + '?device=' + dev).then(r=>{
+                            if(!r.ok) throw new Error(r.status);
+                            return r.json();
+                        }).then(t=>{
+                            var ctx = canvas.getContext('2d'), k = 256 / t.extent;
+                            ctx.strokeStyle = '#7a5cff'; ctx.lineWidth = 3; ctx.lineJoin = 'round';
+                            t.lines.forEach(str=>{
+                                var pts = decodeLine(str);
+                                ctx.beginPath();
+                                pts.forEach((p, i)=>{ if(i) ctx.lineTo(p[0]*k, p[1]*k); else ctx.moveTo(p[0]*k, p[1]*k); });
+                                ctx.stroke();
                             });
-                            marker.on('click', (function(pt){
-                                return function(e){
-                                    infoWindow.setContent(`
-                                        <div style="font-size:14px;">
-                                            <b>停留点详情</b><br>
-                                            开始时间: ${pt.time_str}<br>
-                                            停留时长: <span style="color:red;font-weight:bold">${pt.duration_str}</span><br>
-                                            海拔: ${pt.alt} 米<br>
-                                            卫星数: ${pt.sats} 颗
-                                        </div>
-                                    `);
-                                    infoWindow.open(map, e.target.getPosition());
-                                };
-                            })(p));
-                            marker.setMap(map);
-                            stopMarkers.push(marker);
-                        }
-                    });
-
-                    document.getElementById('info').innerHTML = `
-                        <b>当前状态: ${latest.stay_duration==="移动中"?"行驶中":"<span style='color:red'>停留</span>"}</b><br>
-                        当前停留: ${latest.stay_duration}<br>
-                        速度: ${latest.speed_kmh} km/h<br>
-                        时间: ${latest.time}<br>
-                        海拔: ${latest.alt} 米<br>
-                        卫星数: ${latest.sats} 颗<br>
-                        历史停留点: ${stopMarkers.length} 个
-                    `;
-
-                    if(!window.inited) { map.setFitView(); window.inited=true; }
+                            success(canvas);
+                        }).catch(function(){ fail(); });
+                    }
+                });
+                historyLayer.setMap(map);
+            }
+            document.getElementById('historyToggle').addEventListener('change', function(e){ showHistory(e.target.checked); });
+
+            // 多设备：地图页面地址加 ?device=设备ID 查看指定设备，不加则显示最近上报的设备
+            var deviceId = new URLSearchParams(location.search).get('device');
+            var dataUrl = '/data?' + (deviceId ? 'device=' + encodeURIComponent(deviceId) + '&' : '');
+
+            function apply(d){
+                var latest = d.latest;
+                if(!latest) return;
+                if(d.reset || d.device !== curDevice){
+                    resetMap();
+                    var changed = d.device !== curDevice;
+                    curDevice = d.device;
+                    if(changed && historyLayer) showHistory(true);
+                } else if(d.cursor <= cursor){
+                    return;  // 推送与补发重叠的旧事件
+                }
+                appendTrail(d.trail || []);
+                cursor = d.cursor;
+                loadStays();
+                if(points.length === 0) return;
+
+                document.getElementById('info').innerHTML = `
+                    设备: ${d.device}<br>
+                    <b>当前状态: ${latest.stay_duration==="移动中"?"行驶中":"<span style='color:red'>停留</span>"}</b><br>
+                    当前停留: ${latest.stay_duration}<br>
+                    速度: ${latest.speed_kmh} km/h<br>
+                    时间: ${latest.time}<br>
+                    海拔: ${latest.alt} 米<br>
+                    卫星数: ${latest.sats} 颗<br>
+                    历史停留点: ${stopCount} 个
+                `;
 
+                if(!window.inited) { map.setFitView(); window.inited=true; }
+            }
+
+            // 优先使用服务器推送（/stream）；不支持或断开时退回 2 秒轮询，轮询成功后再尝试推送
+            var stream = null;
+
+            function openStream(){
+                stream = new EventSource('/stream?device=' + encodeURIComponent(curDevice) + '&since=' + cursor);
+                stream.onmessage = function(e){ apply(JSON.parse(e.data)); };
+                stream.addEventListener('reset', function(){
+                    // 页面处理太慢被服务器丢弃了积压：拉一次全量再重连
+                    closeStream(); cursor = 0; update();
+                });
+                stream.onerror = function(){ closeStream(); setTimeout(update, 2000); };
+            }
+
+            function closeStream(){
+                if(stream){ stream.close(); stream = null; }
+            }
+
+            // 首次加载和缩放后按当前缩放级别拉抽稀过的轨迹，之后只追加新点
+            function dataQuery(){
+                return cursor ? 'since=' + cursor : 'zoom=' + map.getZoom();
+            }
+
+            var zoomTimer = null;
+            map.on('zoomend', function(){
+                clearTimeout(zoomTimer);
+                zoomTimer = setTimeout(function(){
+                    if(!curDevice) return;
+                    fetch(dataUrl + 'zoom=' + map.getZoom()).then(r=>r.json()).then(apply)
+                        .catch(function(e){ console.log("fetch /data 出错:", e); });
+                }, 300);
+            });
+
+            function update() {
+                fetch(dataUrl + dataQuery()).then(r=>r.json()).then(d=>{
+                    apply(d);
+                    if(window.EventSource && curDevice){ openStream(); return; }
+                    setTimeout(update, 2000);
                 }).catch(function(e){
                     console.log("fetch /data 出错:", e);
+                    setTimeout(update, 2000);
                 });
-                setTimeout(update, 2000);
             }
             update();
             </script></body></html>
@@ -329,5 +2987,309 @@ class ThreadingTCPServer(ThreadingMixIn, TCPServer):
     daemon_threads = True
     allow_reuse_address = True
 
-print(f"HTTP server listening on 0.0.0.0:{HTTP_PORT}")
-ThreadingTCPServer(('0.0.0.0', HTTP_PORT), Handler).serve_forever()
+class ReusePortHTTPServer(ThreadingTCPServer):
+    """多个 HTTP worker 进程绑定同一个端口（SO_REUSEPORT），由内核按连接分给各进程。"""
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+# ---------- 多进程模式（共享内存环形缓冲） ----------
+# HTTP_WORKERS > 0 时主进程只做接入，HTTP 由多个 worker 进程处理，/data 的编码压缩、
+# 大量 /stream 连接都不再和接入抢同一个 GIL。接入进程把状态变化写成定长记录放进一块
+# mmap 共享内存，worker 轮询读取后在自己的内存里重放（add_point 等），不经过 pickle 和管道。
+#
+# 共享内存布局（小端）：
+#   头部   cursor(Q) 最后写入的记录序号  control(Q) worker 发给接入进程的命令（/profile）
+#          stats_ver(Q) stats_len(I)  接入统计 JSON（RING_STATS_MAX 字节）
+#   记录   RING_SLOTS 个，每个 RING_RECORD 字节，序号 seq 写在第 seq % RING_SLOTS 个：
+#          stamp(Q)=seq  kind(B)  ts lat lon a b(d)  sats(i)  ver(q)  id_len(B)  extra_len(H)  id(64s)  extra
+#   kind   RING_POINT  被接受的点，a=速度 b=海拔，ver=接入进程里设备的新 version，extra 为原始上报 JSON
+#          RING_DROP   被过滤掉的点，只更新 latest 的时间和 version
+#          RING_EVENT  围栏事件，extra 为事件 JSON
+#          RING_STORED 已提交到 SQLite 的点，a/b 为线段起点（NaN 表示没有），worker 据此让瓦片失效
+# 写入时先把 stamp 清零、写内容、再写 stamp 和 cursor；读者复制记录前后各检查一次 stamp，
+# 落后超过一圈被覆盖的记录能发现并跳过。
+RING_POINT, RING_DROP, RING_EVENT, RING_STORED = 1, 2, 3, 4
+RING_RECORD = 512
+_RING_HEAD = struct.Struct('<QQQI')
+RING_CTL_PROFILE_START, RING_CTL_PROFILE_STOP = 1, 2
+_RING_REC = struct.Struct('<QBdddddiqBH64s')
+_RING_STAMP = struct.Struct('<Q')
+RING_EXTRA_MAX = RING_RECORD - _RING_REC.size
+
+class ShmRing:
+    """
+    单写多读的共享内存环形缓冲。写端是接入进程（ingest 线程和 SQLite 写线程，用 self.lock 串行），
+    读端是各 HTTP worker，读不加锁、不影响写端。
+    """
+
+    def __init__(self, path, create=False):
+        self.path = path
+        self.slots = RING_SLOTS
+        self.base = _RING_HEAD.size + RING_STATS_MAX
+        size = self.base + self.slots * RING_RECORD
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT | os.O_TRUNC if create else 0), 0o600)
+        try:
+            if create:
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.lock = threading.Lock()
+        self.written = self.cursor()
+
+    def cursor(self):
+        return _RING_STAMP.unpack_from(self.mm, 0)[0]
+
+    def put(self, kind, dev_id, ts, lat=0.0, lon=0.0, a=0.0, b=0.0, sats=0, extra=b"", ver=0):
+        idb = dev_id.encode()[:64]
+        if len(extra) > RING_EXTRA_MAX:
+            extra = b""  # 放不下的附加字段不传，点本身照常同步
+        mm = self.mm
+        with self.lock:
+            seq = self.written + 1
+            off = self.base + (seq % self.slots) * RING_RECORD
+            _RING_STAMP.pack_into(mm, off, 0)
+            _RING_REC.pack_into(mm, off, 0, kind, ts, lat, lon, a, b, sats, ver, len(idb), len(extra), idb)
+            if extra:
+                mm[off + _RING_REC.size:off + _RING_REC.size + len(extra)] = extra
+            _RING_STAMP.pack_into(mm, off, seq)
+            _RING_STAMP.pack_into(mm, 0, seq)
+            self.written = seq
+
+    def read(self, seq):
+        """(kind, ts, lat, lon, a, b, sats, ver, 设备 id, extra)；记录已被覆盖时返回 None。"""
+        off = self.base + (seq % self.slots) * RING_RECORD
+        raw = self.mm[off:off + RING_RECORD]
+        if _RING_STAMP.unpack_from(self.mm, off)[0] != seq:
+            return None
+        rec = _RING_REC.unpack_from(raw)
+        if rec[0] != seq:
+            return None
+        n = _RING_REC.size
+        return rec[1:9] + (rec[11][:rec[9]].decode(errors="ignore"), raw[n:n + rec[10]])
+
+    def put_stats(self, data):
+        """写入接入统计快照；超过 RING_STATS_MAX 的不写（会覆盖后面的记录），返回 False。"""
+        if len(data) > RING_STATS_MAX:
+            return False
+        mm = self.mm
+        n = _RING_HEAD.size
+        with self.lock:
+            ver = _RING_HEAD.unpack_from(mm, 0)[2] + 1
+            struct.pack_into('<QI', mm, 16, 0, 0)  # 版本 0 表示正在写
+            mm[n:n + len(data)] = data
+            struct.pack_into('<QI', mm, 16, ver, len(data))
+        return True
+
+    def get_stats(self, known_ver):
+        """(版本, 统计 JSON bytes)；没有更新或正在写时 bytes 为 None。"""
+        _, _, ver, length = _RING_HEAD.unpack_from(self.mm, 0)
+        if ver == 0 or ver == known_ver:
+            return known_ver, None
+        n = _RING_HEAD.size
+        data = self.mm[n:n + length]
+        if _RING_HEAD.unpack_from(self.mm, 0)[2] != ver:
+            return known_ver, None
+        return ver, data
+
+    def put_control(self, action):
+        """worker 发命令给接入进程：低 2 位是命令，高位取纳秒时间戳，每次写入的值都不同。"""
+        _RING_STAMP.pack_into(self.mm, 8, (time.time_ns() << 2) | action)
+
+    def control(self):
+        return _RING_STAMP.unpack_from(self.mm, 8)[0]
+
+    def close(self):
+        self.mm.close()
+
+ring = None  # 多进程模式下的 ShmRing（接入进程写、worker 读），单进程模式为 None
+
+def ring_path():
+    """共享内存文件：Linux 上放在 /dev/shm（tmpfs），否则放在临时目录。"""
+    d = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(d, f"track-ring-{os.getpid()}")
+
+def ring_stats_blob():
+    s = {"ingest": ingest_stats.export()}
+    if store is not None:
+        s["store"] = [store.written, store.dropped, store.pending()]
+    blob = json.dumps(s).encode()
+    if profiler.running or profiler.samples:
+        # 报告的长度没有上限（例如线程很多），放不下时截短，保证整个快照不超过 RING_STATS_MAX
+        report = profiler.report()
+        while report:
+            s["profile"] = report
+            with_profile = json.dumps(s).encode()
+            if len(with_profile) <= RING_STATS_MAX:
+                return with_profile
+            report = report[:len(report) // 2].rpartition("\n")[0] + "\n（报告太长，已截断）\n"
+            if len(report) < 64:
+                break
+    return blob
+
+_geofence_mtime = None
+ingest_profile_report = None  # HTTP worker：接入进程最近一次的采样分析报告
+
+def reload_geofences_if_changed():
+    """多进程模式：geofences.json 被某个进程改写后，其余进程重新加载。"""
+    global _geofence_mtime
+    if not GEOFENCE_FILE:
+        return
+    try:
+        mtime = os.stat(GEOFENCE_FILE).st_mtime_ns
+    except FileNotFoundError:
+        mtime = 0
+    if mtime != _geofence_mtime:
+        _geofence_mtime = mtime
+        try:
+            geofences.reload(GEOFENCE_FILE)
+        except (ValueError, KeyError, TypeError, IndexError):
+            print("重新加载围栏失败：")
+            traceback.print_exc()
+
+def apply_ring_record(rec, restored):
+    """在 HTTP worker 里重放一条记录；restored 为启动时从 SQLite 恢复到的 {设备: 最后时间}。"""
+    kind, ts, lat, lon, a, b, sats, ver, dev_id, extra = rec
+    if kind == RING_POINT:
+        dev = get_device(dev_id)
+        if restored and ts <= restored.get(dev_id, -1.0):
+            dev.adopt_version(ver)  # 启动时已经从 SQLite 恢复过，只对齐 version
+            return
+        if not dev.ring_synced:
+            dev.adopt_version(ver - 1)
+        since = dev.version
+        dev.add_point(lat, lon, a, b, sats, ts, json.loads(extra) if extra else None, ver)
+        publish(dev, since)
+    elif kind == RING_DROP:
+        dev = get_device(dev_id)
+        if not dev.ring_synced:
+            dev.adopt_version(ver - 1)
+        with dev.lock:
+            dev.updated = max(dev.updated, ts)
+            dev.latest['time'] = time.strftime("%H:%M:%S", time.localtime(ts))
+            dev.version = ver
+    elif kind == RING_EVENT:
+        if extra:
+            geofences.add_event(json.loads(extra))
+    elif kind == RING_STORED:
+        plat = None if math.isnan(a) else a
+        tile_cache.invalidate([(dev_id, ts, lat, lon, None, None, None, None, plat, b)])
+
+def follow_ring(r, seq, catchup, restored):
+    """
+    HTTP worker 的同步线程：重放 seq 之后的记录，之后每 RING_POLL_INTERVAL 秒读一次新记录。
+    序号不超过 catchup 的点可能已经从 SQLite 恢复，按 restored 里的时间跳过。
+    """
+    global ingest_profile_report
+    stats_ver = 0
+    next_check = 0.0
+    parent = os.getppid()
+    while True:
+        cursor = r.cursor()
+        if cursor - seq > r.slots:
+            print(f"HTTP worker 落后超过 {r.slots} 条记录，跳过 {cursor - r.slots - seq} 条")
+            seq = cursor - r.slots
+        while seq < cursor:
+            seq += 1
+            rec = r.read(seq)
+            if rec is None:
+                continue
+            try:
+                apply_ring_record(rec, restored if seq <= catchup else None)
+            except Exception:
+                print("重放共享内存记录异常：")
+                traceback.print_exc()
+        stats_ver, data = r.get_stats(stats_ver)
+        if data is not None:
+            s = json.loads(data)
+            ingest_stats.load(s["ingest"])
+            ingest_profile_report = s.get("profile")
+            if store is not None and "store" in s:
+                store.written, store.dropped, store.pending_remote = s["store"]
+        now = time.monotonic()
+        if now >= next_check:
+            if os.getppid() != parent:
+                os._exit(0)  # 接入进程已经退出（被强行结束），worker 跟着退出，释放端口
+            reload_geofences_if_changed()
+            next_check = now + 1.0
+        time.sleep(RING_POLL_INTERVAL)
+
+def http_worker(path, index, boot_id, epoch):
+    """HTTP worker 进程入口：从 SQLite 和共享内存重建状态，与其他 worker 共用 HTTP_PORT。"""
+    global store, ring, BOOT_ID, CURSOR_EPOCH
+    # version 由接入进程编号，游标和 ETag 在所有 worker 上一致，请求落到哪个 worker 都能用
+    BOOT_ID, CURSOR_EPOCH = boot_id, epoch
+    ring = ShmRing(path)
+    # 环里还留着的记录全部重放一遍：SQLite 尚未提交的点、最近的围栏事件都在里面
+    start = max(0, ring.cursor() - ring.slots)
+    if STORE_PATH:
+        store = TrackStore(STORE_PATH, readonly=True)
+        restore_from_store()
+    restored = {dev_id: dev.updated for dev_id, dev in list(devices.items())}
+    reload_geofences_if_changed()
+    threading.Thread(target=follow_ring, args=(ring, start, ring.cursor(), restored), daemon=True).start()
+    server = ReusePortHTTPServer(('0.0.0.0', HTTP_PORT), Handler)
+    print(f"HTTP worker {index} (pid {os.getpid()}) listening on 0.0.0.0:{HTTP_PORT}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def start_http_worker(ctx, path, index):
+    p = ctx.Process(target=http_worker, args=(path, index, BOOT_ID, CURSOR_EPOCH), daemon=True)
+    p.start()
+    return p
+
+def main():
+    global store, ring, CURSOR_EPOCH
+    workers = HTTP_WORKERS
+    if workers > 0 and not hasattr(socket, "SO_REUSEPORT"):
+        print("当前系统不支持 SO_REUSEPORT，改用单进程模式")
+        workers = 0
+    if STORE_PATH:
+        store = TrackStore(STORE_PATH)
+        restore_from_store()
+    if GEOFENCE_FILE:
+        print(f"已从 {GEOFENCE_FILE} 加载 {geofences.load(GEOFENCE_FILE)} 个围栏")
+
+    # kill/systemd 停止时也走下面的 finally：写完剩余数据、结束 worker、删除共享内存文件
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    procs = []
+    if workers > 0:
+        # worker 用 spawn 启动（不继承本进程的线程和锁），只通过共享内存文件和 SQLite 取数据
+        ring = ShmRing(ring_path(), create=True)
+        CURSOR_EPOCH = int.from_bytes(os.urandom(3), "little") % 0xfffff + 1
+        ctx = multiprocessing.get_context("spawn")
+        procs = [start_http_worker(ctx, ring.path, i) for i in range(workers)]
+
+    # 启动 TCP 接收线程（内部是一个 asyncio 事件循环，承载所有 DTU 连接）
+    threading.Thread(target=run_tcp_server, daemon=True).start()
+
+    try:
+        if procs:
+            while True:
+                time.sleep(1)
+                for i, p in enumerate(procs):
+                    if not p.is_alive():
+                        print(f"HTTP worker {i} 已退出（exitcode {p.exitcode}），重新启动")
+                        procs[i] = start_http_worker(ctx, ring.path, i)
+        else:
+            print(f"HTTP server listening on 0.0.0.0:{HTTP_PORT}")
+            ThreadingTCPServer(('0.0.0.0', HTTP_PORT), Handler).serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for p in procs:
+            p.terminate()
+            p.join(timeout=5)
+        if store is not None:
+            store.close()
+        if ring is not None:
+            ring.close()
+            os.unlink(ring.path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+# 让测试直接 import 服务器目录下的 success.py
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
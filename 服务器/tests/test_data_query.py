@@ -0,0 +1,61 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import success
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    for i in range(20):
+        success.handle_report({"id": "zoom-test", "lat": 30.0 + i * 1e-3, "lon": 120.0},
+                              ("127.0.0.1", 1), ts=1000.0 + i * 10)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), success.Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def base_url(server_url):
+    return server_url + "/data?device=zoom-test&"
+
+
+def status(url):
+    try:
+        with urllib.request.urlopen(url, timeout=5) as r:
+            json.loads(r.read())
+            return r.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+@pytest.mark.parametrize("zoom", ["0", "17", "17.6", "22"])
+def test_zoom_in_range(base_url, zoom):
+    assert status(base_url + "zoom=" + zoom) == 200
+
+
+@pytest.mark.parametrize("zoom", ["100000", "-10000", "23", "-1", "nan", "inf", "1e400", "x"])
+def test_zoom_out_of_range_is_400(base_url, zoom):
+    assert status(base_url + "zoom=" + zoom) == 400
+
+
+@pytest.mark.parametrize("tolerance", ["nan", "inf", "-inf"])
+def test_non_finite_tolerance_is_400(base_url, tolerance):
+    assert status(base_url + "tolerance=" + tolerance) == 400
+
+
+def test_lod_for_clamps_zoom():
+    dev = success.get_device("zoom-test")
+    assert dev.lod_for(zoom=10 ** 6) == dev.lod_for(zoom=success.MAX_ZOOM)
+    assert dev.lod_for(zoom=-10 ** 6) == dev.lod_for(zoom=0)
+
+
+@pytest.mark.parametrize("limit,code", [("1", 200), ("1000", 200), ("0", 400), ("-5", 400), ("x", 400)])
+def test_geofence_events_limit(server_url, limit, code):
+    assert status(server_url + "/geofence-events?limit=" + limit) == code
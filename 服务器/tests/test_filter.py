@@ -0,0 +1,32 @@
+import math
+
+import success
+
+
+def test_kalman_tracks_a_steady_walk():
+    f = success.KalmanFilter()
+    last = None
+    for i in range(30):
+        ok, lat, lon, kind, _ = f.check(last, 30.0 + i * 1e-5, 120.0, 4.0, 9, 1, 1000.0 + i)
+        assert ok, kind
+        last = (lat, lon, 1000.0 + i)
+    # 偏离 500 米的单个点被当成离群点丢弃
+    ok, _, _, kind, _ = f.check(last, 30.0 + 30e-5 + 0.0045, 120.0, 4.0, 9, 1, 1030.0)
+    assert not ok and kind == "outlier"
+
+
+def test_non_finite_report_never_reaches_filter():
+    dev_id = "nan-test"
+    addr = ("127.0.0.1", 1)
+    success.handle_report({"id": dev_id, "lat": 30.0, "lon": 120.0, "sats": 9}, addr, ts=1000.0)
+    before = success.ingest_stats.by_reason.get(("dropped", "invalid"), 0)
+    for bad in ({"lat": math.nan}, {"lon": math.inf}, {"speed_kmh": math.nan}, {"alt": -math.inf}, {"lat": 95.0}):
+        j = {"id": dev_id, "lat": 30.00001, "lon": 120.0, "sats": 9}
+        j.update(bad)
+        success.handle_report(j, addr, ts=1001.0)
+    assert success.ingest_stats.by_reason[("dropped", "invalid")] == before + 5
+    success.handle_report({"id": dev_id, "lat": 30.00002, "lon": 120.0, "sats": 9}, addr, ts=1002.0)
+    dev = success.get_device(dev_id)
+    assert all(math.isfinite(v) for col in (dev.trail.lat, dev.trail.lon, dev.trail.alt) for v in col)
+    assert math.isfinite(dev.latest["lat"])
+    assert "NaN" not in dev.snapshot_json()[1].decode()
@@ -0,0 +1,182 @@
+# 二进制帧：用 ESP32/main.py 里的编码函数生成帧，经 DtuProtocol 解析，检查两边的格式一致
+import ast
+import binascii
+import json
+import os
+import random
+import struct
+
+import pytest
+
+import success
+
+ESP32_MAIN = os.path.join(os.path.dirname(__file__), "..", "..", "ESP32", "main.py")
+ENCODER_NAMES = {"FRAME_MAGIC", "FRAME_FIXES", "FRAME_ACK", "ACK_FRAME_SIZE",
+                 "_clamp", "_fix_ints", "can_delta", "encode_frame", "frame_seq", "frame_ok"}
+SPOOL_NAMES = ENCODER_NAMES | {"RAM_FRAMES", "SPOOL_FILE", "SPOOL_MAX_BYTES", "Spool"}
+
+
+def load_esp32_encoder(device_id=b"esp-test", names=ENCODER_NAMES):
+    """
+    从 ESP32/main.py 中只取出帧编码相关的常量和函数（整个文件要在 MicroPython 上跑，
+    导入时会打开串口），ustruct/ubinascii 用 CPython 的 struct/binascii 代替。
+    """
+    with open(ESP32_MAIN, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    picked = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in names:
+            picked.append(node)
+        elif isinstance(node, ast.Assign) and any(
+                isinstance(t, ast.Name) and t.id in names for t in node.targets):
+            picked.append(node)
+    ns = {"ustruct": struct, "ubinascii": binascii, "uos": os, "print_flush": print,
+          "DEVICE_ID_BYTES": device_id}
+    exec(compile(ast.Module(body=picked, type_ignores=[]), ESP32_MAIN, "exec"), ns)
+    assert names <= set(ns)
+    return ns
+
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = bytearray()
+
+    def get_extra_info(self, name):
+        return ("10.0.0.1", 5000)
+
+    def write(self, data):
+        self.sent += data
+
+    def close(self):
+        pass
+
+
+def feed(proto, data, rnd):
+    """把 data 按随机大小分块写进 DtuProtocol，模拟 TCP 任意切包。"""
+    i = 0
+    while i < len(data):
+        n = min(rnd.randint(1, 300), len(data) - i)
+        proto.get_buffer(n)[:n] = data[i:i + n]
+        proto.buffer_updated(n)
+        i += n
+
+
+def make_fixes(rnd, n, t0):
+    lat, lon = 30.0 + rnd.random(), 120.0 + rnd.random()
+    out = []
+    for i in range(n):
+        out.append((lat + i * 1e-4, lon + i * 1e-4, t0 + i * 5, 10.0 + i, 9, 1, 36.0))
+    return out
+
+
+def test_encoder_matches_decoder():
+    esp = load_esp32_encoder()
+    fixes = make_fixes(random.Random(1), 5, 1_700_000_000)
+    frame = esp["encode_frame"](300, fixes)
+    assert esp["frame_seq"](frame) == 300
+    assert success.frame_length_at(frame, 0, len(frame)) == len(frame)
+    seq, dev_id, decoded = success.decode_fixes(frame[success.FRAME_HEADER_SIZE:-4])
+    assert (seq, dev_id, len(decoded)) == (300, "esp-test", 5)
+    for a, b in zip(fixes, decoded):
+        assert b[0] == pytest.approx(a[0], abs=1e-6) and b[1] == pytest.approx(a[1], abs=1e-6)
+        assert b[2:] == (a[2], pytest.approx(a[3]), a[4], a[5], pytest.approx(a[6]))
+    # 服务器回的确认帧长度与 ESP32 读取确认时假定的一致
+    ack = success.make_frame(success.FRAME_ACK, struct.pack('<H', 300))
+    assert len(ack) == esp["ACK_FRAME_SIZE"] and ack[1] == esp["FRAME_ACK"]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_frames_mixed_with_junk_are_all_received(seed):
+    rnd = random.Random(seed)
+    dev_id = f"esp-junk-{seed}"
+    esp = load_esp32_encoder(dev_id.encode())
+    stream = bytearray()
+    expected = []
+    for seq in range(40):
+        # DTU 的注册包/心跳包：没有换行，可能含 0xA5、0x0A 和 '{'
+        junk = bytes(rnd.choice((0xA5, 0x0A, 0x7B, rnd.randrange(256))) for _ in range(rnd.randint(0, 12)))
+        stream += junk
+        frame = esp["encode_frame"](seq, make_fixes(rnd, rnd.randint(1, 5), 0))
+        stream += frame
+        expected.append(seq)
+        if seq % 10 == 0:
+            stream += json.dumps({"id": dev_id + "-json", "lat": 30.0, "lon": 120.0}).encode() + b"\n"
+    proto = success.DtuProtocol()
+    proto.connection_made(FakeTransport())
+    before = success.ingest_stats.frames - success.ingest_stats.bad_frames
+    feed(proto, bytes(stream), rnd)
+    acks = proto.transport.sent
+    got = [struct.unpack_from('<H', acks, i + 4)[0] for i in range(0, len(acks), 10)]
+    assert got == expected
+    assert success.ingest_stats.frames - success.ingest_stats.bad_frames - before >= 40
+    assert success.get_device(dev_id + "-json", create=False) is not None
+    proto.connection_lost(None)
+
+
+def test_retransmitted_frame_is_acked_but_not_reapplied():
+    esp = load_esp32_encoder(b"esp-dup")
+    frame = esp["encode_frame"](7, make_fixes(random.Random(3), 3, 0))
+    proto = success.DtuProtocol()
+    proto.connection_made(FakeTransport())
+    dup = success.ingest_stats.dup_frames
+    feed(proto, frame + b"\x00junk" + frame, random.Random(0))
+    assert len(proto.transport.sent) == 20
+    assert success.ingest_stats.dup_frames == dup + 1
+    proto.connection_lost(None)
+
+
+def test_corrupted_frame_is_skipped():
+    esp = load_esp32_encoder(b"esp-bad")
+    good = esp["encode_frame"](1, make_fixes(random.Random(4), 2, 0))
+    bad = bytearray(esp["encode_frame"](2, make_fixes(random.Random(5), 2, 0)))
+    bad[10] ^= 0xFF
+    proto = success.DtuProtocol()
+    proto.connection_made(FakeTransport())
+    feed(proto, bytes(bad) + good, random.Random(0))
+    assert struct.unpack_from('<H', proto.transport.sent, 4)[0] == 1
+    assert len(proto.transport.sent) == 10
+    proto.connection_lost(None)
+
+
+def test_spool_skips_truncated_record(tmp_path, monkeypatch):
+    # 写到一半掉电：flash 里留下半条记录，重启后新帧追加在它后面
+    monkeypatch.chdir(tmp_path)
+    esp = load_esp32_encoder(b"esp-spool", SPOOL_NAMES)
+    esp["RAM_FRAMES"] = 2
+    frames = [esp["encode_frame"](seq, make_fixes(random.Random(seq), 3, 0)) for seq in range(1, 8)]
+    spool = esp["Spool"]()
+    for f in frames[:5]:
+        spool.push(f)                # 2 个在内存，3 个在 flash
+    with open(esp["SPOOL_FILE"], "ab") as f:
+        f.write(struct.pack("<H", len(frames[5])) + frames[5][:9])
+    spool = esp["Spool"]()           # 重启：内存里的帧丢了，flash 从头读
+    for f in frames[6:]:
+        spool.push(f)
+    got = []
+    while spool.head() is not None:
+        assert esp["frame_ok"](spool.head())
+        got.append(esp["frame_seq"](spool.head()))
+        spool.pop()
+    assert got == [3, 4, 5, 7]
+    assert spool.corrupt == 1
+    assert not os.path.exists(esp["SPOOL_FILE"])
+
+
+def test_uplink_gives_up_after_max_retries(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    esp = load_esp32_encoder(b"esp-retry", SPOOL_NAMES | {"ACK_TIMEOUT", "ACK_MAX_RETRIES",
+                                                          "BATCH_MAX_WAIT", "BATCH_SIZE", "Uplink"})
+    sent, now = [], [1000]
+    esp.update(ACK_MAX_RETRIES=3, dtu_send=sent.append,
+               dtu_uart=type("Uart", (), {"any": lambda self: 0})(),
+               urandom=type("R", (), {"getrandbits": staticmethod(lambda n: 0)}),
+               time=type("T", (), {"time": staticmethod(lambda: now[0])}))
+    up = esp["Uplink"]()
+    for seq in (1, 2):
+        up.spool.push(esp["encode_frame"](seq, make_fixes(random.Random(seq), 2, 0)))
+    for _ in range(6):
+        up.pump()
+        now[0] += esp["ACK_TIMEOUT"]
+    seqs = [esp["frame_seq"](f) for f in sent]
+    assert seqs == [1, 1, 1, 1, 2, 2]      # 首发 + 3 次重发，然后放弃
+    assert up.gave_up == 1
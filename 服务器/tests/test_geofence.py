@@ -0,0 +1,101 @@
+import json
+import math
+
+import pytest
+
+import success
+
+
+def circle(**kw):
+    spec = {"type": "circle", "lat": 30.0, "lon": 120.0, "radius": 200}
+    spec.update(kw)
+    return spec
+
+
+def square(d=0.001):
+    return {"type": "polygon", "points": [[30 - d, 120 - d], [30 - d, 120 + d], [30 + d, 120 + d], [30 + d, 120 - d]]}
+
+
+def test_put_evaluate_delete():
+    g = success.GeofenceEngine()
+    f = g.put(circle(name="home"))
+    p = g.put(square(), "sq")
+    assert (f.id, p.id) == ("1", "sq")
+    events = g.evaluate("d", 30.0, 120.0, 1.0)
+    assert sorted((e["type"], e["fence"]) for e in events) == [("enter", "1"), ("enter", "sq")]
+    assert g.evaluate("d", 30.0, 120.0, 2.0) == []
+    assert g.delete("sq")
+    assert not g.delete("sq")
+    assert g.grid and all("sq" not in ids for ids in g.grid.values())
+    # 删除的围栏不产生 exit，剩下的围栏照常离开
+    assert [(e["type"], e["fence"]) for e in g.evaluate("d", 31.0, 121.0, 3.0)] == [("exit", "1")]
+
+
+def test_replace_moves_index():
+    g = success.GeofenceEngine()
+    g.put(circle(), "a")
+    g.put(circle(lat=40.0, lon=100.0), "a")
+    assert len(g.fences) == 1
+    assert g.evaluate("d", 30.0, 120.0, 1.0) == []
+    assert [e["type"] for e in g.evaluate("d", 40.0, 100.0, 2.0)] == ["enter"]
+
+
+@pytest.mark.parametrize("spec", [
+    circle(radius=math.nan),
+    circle(radius=math.inf),
+    circle(radius=-1),
+    circle(lat=math.nan),
+    circle(lat=91),
+    circle(lon=-180.5),
+    {"type": "polygon", "points": [[30, 120], [30, math.inf], [31, 121]]},
+    {"type": "polygon", "points": [[30, 120], [31, 121]]},
+    {"type": "line"},
+])
+def test_invalid_spec_leaves_engine_unchanged(spec):
+    g = success.GeofenceEngine()
+    g.put(circle(), "keep")
+    before = (dict(g.fences), {k: list(v) for k, v in g.grid.items()}, set(g.large))
+    with pytest.raises((ValueError, TypeError, KeyError)):
+        g.put(spec, "bad")
+    assert (dict(g.fences), {k: list(v) for k, v in g.grid.items()}, set(g.large)) == before
+    assert g.delete("keep")
+
+
+def test_save_load_round_trip_skips_bad_entries(tmp_path, capsys):
+    path = str(tmp_path / "geofences.json")
+    g = success.GeofenceEngine()
+    g.put(circle(name="家"), "a")
+    g.put(square(), "b")
+    g.save(path)
+    data = json.loads(open(path, encoding="utf-8").read())
+    data.append({"id": "nan", "type": "circle", "lat": 30, "lon": 120, "radius": float("nan")})
+    data.append(["not", "a", "dict"])
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+    g2 = success.GeofenceEngine()
+    assert g2.load(path) == 2
+    assert sorted(g2.fences) == ["a", "b"]
+    assert g2.get("a")["name"] == "家"
+    assert "跳过不合法的围栏" in capsys.readouterr().out
+    assert {e["fence"] for e in g2.evaluate("d", 30.0, 120.0, 1.0)} == {"a", "b"}
+
+    # reload 整体替换：文件里删掉的围栏消失，设备也不再算在里面
+    g2.delete("b")
+    g2.save(path)
+    g.reload(path)
+    assert sorted(g.fences) == ["a"]
+
+
+def test_events_since_with_small_limit():
+    eng = success.GeofenceEngine()
+    eng.put(circle())
+    eng.evaluate("d", 30.0, 120.0, 1.0)
+    eng.evaluate("d", 31.0, 120.0, 2.0)
+    cursor, events = eng.events_since(0, limit=0)
+    assert [e["type"] for e in events] == ["enter"] and cursor == events[0]["seq"]
+    assert eng.events_since(cursor, limit=1)[1][0]["type"] == "exit"
+
+
+def test_load_missing_file(tmp_path):
+    assert success.GeofenceEngine().load(str(tmp_path / "none.json")) == 0
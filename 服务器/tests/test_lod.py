@@ -0,0 +1,98 @@
+import math
+import random
+
+import pytest
+
+import success
+
+
+def point_segment_distance(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    seg2 = dx * dx + dy * dy
+    t = 0.0 if seg2 == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / seg2))
+    return math.hypot(px - ax - t * dx, py - ay - t * dy)
+
+
+def max_deviation(xs, ys, keep):
+    worst = 0.0
+    for a, b in zip(keep, keep[1:]):
+        for i in range(a + 1, b):
+            worst = max(worst, point_segment_distance(xs[i], ys[i], xs[a], ys[a], xs[b], ys[b]))
+    return worst
+
+
+def random_walk(seed, n=400):
+    rnd = random.Random(seed)
+    xs, ys = [0.0], [0.0]
+    heading = 0.0
+    for _ in range(n - 1):
+        heading += rnd.gauss(0, 0.3)
+        step = rnd.uniform(0, 15)
+        xs.append(xs[-1] + step * math.cos(heading))
+        ys.append(ys[-1] + step * math.sin(heading))
+    return xs, ys
+
+
+def test_douglas_peucker_straight_line_keeps_endpoints():
+    xs = [float(i) for i in range(50)]
+    assert success.douglas_peucker(xs, [0.0] * 50, 1.0) == [0, 49]
+    assert success.douglas_peucker([1.0, 2.0], [0.0, 0.0], 1.0) == [0, 1]
+
+
+def test_douglas_peucker_keeps_spike():
+    xs = [0.0, 1.0, 2.0, 3.0, 4.0]
+    ys = [0.0, 0.0, 10.0, 0.0, 0.0]
+    assert success.douglas_peucker(xs, ys, 1.0) == [0, 2, 4]
+    assert success.douglas_peucker(xs, ys, 0.5) == [0, 1, 2, 3, 4]
+    assert success.douglas_peucker(xs, ys, 20.0) == [0, 4]
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("tolerance", [2.0, 30.0])
+def test_douglas_peucker_within_tolerance(seed, tolerance):
+    xs, ys = random_walk(seed)
+    keep = success.douglas_peucker(xs, ys, tolerance)
+    assert keep[0] == 0 and keep[-1] == len(xs) - 1 and keep == sorted(set(keep))
+    assert max_deviation(xs, ys, keep) <= tolerance + 1e-9
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("tolerance", [2.0, 30.0])
+def test_lod_level_within_tolerance(seed, tolerance):
+    xs, ys = random_walk(seed)
+    keep = lod_keep(xs, ys, tolerance)
+    assert keep[0] == 0 and keep[-1] == len(xs) - 1 and keep == sorted(set(keep))
+    assert len(keep) < len(xs)
+    assert max_deviation(xs, ys, keep) <= tolerance + 1e-9
+
+
+@pytest.mark.parametrize("tolerance", [2.0, 8.0, 30.0])
+def test_lod_level_out_and_back(tolerance):
+    # 沿同一条路出去 1km 再原路返回 500m：楔形本身挡不住，要靠离锚点的距离往回退来判断
+    xs = [10.0 * i for i in range(101)] + [1000.0 - 10.0 * i for i in range(1, 51)]
+    ys = [0.0] * len(xs)
+    keep = lod_keep(xs, ys, tolerance)
+    assert len(keep) == 3             # 去程、回程各一段
+    assert max_deviation(xs, ys, keep) <= tolerance + 1e-9
+
+
+def lod_keep(xs, ys, tolerance):
+    lod = success.LodLevel(tolerance)
+    for seq, (x, y) in enumerate(zip(xs, ys), start=1):
+        lod.add(seq, x, y)
+    return [s - 1 for s in lod.seqs()]
+
+
+def test_lod_level_prune():
+    lod = success.LodLevel(1.0)
+    for seq in range(1, 11):
+        lod.add(seq, float(seq), 5.0 * (seq % 2))   # 锯齿，每个点都保留
+    assert lod.seqs() == list(range(1, 11))
+    lod.prune(6)
+    assert lod.seqs() == list(range(6, 11))
+
+
+def test_zoom_tolerance_halves_per_level():
+    t10 = success.zoom_tolerance(10, 30.0)
+    assert success.zoom_tolerance(11, 30.0) == pytest.approx(t10 / 2)
+    assert success.zoom_tolerance(0, 0.0) == pytest.approx(success.SIMPLIFY_PIXELS * 156543.03392)
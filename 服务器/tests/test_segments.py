@@ -0,0 +1,77 @@
+import pytest
+
+import success
+
+DEG = 1 / 111195.0   # 约 1 米对应的纬度
+
+
+def drive(seg, lat, ts, n, step_m=100.0, dt=10.0):
+    for _ in range(n):
+        lat += step_m * DEG
+        ts += dt
+        seg.add(lat, 120.0, step_m / dt * 3.6, ts)
+    return lat, ts
+
+
+def park(seg, lat, ts, seconds, dt=30.0):
+    for _ in range(int(seconds // dt)):
+        ts += dt
+        seg.add(lat + 3 * DEG, 120.0, 0.0, ts)
+    return lat, ts
+
+
+def test_trip_stay_trip():
+    seg = success.Segmenter()
+    seg.add(30.0, 120.0, 0.0, 0.0)
+    lat, ts = drive(seg, 30.0, 0.0, 10)
+    assert seg.current_trip() is not None and seg.current_stay() is None
+    lat, ts = park(seg, lat, ts, success.STAY_MIN_SECONDS + 120)
+    stay = seg.current_stay()
+    assert stay is not None and stay["ongoing"]
+    assert len(seg.trips) == 1
+    trip = seg.trips[0]
+    assert trip["distance_m"] == pytest.approx(1000, rel=0.01)
+    assert trip["max_speed_kmh"] == pytest.approx(36.0)
+    lat, ts = drive(seg, lat, ts, 5)
+    assert len(seg.stays) == 1 and seg.current_stay() is None
+    assert seg.stays[0]["duration"] >= success.STAY_MIN_SECONDS
+    assert seg.current_trip()["ongoing"]
+
+    seg.close()
+    assert [r["ongoing"] for r in seg.records("trips")] == [False, False]
+    ids = [r["id"] for r in seg.records("trips")] + [r["id"] for r in seg.records("stays")]
+    assert len(set(ids)) == 3
+
+
+def test_short_stop_is_not_a_stay():
+    seg = success.Segmenter()
+    seg.add(30.0, 120.0, 0.0, 0.0)
+    lat, ts = drive(seg, 30.0, 0.0, 10)
+    lat, ts = park(seg, lat, ts, success.STAY_MIN_SECONDS - 60)   # 红绿灯
+    lat, ts = drive(seg, lat, ts, 10)
+    seg.close()
+    assert list(seg.stays) == []
+    assert len(seg.trips) == 1
+    assert seg.trips[0]["distance_m"] == pytest.approx(2000, rel=0.01)
+
+
+def test_gap_closes_segments():
+    seg = success.Segmenter()
+    lat, ts = drive(seg, 30.0, 0.0, 5)
+    drive(seg, lat, ts + success.TRIP_GAP_SECONDS + 1, 5)
+    assert len(seg.trips) == 1
+    assert seg.current_trip() is not None
+
+
+def test_records_filters_by_time_and_limit():
+    seg = success.Segmenter()
+    lat, ts = 30.0, 0.0
+    for _ in range(3):
+        lat, ts = drive(seg, lat, ts, 5)
+        lat, ts = park(seg, lat, ts, success.STAY_MIN_SECONDS + 60)
+    stays = seg.records("stays")
+    assert len(stays) == 3 and stays[-1]["ongoing"]
+    assert seg.records("stays", limit=1) == stays[-1:]
+    assert seg.records("stays", limit=0) == []
+    assert seg.records("stays", start=stays[1]["end_ts"]) == stays[1:]
+    assert seg.records("stays", end=stays[0]["end_ts"]) == stays[:1]
@@ -0,0 +1,121 @@
+import json
+import math
+
+import pytest
+
+import success
+
+
+@pytest.fixture
+def ring(tmp_path, monkeypatch):
+    monkeypatch.setattr(success, "RING_SLOTS", 8)
+    w = success.ShmRing(str(tmp_path / "ring"), create=True)
+    r = success.ShmRing(w.path)
+    yield w, r
+    w.close(); r.close()
+
+
+def test_records_round_trip(ring):
+    w, r = ring
+    assert r.cursor() == 0
+    w.put(success.RING_POINT, "dev-1", 100.5, 30.1, 120.2, 12.5, 8.0, 9, json.dumps({"t_sent": 1}).encode(), 77)
+    w.put(success.RING_STORED, "dev-1", 101.0, 30.1, 120.2, math.nan, math.nan)
+    assert r.cursor() == 2
+    assert r.read(1) == (success.RING_POINT, 100.5, 30.1, 120.2, 12.5, 8.0, 9, 77, "dev-1", b'{"t_sent": 1}')
+    rec = r.read(2)
+    assert rec[0] == success.RING_STORED and math.isnan(rec[4])
+    # 还没写到的序号
+    assert r.read(3) is None
+
+
+def test_wrap_detects_overwritten_records(ring):
+    w, r = ring
+    for i in range(1, 21):
+        w.put(success.RING_DROP, f"d{i}", float(i))
+    assert r.cursor() == 20
+    # 只有最近一圈（8 条）还能读到，更早的已被覆盖
+    assert [r.read(s) for s in range(1, 13)] == [None] * 12
+    assert [r.read(s)[1] for s in range(13, 21)] == [float(s) for s in range(13, 21)]
+
+
+def test_oversized_extra_is_dropped(ring):
+    w, r = ring
+    w.put(success.RING_POINT, "d", 1.0, extra=b"x" * (success.RING_EXTRA_MAX + 1))
+    w.put(success.RING_POINT, "d", 2.0, extra=b"x" * success.RING_EXTRA_MAX)
+    assert r.read(1)[-1] == b""
+    assert r.read(2)[-1] == b"x" * success.RING_EXTRA_MAX
+
+
+def test_stats_and_control(ring):
+    w, r = ring
+    assert r.get_stats(0) == (0, None)
+    w.put_stats(b'{"a": 1}')
+    ver, data = r.get_stats(0)
+    assert data == b'{"a": 1}'
+    assert r.get_stats(ver) == (ver, None)
+    r.put_control(success.RING_CTL_PROFILE_STOP)
+    assert w.control() & 3 == success.RING_CTL_PROFILE_STOP
+
+
+def test_oversized_stats_are_refused(ring):
+    w, r = ring
+    w.put(success.RING_POINT, "d", 1.0)
+    w.put_stats(b'{"a": 1}')
+    assert w.put_stats(b"x" * (success.RING_STATS_MAX + 1)) is False
+    assert r.get_stats(0)[1] == b'{"a": 1}'
+    assert r.read(1)[1] == 1.0
+
+
+def test_stats_blob_truncates_long_profile(monkeypatch):
+    monkeypatch.setattr(success.profiler, "samples", 1)
+    monkeypatch.setattr(success.profiler, "report", lambda: "线程 %d\n" * 20000 % tuple(range(20000)))
+    blob = success.ring_stats_blob()
+    assert len(blob) <= success.RING_STATS_MAX
+    assert json.loads(blob)["profile"].endswith("（报告太长，已截断）\n")
+
+
+def test_follow_ring_applies_points_and_events(ring, monkeypatch):
+    w, r = ring
+    w.put(success.RING_POINT, "ring-dev", 1000.0, 30.0, 120.0, 0.0, 0.0, 9, ver=1)
+    w.put(success.RING_POINT, "ring-dev", 1060.0, 30.01, 120.0, 36.0, 0.0, 9, ver=2)
+    w.put(success.RING_EVENT, "ring-dev", 1060.0,
+          extra=json.dumps({"seq": 7, "type": "enter", "device": "ring-dev", "fence": "f"}).encode())
+    # 启动时已从 SQLite 恢复到 1000.0，第一条不再重放
+    for seq in range(1, r.cursor() + 1):
+        success.apply_ring_record(r.read(seq), {"ring-dev": 1000.0})
+    dev = success.get_device("ring-dev")
+    assert list(dev.trail.last_ts) == [1060.0]
+    assert success.geofences.events_since(6)[1][0]["seq"] == 7
+
+
+def test_workers_share_the_ingest_version(ring):
+    w, r = ring
+    # 接入进程里这台设备已经有 40 个 version；worker A 一直在跟，worker B 刚从 SQLite 恢复了前两个点
+    w.put(success.RING_POINT, "ver-dev", 1000.0, 30.0, 120.0, ver=40)
+    w.put(success.RING_DROP, "ver-dev", 1010.0, ver=41)
+    w.put(success.RING_POINT, "ver-dev", 1020.0, 30.01, 120.0, ver=42)
+    w.put(success.RING_POINT, "ver-dev", 1030.0, 30.02, 120.0, ver=43)
+    dev = success.get_device("ver-dev")
+    dev.add_point(29.99, 120.0, 0.0, 0.0, 9, 990.0)
+    dev.add_point(30.0, 120.0, 0.0, 0.0, 9, 1000.0)
+    for seq in range(1, r.cursor() + 1):
+        success.apply_ring_record(r.read(seq), {"ver-dev": 1000.0})
+    assert dev.version == 43 and list(dev.trail.ver) == [1, 2, 42, 43]
+    # 其他 worker 发出的游标在这里照样能做增量
+    head, _, trail = dev.snapshot_json(42)[1].decode().partition(', "trail": ')
+    assert json.loads(head + "}")["reset"] is False and trail.count('"seq"') == 1
+    # 恢复之前的游标对不上，按全量处理
+    assert json.loads(dev.snapshot_json(12)[1])["reset"] is True
+    assert dev.full_response()[0] == 43
+
+
+def test_cursor_epoch(monkeypatch):
+    assert success.cursor_in(success.cursor_out(42)) == 42
+    monkeypatch.setattr(success, "CURSOR_EPOCH", 5)
+    c = success.cursor_out(42)
+    assert c > 2 ** 32 and c < 2 ** 53  # 浏览器里仍是精确整数
+    assert success.cursor_in(c) == 42
+    # 别的 worker（或单进程）发出的游标按全量处理
+    assert success.cursor_in(42) == 0
+    monkeypatch.setattr(success, "CURSOR_EPOCH", 6)
+    assert success.cursor_in(c) == 0
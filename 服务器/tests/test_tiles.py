@@ -0,0 +1,43 @@
+import pytest
+
+import success
+
+
+def test_morton_interleaves_bits():
+    assert success.morton(0, 0) == 0
+    assert success.morton(1, 0) == 1
+    assert success.morton(0, 1) == 2
+    assert success.morton(3, 3) == 15
+    assert success.morton(0xFFFF, 0) == 0x55555555
+
+
+@pytest.mark.parametrize("lat,lon", [(30.0, 120.0), (39.9, 116.4), (-33.9, 151.2), (0.0, 0.0)])
+def test_tile_key_range_contains_point_at_every_zoom(lat, lon):
+    key = success.tile_key(lat, lon)
+    mx, my = success.mercator_xy(lat, lon)
+    for z in range(0, success.TILE_INDEX_ZOOM + 4):
+        n = 1 << z
+        lo, hi = success.tile_key_range(z, int(mx * n), int(my * n))
+        assert lo <= key < hi
+
+
+def test_tile_key_range_children_partition_parent():
+    z, x, y = 10, 857, 418
+    lo, hi = success.tile_key_range(z, x, y)
+    children = sorted(success.tile_key_range(z + 1, 2 * x + dx, 2 * y + dy)
+                      for dx in (0, 1) for dy in (0, 1))
+    assert children[0][0] == lo and children[-1][1] == hi
+    assert all(a[1] == b[0] for a, b in zip(children, children[1:]))
+
+
+def test_tile_key_range_deeper_than_index_is_single_cell():
+    z = success.TILE_INDEX_ZOOM + 2
+    lo, hi = success.tile_key_range(z, 13, 7)
+    assert hi - lo == 1 and lo == success.morton(13 >> 2, 7 >> 2)
+
+
+def test_encode_polyline_reference():
+    # Google 文档里的示例（坐标放大 1e5）
+    pts = [(3850000, -12020000), (4070000, -12095000), (4325200, -12645300)]
+    assert success.encode_polyline(pts) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+    assert success.encode_polyline([]) == ""
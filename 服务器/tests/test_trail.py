@@ -0,0 +1,70 @@
+import pytest
+
+import success
+
+
+def test_append_is_atomic():
+    t = success.TrailBuffer(10)
+    t.append(30.0, 120.0, 1.0, 5.0, 9, 100.0, 1)
+    with pytest.raises(OverflowError):
+        t.append(30.1, 120.1, 1.0, 5.0, 2 ** 40, 101.0, 2)
+    with pytest.raises(TypeError):
+        t.append(30.1, None, 1.0, 5.0, 9, 101.0, 2)
+    assert {len(c) for c in t.columns()} == {1}
+    t.append(30.2, 120.2, 1.0, 5.0, 8, 102.0, 3)
+    assert {len(c) for c in t.columns()} == {2}
+    assert list(t.sats) == [9, 8] and list(t.ver) == [1, 3]
+
+
+def test_report_with_huge_sats_is_clamped():
+    j = {"id": "sats-test", "lat": 30.0, "lon": 120.0, "sats": 2 ** 40}
+    success.handle_report(j, ("127.0.0.1", 1), ts=1000.0)
+    dev = success.get_device("sats-test")
+    assert {len(c) for c in dev.trail.columns()} == {1}
+    assert dev.trail.sats[0] == 255
+
+
+def fill(t, n, start=1):
+    for k in range(start, start + n):
+        t.append(30.0 + k, 120.0, 0.0, 0.0, k % 50, 1000.0 + k, k)
+
+
+def test_wrap_keeps_newest_points_in_order():
+    t = success.TrailBuffer(5)
+    fill(t, 12)
+    assert len(t) == 5 and t.first_seq == 8 and t.last_seq == 12
+    assert [t.ver[t.pos(i)] for i in range(5)] == [8, 9, 10, 11, 12]
+    assert t.ver[t.pos(-1)] == 12
+
+
+@pytest.mark.parametrize("n", [3, 5, 7, 10, 13])
+def test_copy_unwraps(n):
+    t = success.TrailBuffer(5)
+    fill(t, n)
+    for start in range(len(t) + 1):
+        c = t.copy(start)
+        expect = list(range(max(n - 5, 0) + 1 + start, n + 1))
+        assert list(c.ver) == expect
+        assert c.first_seq == (expect[0] if expect else t.last_seq + 1)
+        assert {len(col) for col in c.columns()} == {len(expect)}
+
+
+def test_index_since_after_wrap_and_touch():
+    t = success.TrailBuffer(5)
+    fill(t, 9)                       # ver 5..9 remain
+    assert t.index_since(0) == 0
+    assert t.index_since(7) == 3
+    assert t.index_since(9) == 5
+    t.touch_last(2000.0, 10)         # a stay bumps only the last point
+    assert t.index_since(9) == 4
+    assert list(t.copy(t.index_since(9)).ver) == [10]
+    assert t.last_ts[t.pos(-1)] == 2000.0
+
+
+def test_select_skips_evicted_seqs():
+    t = success.TrailBuffer(5)
+    fill(t, 8)                       # seqs 4..8 remain
+    s = t.select([1, 4, 6, 8, 9])
+    assert s.seqs == [4, 6, 8]
+    assert list(s.ver) == [4, 6, 8]
+    assert '"seq":6' in s.to_json()